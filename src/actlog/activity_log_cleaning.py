@@ -5,19 +5,35 @@ Created on Nov 18, 2021
 @author: paepcke
 '''
 import argparse
+import copy
 import csv
 import datetime
 import getpass
 import gzip
+import heapq
 import os
 import re
 import sys
-import time
 
 from logging_service import LoggingService
 from pymysql_utils.pymysql_utils import MySQLDB
 
+from actlog.bulk_load import BulkLoadSession, PhaseTimer
+from actlog.checkpoint import IngestCheckpoint
+from actlog.columnar import ColumnarBuffer
+from actlog.db_backends import MySqlBackend, SqliteBackend
+from actlog.dimensions import DimensionTable
+from actlog.env_scanner import EnvironmentScanner
+from actlog.flush_coordinator import FlushCoordinator
+from actlog.index_builder import IndexBuilder
+from actlog.int_lists import IntListParser
+from actlog.ip_cache import IpLocationCache
 from actlog.ipToFullLocation import IpFullLocation
+from actlog.log_index import LogIndex
+from actlog.parallel_ingest import ParallelIngester
+from actlog.parquet_sink import ParquetTableSink
+from actlog.pipeline import AsyncTableSink, DbTableSink, ExtractorStage, \
+    LoadDataTableSink, Pipeline, RowDecoder, SinkStage, TsvSource
 
 
 # For running in Eclipse on Mac: add path to mysql client:
@@ -82,41 +98,157 @@ class ActivityLogCleaner(object):
                            '0.0',               # Long
                            'Zip-Unknown',       # Zip/Postal code
                            'TZ-Unknown',        # Time zone
-                           '-1'                 # Phone country number
+                           '-1',                # Phone country number
                            '-1'                 # Area code
                            )
     '''Used when IP Address not in the database'''
 
     SECS_BETWEEN_HEARTBEATS = 5
+    
+    # How often the ingest saves a checkpoint,
+    # from which an interrupted run can resume:
+    SECS_BETWEEN_CHECKPOINTS = 300
+    
+    # Searches in which nothing was typed for this many
+    # seconds of log time are committed; 0: never, which
+    # keeps every pending search in memory until the log ends:
+    SEARCH_SESSION_TIMEOUT = 3600
+    
+    # Search deadline when no search is pending; sorts
+    # after all created_at values:
+    NO_SEARCH_DEADLINE = '\uffff'
+    
+    # Start of log time in seconds:
+    LOG_EPOCH = datetime.datetime(1970, 1, 1)
+    ONE_SEC = datetime.timedelta(seconds=1)
+
+    # Indexes created after the import:
+    #    (index name, table, column(s))
+    INDEX_SPECS = [
+        ('row_id_idx', 'ContextPins', 'row_id'),
+        ('row_id_idx', 'CrseSearches', 'row_id'),
+        ('row_id_idx', 'CrseSelects', 'row_id'),
+        ('row_id_idx', 'EnrollmentHist', 'row_id'),
+        ('row_id_idx', 'InstructorLookups', 'row_id'),
+        ('row_id_idx', 'Pins', 'row_id'),
+        ('row_id_idx', 'UnPins', 'row_id'),
+        ('row_id_idx', 'IpLocation', 'row_id'),
+        
+        ('crs_id_idx', 'ContextPins', 'crs_id'),
+        ('crs_id_idx', 'CourseInfo', 'crs_id'),
+        ('crs_id_idx', 'CrseSelects', 'crs_id'),
+        ('crs_id_idx', 'EnrollmentHist', 'crs_id'),
+        ('crs_id_idx', 'Pins', 'crs_id'),
+        ('crs_id_idx', 'UnPins', 'crs_id'),
+        
+        ('subj_idx', 'SubjSchoolSubschoolDep', 'subject'),
+        ('subj_idx', 'CourseInfo', 'subject'),
+        
+        ('created_at_idx', 'Activities', 'created_at'),
+        ('action_nm_idx', 'Activities', 'action_nm')
+        ]
+
+    # With the compact schema, these replace the
+    # indexes of Activities, which is a view then:
+    COMPACT_INDEX_SPECS = [
+        ('created_at_idx', 'ActivitiesCompact', 'created_at'),
+        ('action_id_idx', 'ActivitiesCompact', 'action_id'),
+        ('student_id_idx', 'ActivitiesCompact', 'student_id'),
+        ('student_hash_idx', 'Students', 'student_hash'),
+        ('location_id_idx', 'ActivitiesCompact', 'location_id')
+        ]
+
+    # Views that present the tables of the compact schema
+    # with the names and columns of the original tables.
+    # Times are kept in epoch seconds, which are turned
+    # back into datetimes independent of the session's
+    # time zone; the backend fills in the expressions
+    # for {created_at} and {updated_at}:
+    COMPACT_VIEWS = {
+        'Activities' : '''SELECT act.row_id,
+                                 students.student_hash AS student,
+                                 act.ip_addr,
+                                 actions.category,
+                                 actions.action_nm,
+                                 {created_at} AS created_at,
+                                 {updated_at} AS updated_at
+                            FROM ActivitiesCompact AS act
+                                 LEFT JOIN Actions AS actions
+                                   ON act.action_id = actions.action_id
+                                 LEFT JOIN Students AS students
+                                   ON act.student_id = students.student_id''',
+        'IpLocation' : '''SELECT act.row_id,
+                                 loc.country_code,
+                                 loc.country,
+                                 loc.state,
+                                 loc.city,
+                                 loc.lat,
+                                 loc.longitude,
+                                 loc.zip,
+                                 loc.time_zone,
+                                 loc.country_phone,
+                                 loc.area_code
+                            FROM ActivitiesCompact AS act
+                                 LEFT JOIN Locations AS loc
+                                   ON act.location_id = loc.location_id'''
+        }
+
+    # Columns of the location tables, after their id:
+    LOCATION_COL_SPECS = (('country_code', 'varchar(2)'),
+                          ('country', 'varchar(60)'),
+                          ('state', 'varchar(100)'),
+                          ('city', 'varchar(100)'),
+                          ('lat', 'varchar(40)'),
+                          ('longitude', 'varchar(40)'),
+                          ('zip', 'varchar(20)'),
+                          ('time_zone', 'varchar(10)'),
+                          ('country_phone', 'varchar(5)'),
+                          ('area_code', 'varchar(40)'))
+
+    # Each table's (column name, MySQL type) pairs,
+    # and its primary key:
+    TABLE_SCHEMAS = {
+        'Pins'              : ((('row_id', 'int'), ('crs_id', 'int')), None),
+        'UnPins'            : ((('row_id', 'int'), ('crs_id', 'int')), None),
+        'CrseSelects'       : ((('row_id', 'int'), ('crs_id', 'int')), None),
+        'EnrollmentHist'    : ((('row_id', 'int'), ('crs_id', 'int')), None),
+        'ContextPins'       : ((('row_id', 'int'), ('quarter_id', 'int'), ('crs_id', 'int')), None),
+        'CrseSearches'      : ((('row_id', 'int'),
+                                ('search_term', f'varchar({MAX_SEARCH_TERM_LEN})'),
+                                ('crs_res', 'text'),
+                                ('instructor_res', 'text')), None),
+        'Activities'        : ((('row_id', 'int NOT NULL'),
+                                ('student', 'varchar(100)'),
+                                ('ip_addr', 'varchar(16)'),
+                                ('category', 'varchar(30)'),
+                                ('action_nm', 'varchar(30)'),
+                                ('created_at', 'datetime'),
+                                ('updated_at', 'datetime')), 'row_id'),
+        'ActivitiesCompact' : ((('row_id', 'int unsigned NOT NULL'),
+                                ('student_id', 'int unsigned'),
+                                ('ip_addr', 'varchar(16)'),
+                                ('location_id', 'int unsigned'),
+                                ('action_id', 'smallint unsigned'),
+                                ('created_at', 'int unsigned'),
+                                ('updated_at', 'int unsigned')), 'row_id'),
+        'Locations'         : ((('location_id', 'int unsigned NOT NULL'),) + LOCATION_COL_SPECS, 'location_id'),
+        'Students'          : ((('student_id', 'int unsigned NOT NULL'),
+                                ('student_hash', 'varchar(100)')), 'student_id'),
+        'Actions'           : ((('action_id', 'smallint unsigned NOT NULL'),
+                                ('category', 'varchar(30)'),
+                                ('action_nm', 'varchar(30)')), 'action_id'),
+        'InstructorLookups' : ((('row_id', 'int'), ('instructor', 'varchar(40)')), None),
+        'IpLocation'        : ((('row_id', 'int'),) + LOCATION_COL_SPECS, None)
+        }
 
     STRM_LEN = 4
 
     caller_pat = re.compile(r"")
 
-    # For extracting pins from ENVIRONMENT context
-    # for the two varieties: early format and late
-    # format (2016-2017, 2017-present):
-    
-    # If successful, the following pattern returns
-    #    b'1156:208582, 1162:120904'
-    context_pinned_early_var_pat = re.compile(b'.*pinned:{([^}]*)}.*')
-    
-    # If successful, the following pattern returns
-    # the list shown in header comment:
-    context_pinned_late_var_phase1_pat = re.compile(b'.*pinned_courses"=>\[([^]]*)].*')
-    # Pick the crse_id nums from the pin specs 
-    # Intended to be used with pattern.findall().
-    # Returns:
-    #   [(b'1214', b'204608'), (b'1214', b'105670'), (b'1214', b'105687'), (b'1214', b'219885')]
-    context_pinned_late_var_phase2_pat = re.compile(b'STRM: ([0-9]{4}), CLASS_NBR: [^,]*, CRSE_ID: ([0-9]{6})')
-    
-    context_enrl_hist_early_pat = re.compile(b'course_history_ids:([^\]]*])')
-    
-    # Pick up the enrire list of #<Enrollment STRM:nil, ... CRSE_ID: 156872, ...>, #<Enrollment...>]
-    context_enrl_hist_late_phase1_pat  = re.compile(b'registered_courses"=>([^\]]*])')
-    # Pick STRM and CRS_ID nums out of the #<Enrollment STRM:nil, ... CRSE_ID: 156872, ...> entries.
-    # Intended to be used with findall().
-    context_enrl_hist_late_phase2_pat  = re.compile(b'CRSE_ID: ([0-9]{6})') 
+    # Pins and enrollment history in the ENVIRONMENT
+    # context of the two varieties, early format and late
+    # format (2016-2017, 2017-present), are found by
+    # an EnvironmentScanner.
     
     p_history_pat = re.compile(b"#<Enrollment (STRM: [0-9]{4}, CRSE_ID: [0-9]{6})")
 
@@ -147,13 +279,131 @@ class ActivityLogCleaner(object):
                  db_name=None,
                  db_pwd=None,        # ******Remove 
                  start_fresh = False,
+                 num_workers=1,
+                 async_writer=False,
+                 load_data=False,
+                 bulk_load=False,
+                 checkpoints=True,
+                 row_range=None,
+                 date_range=None,
+                 columnar_buffers=False,
+                 memory_budget=None,
+                 search_timeout=None,
+                 compact_schema=False,
+                 ip_cache_path=None,
+                 parquet_dir=None,
+                 sqlite_path=None,
                  unittesting=False):
         '''
         Constructor
+        
+        If num_workers is greater than 1, rows are processed
+        in that many worker processes (see ingest_parallel()).
+        If async_writer is True, full buffers are written to
+        the db by a background thread, while parsing continues
+        (see AsyncTableSink). If load_data is True, buffers are
+        written via LOAD DATA LOCAL INFILE, instead of INSERT
+        (see LoadDataTableSink). If bulk_load is True, table
+        keys are disabled during the ingest, and rebuilt
+        afterwards (see BulkLoadSession).
+        
+        If checkpoints is True, the ingest saves its
+        progress next to the log when it starts,
+        and every SECS_BETWEEN_CHECKPOINTS (see IngestCheckpoint).
+        When the tables exist and are not to be wiped, 
+        the ingest resumes from the last checkpoint; without
+        one, it refuses to run.
+        
+        The ingest may be limited to a row_range of
+        (first row id, last row id), or a date_range of
+        (start date, end date), with the end date excluded,
+        like ('2017-01-01', '2018-01-01'). Either end may
+        be None. A LogIndex of the log is then loaded or
+        built, and reading starts close to the first row 
+        of the range. Range limited runs save no checkpoints.
+        
+        If columnar_buffers is True, rows are buffered in
+        typed per-column arrays rather than as tuples (see
+        ColumnarBuffer), which takes less memory, and fewer
+        garbage collections.
+        
+        If memory_budget is given, in bytes, buffers are not
+        flushed at fixed row counts, but as decided by a 
+        FlushCoordinator: batch sizes adapt to insert latencies,
+        batches stay below the server's max_allowed_packet, and
+        the largest buffers are flushed early when all buffers 
+        together reach the budget.
+        
+        Searches in which nothing was typed for search_timeout
+        seconds of log time are committed as the ingest reaches
+        that time; default: SEARCH_SESSION_TIMEOUT, an hour.
+        With a search_timeout of 0, searches stay pending until
+        the visitor does something else, or the log ends, so
+        memory grows with the number of visitors who stopped
+        in the middle of a search.
+        
+        If compact_schema is True, activities go into the
+        ActivitiesCompact table: each caller/action pair is
+        replaced by a small int id, whose pair is in the
+        Actions table, each student hash by an int id from
+        the Students table, and the times are stored as epoch 
+        seconds. Instead of an IpLocation row, each activity
+        has the id of its location in the Locations table.
+        The Activities and IpLocation views join them back 
+        into the original columns (see COMPACT_VIEWS).
+        
+        IP locations are looked up through an IpLocationCache.
+        If ip_cache_path is given, the cache is loaded from that
+        file, and saved there at the end of the ingest, for
+        reuse by later runs.
+        
+        If parquet_dir is given, no db is opened. The tables
+        are written as Parquet files into directories of their
+        names below parquet_dir instead (see ParquetTableSink),
+        replacing those of an earlier export. Such exports
+        always start at the beginning of the log, or of the
+        given range, and save no checkpoints.
+        
+        If sqlite_path is given, the tables go into that
+        SQLite file rather than into MySQL (see SqliteBackend).
+        Its primary keys are added after the ingest. LOAD DATA
+        and the bulk load session are MySQL only.
         '''
         self.log = LoggingService()
 
+        self.activity_log_path = activity_log_path
+        self.checkpoints = checkpoints
+        if row_range is not None and date_range is not None:
+            raise ValueError("Specify a row range or a date range, not both")
+        self.row_range = row_range
+        self.date_range = date_range
+        self.columnar_buffers = columnar_buffers
+        self.compact_schema = compact_schema
+        self.ip_cache_path = ip_cache_path
+        self.parquet_dir = parquet_dir
+        self.sqlite_path = sqlite_path
+        if sqlite_path is not None and (load_data or bulk_load):
+            raise ValueError("LOAD DATA and bulk load sessions need MySQL, not SQLite")
+        self.search_timeout = self.SEARCH_SESSION_TIMEOUT if search_timeout is None else search_timeout
+        # Column typecodes of each buffer:
+        self.buffer_typecodes = {}
+        if memory_budget is None:
+            self.flush_coordinator = None
+        else:
+            self.flush_coordinator = FlushCoordinator(memory_budget)
+        # Sparse index of the log, if available:
+        self.log_index = None
+
         self.db_user = db_user
+        # Worker processes open their own connections:
+        self.db_pwd = db_pwd
+        self.num_workers = num_workers
+        self.async_writer = async_writer
+        self.load_data = load_data
+        self.bulk_load = bulk_load
+        self.bulk_session = None
+        # Time taken by each phase of the run:
+        self.phase_timer = PhaseTimer()
         
         # Lookup dict crs nm to crs ID: 
         #     'STATS50' : 123456
@@ -164,32 +414,39 @@ class ActivityLogCleaner(object):
         # corresponding table when the buffer is full. 
         # The following are the buffers:
         
-        # Holds one tuple for each action:
-        self.activity_buf = BufferClass('activity_buf', self.DB_BATCH_SIZE_BIG)
+        # Holds one tuple for each action. The
+        # typecodes are those of a ColumnarBuffer's
+        # columns; the row ids of Activities and 
+        # IpLocation are str:
+        if self.compact_schema:
+            self.activity_buf = self._new_buffer('activity_buf', self.DB_BATCH_SIZE_BIG, 
+                                                 (None, 'q', None, 'q', 'q', 'q', 'q'))
+        else:
+            self.activity_buf = self._new_buffer('activity_buf', self.DB_BATCH_SIZE_BIG, (None,) * 7)
          
         # Three buffers around pinning:
         # two for the action of pinning and unpinning...:
-        self.pins_buf = BufferClass('pins_buf', self.DB_BATCH_SIZE_SMALL)
-        self.unpins_buf = BufferClass('unpins_buf', self.DB_BATCH_SIZE_SMALL)
+        self.pins_buf = self._new_buffer('pins_buf', self.DB_BATCH_SIZE_SMALL, ('q', 'q'))
+        self.unpins_buf = self._new_buffer('unpins_buf', self.DB_BATCH_SIZE_SMALL, ('q', 'q'))
         # ... the third for the pinned-courses list that
         # is kept with many non-pin-related actions as context:
-        self.pins_in_context_buf = BufferClass('pins_in_context_buf', self.DB_BATCH_SIZE_SMALL)
+        self.pins_in_context_buf = self._new_buffer('pins_in_context_buf', self.DB_BATCH_SIZE_SMALL, ('q', 'q', 'q'))
         # Courses selected for deeper viewing
-        self.crs_selects_buf = BufferClass('crs_selects_buf', self.DB_BATCH_SIZE_BIG)
+        self.crs_selects_buf = self._new_buffer('crs_selects_buf', self.DB_BATCH_SIZE_BIG, ('q', 'q'))
         # Buffer for search terms before going into db:
-        self.crs_search_buf = BufferClass('crs_search_buf', self.DB_BATCH_SIZE_SMALL)
+        self.crs_search_buf = self._new_buffer('crs_search_buf', self.DB_BATCH_SIZE_SMALL, ('q', None, None, None))
         
         # The long lists of enrollment history
         # that comes with some actions. Those
         # are NOT enrollments, which do not occur within
         # Carta:
-        self.enrl_hist_buf = BufferClass('enrl_hist_buf', self.DB_BATCH_SIZE_BIG)
+        self.enrl_hist_buf = self._new_buffer('enrl_hist_buf', self.DB_BATCH_SIZE_BIG, ('q', 'q'))
 
         # Visitors lookup up a particular instructor:
-        self.instructor_lookup_buf = BufferClass('instructor_lookup_buf', self.DB_BATCH_SIZE_SMALL)
+        self.instructor_lookup_buf = self._new_buffer('instructor_lookup_buf', self.DB_BATCH_SIZE_SMALL, ('q', None))
         
         # IP Address reference:
-        self.ip_location_buf = BufferClass('ip_location_lookup_buf', self.DB_BATCH_SIZE_BIG)
+        self.ip_location_buf = self._new_buffer('ip_location_lookup_buf', self.DB_BATCH_SIZE_BIG, (None,) * 11)
         
         # Set up map between each buffer and
         # the database table into which it empties.
@@ -229,130 +486,530 @@ class ActivityLogCleaner(object):
                                     'area_code'))
             }
         
+        # Lookup tables of the compact schema, and the
+        # buffers of their new rows:
+        self.dimension_bufs = {}
+        # False in the workers of a parallel ingest, whose
+        # lookup table ids are all assigned by the parent:
+        self.assigns_dimension_ids = True
+        # In the parent of a parallel ingest: the ids assigned
+        # so far, as (table, key, id), for passing them on
+        # to the workers:
+        self.new_dimension_ids = None
+        if self.compact_schema:
+            self.actions = DimensionTable('Actions', 'action_id', ('category', 'action_nm'))
+            self.students = DimensionTable('Students', 'student_id', ('student_hash',))
+            self.locations = DimensionTable('Locations', 'location_id', 
+                                            self.buffer_tables[self.ip_location_buf][1][1:])
+            # Location tuples as returned by ip_dict --> location
+            # id. The ids of Locations are keyed by str values,
+            # as they are read back from the db:
+            self.location_ids = {}
+            # Locations replace the IpLocation rows:
+            del self.buffer_tables[self.ip_location_buf]
+            self.buffer_tables[self.activity_buf] = ('ActivitiesCompact',
+                                                     (
+                                                        'row_id',
+                                                        'student_id',
+                                                        'ip_addr',
+                                                        'location_id',
+                                                        'action_id',
+                                                        'created_at',
+                                                        'updated_at'
+                                                        ))
+            for dim in (self.actions, self.students, self.locations):
+                dim_buf = self._new_buffer(f"{dim.table.lower()}_buf", self.DB_BATCH_SIZE_SMALL, 
+                                           ('q',) + (None,) * len(dim.key_cols))
+                self.dimension_bufs[dim] = dim_buf
+                self.buffer_tables[dim_buf] = (dim.table, dim.col_names)
+        
+        if self.flush_coordinator is not None:
+            for buf, (tbl_nm, _col_names) in self.buffer_tables.items():
+                self.flush_coordinator.register(buf, tbl_nm, self.buffer_typecodes[buf])
+        
+        # Parses int lists, and counts the malformed
+        # ones, for all extractors:
+        self.int_parser = IntListParser()
+        
+        # Finds pins and enrollment history in 
+        # initial_recommendation rows:
+        self.env_scanner = EnvironmentScanner(self.int_parser)
+        
         # All the currently searching emplids:
         self.crs_search_states = {}
         
+        # Min-heap of (last keystroke secs, row_id, emplid) of
+        # the pending searches. Entries are not updated as
+        # visitors type; popped entries of searches with later
+        # keystrokes are pushed again, and those of searches
+        # committed otherwise are skipped. The created_at at
+        # which the oldest entry times out:
+        self.search_heap = []
+        self.search_deadline = self.NO_SEARCH_DEADLINE
+        
+        # Id of the row being processed:
+        self.cur_id = None
+        
+        # Destination of full buffers; a DbTableSink
+        # once the db is open:
+        self.sink = None
+        
+        # IP address --> location lookups; an IpLocationCache
+        # once the IP table is loaded:
+        self.ip_dict = None
+        
         if unittesting:
             return
         
-        self.db = self.open_db(uname=self.db_user, pwd=db_pwd, start_fresh=start_fresh)
+        if self.parquet_dir is not None:
+            self.export_parquet(activity_log_path)
+            return
+        
+        with self.phase_timer.phase('open db'):
+            self.db = self.open_db(uname=self.db_user, pwd=db_pwd, start_fresh=start_fresh)
 
-        self.log.info("Loading IP locations...")
-        self.ip_dict = IpFullLocation()
-        self.log.info("Done loading IP locations.")
+        with self.phase_timer.phase('load IP locations'):
+            self.ip_dict = IpLocationCache(IpFullLocation(), cache_path=self.ip_cache_path)
 
-        if self.is_gzipped(activity_log_path):
-            open_func = gzip.open
-        else:
-            open_func = open
-        
-        # For timing printouts of number of records processed:
-        prev_sign_of_life = int(time.time())
-        
-        # Open the activity log CSV or CSV.ZIP:
-        with open_func(activity_log_path, 'rt') as fd:
-            # Process a row at a time:
-            reader = csv.reader(fd, delimiter='\t')
-            _header = next(reader)
-            # Are we to pick up where we left off?
-            if type(self.start_fresh) == int:
-                # Yes, so skip the already-done rows:
-                for row in reader:
-                    if int(row[ID_POS]) < self.start_fresh:
-                        continue
-            for row in reader:
-                try:
-                    self.cur_id = int(row[ID_POS])
-                    # About 575 early entries have emplid == 0;
-                    # ignore those.
-                    if row[EMPLID_POS] == '0':
-                        continue
-                except Exception as _e:
-                    self.log.err(f"Row does not have a row id: {row}")
-                    continue
-                #**************
-                # caller = row[CALLER_POS]
-                # action = row[ACTION_POS]
-                # if not (caller == 'index' and action == 'show_index_page'):
-                #     continue
-                #**************
-                self.dispatch_row(row, self.cur_id)
-                # Time for printing progress?
-                cur_time = int(time.time())
-                if (cur_time - prev_sign_of_life) > self.SECS_BETWEEN_HEARTBEATS:
-                    print(f"At record {self.cur_id}", end='\r')
-                    prev_sign_of_life = cur_time
-            # Finished:
-            # Close out any searches:
-            self.commit_hanging_search_actions(cur_log_time=row[CREATED_AT_POS])
-            
-            for buf in self.buffer_tables.keys():
-                self.flush_buffer(buf)
-            # Break out of the inline progress report:
-            print()
-            self.log.info(f"Imported {self.cur_id} records.")
+        with self.phase_timer.phase('log index'):
+            self.open_log_index()
 
-        # Create indexing:
-        self.log.info("Creating indexes on row_id for ...")
-        self.log.info("ContextPins ...")
-        self._index_if_not_exists('row_id_idx', 'ContextPins', 'row_id')
+        if self.bulk_load:
+            tables = [tbl_nm for tbl_nm, _cols in self.buffer_tables.values()]
+            self.bulk_session = BulkLoadSession(self.db, tables)
+        try:
+            if self.bulk_session is not None:
+                self.bulk_session.apply_session_settings()
+                with self.phase_timer.phase('disable keys'):
+                    self.bulk_session.disable_keys()
+
+            with self.phase_timer.phase('ingest'):
+                if self.num_workers > 1:
+                    self.ingest_parallel(activity_log_path)
+                else:
+                    self.ingest(activity_log_path)
 
-        self.log.info("CrseSearches ...")
-        self._index_if_not_exists('row_id_idx', 'CrseSearches', 'row_id')
-        
-        self.log.info("CrseSelects ...")
-        self._index_if_not_exists('row_id_idx', 'CrseSelects', 'row_id')
+            if self.bulk_session is not None:
+                with self.phase_timer.phase('enable keys'):
+                    self.bulk_session.enable_keys()
 
-        self.log.info("EnrollmentHist ...")
-        self._index_if_not_exists('row_id_idx', 'EnrollmentHist', 'row_id')
-        
-        self.log.info("InstructorLookups ...")
-        self._index_if_not_exists('row_id_idx', 'InstructorLookups', 'row_id')
-        
-        self.log.info("Pins ...")
-        self._index_if_not_exists('row_id_idx', 'Pins', 'row_id')
+            if self.db.DEFERS_PRIMARY_KEYS:
+                with self.phase_timer.phase('primary keys'):
+                    self.add_primary_keys()
+
+            with self.phase_timer.phase('create indexes'):
+                self.create_indexes()
+        finally:
+            if self.bulk_session is not None:
+                # After a failure, don't leave tables without
+                # their keys; both calls do nothing if done:
+                self.bulk_session.enable_keys()
+                self.bulk_session.restore_session_settings()
+
+        self.phase_timer.report()
         
-        self.log.info("UnPins ...")
-        self._index_if_not_exists('row_id_idx', 'UnPins', 'row_id')
+        self.db.close()
+
+    #------------------------------------
+    # export_parquet
+    #-------------------
+    
+    def export_parquet(self, activity_log_path):
+        '''
+        Like the ingest done by the constructor, but the
+        tables go into Parquet files below self.parquet_dir.
         
-        self.log.info("IpLocation ...")
-        self._index_if_not_exists('row_id_idx', 'IpLocation', 'row_id')
+        :param activity_log_path: path to activity log tsv;
+            may be gzipped
+        :type activity_log_path: str
+        '''
+        self.start_fresh = True
+        self.checkpoints = False
+
+        with self.phase_timer.phase('load IP locations'):
+            self.ip_dict = IpLocationCache(IpFullLocation(), cache_path=self.ip_cache_path)
+
+        with self.phase_timer.phase('log index'):
+            self.open_log_index()
+
+        ParquetTableSink.remove_parts(self.parquet_dir, 
+                                      [tbl_nm for tbl_nm, _cols in self.buffer_tables.values()])
+        self.sink = self.make_parquet_sink()
+
+        with self.phase_timer.phase('export'):
+            if self.num_workers > 1:
+                self.ingest_parallel(activity_log_path)
+            else:
+                self.ingest(activity_log_path)
+
+        self.phase_timer.report()
+
+    #------------------------------------
+    # ingest
+    #-------------------
+    
+    def ingest(self, activity_log_path, threaded=False):
+        '''
+        Read the activity log, and dispatch each row 
+        to the extractors in this process. All buffers
+        are flushed to self.sink when the log is exhausted.
+        
+        :param activity_log_path: path to activity log tsv;
+            may be gzipped
+        :type activity_log_path: str
+        :param threaded: whether to run each pipeline stage
+            in its own thread
+        :type threaded: bool
+        '''
+
+        start_offset, min_row_id, max_row_id = self.read_range()
+        checkpoints = self.checkpoints and self.row_range is None
+        if checkpoints:
+            self.save_start_checkpoint(activity_log_path)
+        pipeline = self.build_pipeline(activity_log_path, 
+                                       self.sink, 
+                                       min_row_id=min_row_id,
+                                       max_row_id=max_row_id,
+                                       start_offset=start_offset,
+                                       checkpoints=checkpoints)
+        pipeline.run(threaded=threaded)
+        # Break out of the inline progress report:
+        print()
+        self.log.info(f"Imported {self.cur_id} records.")
+
+    #------------------------------------
+    # save_start_checkpoint
+    #-------------------
+    
+    def save_start_checkpoint(self, activity_log_path):
+        '''
+        Save a checkpoint at the start of the log, unless
+        resuming from a checkpoint, which then stays in place.
+        An ingest that fails before it saves its first regular
+        checkpoint is thus resumed by starting over.
+        
+        :param activity_log_path: path to activity log tsv;
+            may be gzipped
+        :type activity_log_path: str
+        '''
+        if isinstance(self.start_fresh, IngestCheckpoint):
+            return
+        IngestCheckpoint.of_cleaner(self, activity_log_path, 0).save()
+
+    #------------------------------------
+    # build_pipeline
+    #-------------------
+    
+    def build_pipeline(self, 
+                       activity_log_path, 
+                       sink, 
+                       min_row_id=None, 
+                       max_row_id=None,
+                       start_offset=0, 
+                       checkpoints=False):
+        '''
+        Return a Pipeline that reads the activity log,
+        runs this cleaner's extractors, and writes the
+        results to the given sink. 
+        
+        :param activity_log_path: path to activity log tsv;
+            may be gzipped
+        :type activity_log_path: str
+        :param sink: destination of the extracted records
+        :type sink: TableSink
+        :param min_row_id: if provided, rows with lower ids
+            are skipped
+        :type min_row_id: {None | int}
+        :param max_row_id: if provided, reading stops after
+            the row with this id
+        :type max_row_id: {None | int}
+        :param start_offset: uncompressed byte offset in the
+            log at which to start reading
+        :type start_offset: int
+        :param checkpoints: whether to save checkpoints
+            while ingesting
+        :type checkpoints: bool
+        :return: the pipeline, ready to run
+        :rtype: Pipeline
+        '''
+        return Pipeline([TsvSource(activity_log_path, 
+                                   start_offset=start_offset, 
+                                   track_offsets=checkpoints,
+                                   log_index=self.log_index),
+                         RowDecoder(self, min_row_id=min_row_id, max_row_id=max_row_id),
+                         ExtractorStage(self, 
+                                        checkpoint_log=activity_log_path if checkpoints else None),
+                         SinkStage(sink)
+                         ])
+
+    #------------------------------------
+    # resume_point
+    #-------------------
+    
+    def resume_point(self):
+        '''
+        Return where reading the log is to start, given
+        self.start_fresh as set by open_db(): at the offset
+        of an IngestCheckpoint, else from the start.
         
-        self.log.info("Creating indexes on crs_id for ...")
-        self.log.info("ContextPins ...")
-        self._index_if_not_exists('crs_id_idx', 'ContextPins', 'crs_id')
+        :return: uncompressed byte offset at which to start
+            reading, and lowest row id to process 
+        :rtype: (int, {None | int})
+        '''
+        if isinstance(self.start_fresh, IngestCheckpoint):
+            return (self.start_fresh.offset, None)
+        return (0, None)
+
+    #------------------------------------
+    # read_range
+    #-------------------
+    
+    def read_range(self):
+        '''
+        Combine the resume point with self.row_range.
         
-        self.log.info("CourseInfo ...")
-        self._index_if_not_exists('crs_id_idx', 'CourseInfo', 'crs_id')
+        :return: uncompressed byte offset at which to start
+            reading, lowest row id to process, and highest
+            row id to process
+        :rtype: (int, {None | int}, {None | int})
+        '''
+        start_offset, min_row_id = self.resume_point()
+        if self.row_range is None:
+            return (start_offset, min_row_id, None)
+        range_min, range_max = self.row_range
+        if range_min is not None and (min_row_id is None or range_min > min_row_id):
+            min_row_id = range_min
+            start_offset = max(start_offset, self.offset_for_row_id(range_min))
+        return (start_offset, min_row_id, range_max)
+
+    #------------------------------------
+    # offset_for_row_id
+    #-------------------
+    
+    def offset_for_row_id(self, row_id):
+        '''
+        Offset from which reading reaches the given row
+        soon: looked up in the log index, if available,
+        else 0, i.e. the start of the log.
+        '''
+        if self.log_index is None:
+            return 0
+        return self.log_index.offset_for_row_id(row_id)
+
+    #------------------------------------
+    # open_log_index
+    #-------------------
+    
+    def open_log_index(self):
+        '''
+        Set self.log_index. If the ingest is limited to a 
+        range, the index is built if needed, and a date range
+        is turned into a row range. Else a saved index is
+        used if there is one, to speed up resuming.
+        '''
+        if self.row_range is None and self.date_range is None:
+            self.log_index = LogIndex.load(self.activity_log_path)
+            return
+        self.log_index = LogIndex.load_or_build(self.activity_log_path)
+        if self.date_range is not None:
+            self.row_range = self.log_index.row_range_for_dates(*self.date_range)
+            self.log.info(f"Dates {self.date_range} are rows {self.row_range}")
+
+    #------------------------------------
+    # finish_ingest
+    #-------------------
+    
+    def finish_ingest(self, last_row=None, save_ip_cache=True):
+        '''
+        Close out any searches that are still
+        accumulating, and flush all buffers. 
+        
+        :param last_row: the last row that was dispatched;
+            None if no rows were dispatched, like when
+            resuming at the end of the log
+        :type last_row: {None | [str]}
+        :param save_ip_cache: whether to save the IP location
+            cache; parallel workers leave that to the parent
+        :type save_ip_cache: bool
+        '''
+        if last_row is not None:
+            self.commit_hanging_search_actions(cur_log_time=last_row[CREATED_AT_POS])
+        else:
+            for emplid in list(self.crs_search_states.keys()):
+                self.commit_search_action(emplid)
         
-        self.log.info("CrseSelects ...")
-        self._index_if_not_exists('crs_id_idx', 'CrseSelects', 'crs_id')
+        self.flush_all_buffers()
         
-        self.log.info("EnrollmentHist ...")
-        self._index_if_not_exists('crs_id_idx', 'EnrollmentHist', 'crs_id')
+        if self.flush_coordinator is not None:
+            self.flush_coordinator.report()
         
-        self.log.info("Pins ...")
-        self._index_if_not_exists('crs_id_idx', 'Pins', 'crs_id')
+        if isinstance(self.ip_dict, IpLocationCache):
+            self.ip_dict.report()
+            if save_ip_cache:
+                self.ip_dict.save()
         
-        self.log.info("UnPins ...")
-        self._index_if_not_exists('crs_id_idx', 'UnPins', 'crs_id')
+        if self.int_parser.num_malformed > 0:
+            self.log.warn(f"Skipped {self.int_parser.num_malformed} malformed int lists or pins")
+
+    #------------------------------------
+    # flush_all_buffers
+    #-------------------
+    
+    def flush_all_buffers(self):
+        '''
+        Empty all buffers into self.sink. Searches
+        that are still being typed stay pending.
+        '''
+        for buf in self.buffer_tables.keys():
+            self.flush_buffer(buf)
+
+    #------------------------------------
+    # ingest_parallel
+    #-------------------
+    
+    def ingest_parallel(self, activity_log_path):
+        '''
+        Like ingest(), but rows are handed to self.num_workers
+        worker processes. Each worker runs the extractors
+        on its share of rows, and flushes its buffers through
+        its own db connection. Rows are routed by a hash of 
+        the emplid, so all activities of one visitor are 
+        handled by the same worker, in log order. This keeps 
+        the search term accumulation in crs_search_states
+        correct.
+        
+        Checkpoints are saved as by ingest(), after all
+        workers flushed their buffers (see ParallelIngester).
+        
+        :param activity_log_path: path to activity log tsv;
+            may be gzipped
+        :type activity_log_path: str
+        '''
         
-        self.log.info("Creating indexes on subject for ...")
-        self.log.info("SubjSchoolSubschoolDep ...")
-        self._index_if_not_exists('subj_idx', 'SubjSchoolSubschoolDep', 'subject')
+        ingester = ParallelIngester(self, self.num_workers, key_pos=EMPLID_POS)
+        start_offset, min_row_id, max_row_id = self.read_range()
+        checkpoints = self.checkpoints and self.row_range is None
+        if checkpoints:
+            self.save_start_checkpoint(activity_log_path)
+        decoder = RowDecoder(self, min_row_id=min_row_id, max_row_id=max_row_id)
+        source = TsvSource(activity_log_path, 
+                           start_offset=start_offset, 
+                           track_offsets=checkpoints,
+                           log_index=self.log_index)
+        batches = decoder.process(source.process())
+        if self.compact_schema:
+            # Lookup table ids are assigned here, and
+            # sent to the workers with the rows:
+            self.new_dimension_ids = []
+            batches = self._with_dimension_ids(batches)
+        self.cur_id, truncated = ingester.run(batches, 
+                                              checkpoint_log=activity_log_path if checkpoints else None)
+        # The lookup table rows are written from here:
+        for dim_buf in self.dimension_bufs.values():
+            self.flush_buffer(dim_buf)
+        self.sink.truncated_search_terms += truncated
+        self.sink.close()
+        # Holds the workers' lookups as well (see ParallelIngester):
+        if isinstance(self.ip_dict, IpLocationCache):
+            self.ip_dict.save()
+        self.log.info(f"Imported {self.cur_id} records using {self.num_workers} workers.")
 
-        self.log.info("CourseInfo ...")
-        self._index_if_not_exists('subj_idx', 'CourseInfo', 'subject')
+    #------------------------------------
+    # _with_dimension_ids
+    #-------------------
+    
+    def _with_dimension_ids(self, batches):
+        '''
+        Generator that passes on the batches of (row_id, row)
+        it is given, after assigning the lookup table ids of
+        their rows. See assign_dimension_ids().
+        '''
+        for batch in batches:
+            for _row_id, row in batch:
+                self.assign_dimension_ids(row)
+            yield batch
+
+    #------------------------------------
+    # log_rows
+    #-------------------
+    
+    def log_rows(self, reader):
+        '''
+        Generator that yields (row_id, row) for each
+        usable row delivered by the given csv reader.
+        Rows without a row id, and the early rows 
+        with emplid 0 are skipped.
         
-        self.log.info("Creating index on created_at for Activities...")
-        self._index_if_not_exists('created_at_idx', 'Activities', 'created_at')
+        :param reader: csv reader over the activity log
+        :type reader: csv.reader
+        '''
+        for row in reader:
+            try:
+                row_id = int(row[ID_POS])
+                # About 575 early entries have emplid == 0;
+                # ignore those.
+                if row[EMPLID_POS] == '0':
+                    continue
+            except Exception as _e:
+                self.log.err(f"Row does not have a row id: {row}")
+                continue
+            yield row_id, row
 
-        self.log.info("Creating index on action_nm for Activities...")
-        self._index_if_not_exists('action_nm_idx', 'Activities', 'action_nm')
+    #------------------------------------
+    # create_indexes
+    #-------------------
+    
+    def create_indexes(self):
+        '''
+        Create all indexes in INDEX_SPECS that do not exist 
+        yet. Called after all rows have been imported. 
+        Tables are indexed concurrently, each through its
+        own connection (see IndexBuilder), unless the backend
+        writes through one connection at a time.
+        '''
+        if self.bulk_session is not None:
+            # Index sorting benefits from the bulk load buffers:
+            prepare = self.bulk_session.apply_session_settings
+        else:
+            prepare = None
+        builder = IndexBuilder(lambda : self.connect_db(uname=self.db_user, pwd=self.db_pwd),
+                               self.index_specs(),
+                               pool_size=None if self.db.CONCURRENT_WRITERS else 1,
+                               prepare=prepare)
+        durations = builder.build()
+        total_secs = sum(duration for _tbl_nm, _idx_nm, duration in durations)
+        self.log.info(f"Done indexing: {len(durations)} indexes, {total_secs:.1f}s total index build time")
 
-        self.log.info("Done indexing")
+    #------------------------------------
+    # add_primary_keys
+    #-------------------
+    
+    def add_primary_keys(self):
+        '''
+        Add the primary keys the backend left out
+        when it created the tables.
+        '''
+        for tbl_nm, _cols in self.buffer_tables.values():
+            primary_key = self.TABLE_SCHEMAS[tbl_nm][1]
+            if primary_key is not None:
+                self.db.add_primary_key(tbl_nm, primary_key)
+
+    #------------------------------------
+    # index_specs
+    #-------------------
+    
+    def index_specs(self):
+        '''
+        Return the specs of the indexes to create:
+        INDEX_SPECS, with those of views replaced by
+        COMPACT_INDEX_SPECS when the schema is compact.
         
-        self.db.close()
+        :rtype: [(str, str, str)]
+        '''
+        if not self.compact_schema:
+            return self.INDEX_SPECS
+        return [spec for spec in self.INDEX_SPECS 
+                if spec[1] not in self.COMPACT_VIEWS] + self.COMPACT_INDEX_SPECS
 
     #------------------------------------
     # process_one_row
@@ -364,6 +1021,12 @@ class ActivityLogCleaner(object):
         action = row[ACTION_POS]
         emplid = row[EMPLID_POS]
         
+        # Close out searches that timed out by this
+        # row's time; created_at values sort as str, but
+        # ones that are not times, like 'NULL', do not count:
+        if row[-2] >= self.search_deadline and row[-2][:1].isdigit():
+            self.expire_searches(row[-2])
+        
         # So far, it will be necessary further down
         # to add an activity table record for this
         # action:
@@ -412,8 +1075,7 @@ class ActivityLogCleaner(object):
         # Add other info contained in the row:
 
         if caller == 'initial_recommendation':
-            self.extract_pins(row, row_id)
-            self.extract_enrl_history(row, row_id)
+            self.extract_environment(row, row_id)
         elif caller == 'get_course_info' or \
              (caller == 'index' and action == 'show_index_page'):
             self.handle_select_course(row, row_id)
@@ -469,6 +1131,10 @@ class ActivityLogCleaner(object):
                 )
         else:
             activity_tuple = row
+        if self.compact_schema:
+            # Includes the location:
+            self.buffer(self.activity_buf, self.compact_activity(activity_tuple))
+            return
             
         self.buffer(self.activity_buf, activity_tuple)
         # Fill a row in the IpLocation table
@@ -476,6 +1142,162 @@ class ActivityLogCleaner(object):
                                         default=self.DEFAULT_IPLOC_TUPLE)
         self.buffer(self.ip_location_buf, (row_id,) + ip_loc_tuple)
 
+    #------------------------------------
+    # compact_activity
+    #-------------------
+    
+    def compact_activity(self, activity_tuple):
+        '''
+        Turn an Activities row into an ActivitiesCompact
+        row: the student hash is replaced by its id in the
+        Students table, the caller and action by their
+        id in the Actions table, and the times by epoch
+        seconds. Times that are not datetimes become None.
+        The id of the IP address's location is added.
+        
+        :param activity_tuple: (row_id, student, ip_addr, 
+            caller, action, created_at, updated_at)
+        :type activity_tuple: tuple
+        :return: (row_id, student_id, ip_addr, location_id,
+            action_id, created_at, updated_at)
+        :rtype: tuple
+        '''
+        row_id, student, ip_addr, caller, action, created_at, updated_at = activity_tuple
+        created_secs = self.epoch_secs(created_at)
+        # Most rows are never updated:
+        if updated_at == created_at:
+            updated_secs = created_secs
+        else:
+            updated_secs = self.epoch_secs(updated_at)
+        return (row_id,
+                self.dimension_id(self.students, (student,)),
+                ip_addr,
+                self.location_id(ip_addr),
+                self.dimension_id(self.actions, (caller, action)),
+                created_secs,
+                updated_secs)
+
+    #------------------------------------
+    # location_id
+    #-------------------
+    
+    def location_id(self, ip_addr):
+        '''
+        Return the id of the given IP address's
+        location in the Locations table.
+        
+        :param ip_addr: IP address, like '171.64.75.72'
+        :type ip_addr: str
+        :rtype: int
+        '''
+        ip_loc_tuple = self.ip_dict.get(ip_addr, default=self.DEFAULT_IPLOC_TUPLE)
+        try:
+            return self.location_ids[ip_loc_tuple]
+        except KeyError:
+            key = tuple(None if val is None else str(val) for val in ip_loc_tuple)
+            location_id = self.dimension_id(self.locations, key)
+            self.location_ids[ip_loc_tuple] = location_id
+            return location_id
+
+    #------------------------------------
+    # dimension_id
+    #-------------------
+    
+    def dimension_id(self, dim, key):
+        '''
+        Return the id of key in the given DimensionTable.
+        Keys seen for the first time are given an id, and
+        buffered for the dimension's lookup table.
+        
+        :param dim: one of the keys of self.dimension_bufs
+        :type dim: DimensionTable
+        :param key: one value per key column of dim
+        :type key: tuple
+        :rtype: int
+        '''
+        try:
+            return dim.ids[key]
+        except KeyError:
+            if not self.assigns_dimension_ids:
+                raise RuntimeError(f"No id for {key} in {dim.table}; the parent process assigns them")
+            dim_id = dim.add(key)
+            self.buffer(self.dimension_bufs[dim], (dim_id,) + key)
+            if self.new_dimension_ids is not None:
+                self.new_dimension_ids.append((dim.table, key, dim_id))
+            return dim_id
+
+    #------------------------------------
+    # assign_dimension_ids
+    #-------------------
+    
+    def assign_dimension_ids(self, row):
+        '''
+        Give the student, location, and caller/action pair
+        of a log row their lookup table ids, unless they have
+        ids already. Called for each row as it is read, before
+        it is dispatched, by the serial ingest and by the parent
+        of a parallel one. Both therefore assign the same ids.
+        
+        :param row: row of the activity log
+        :type row: [str]
+        '''
+        # In the order of compact_activity():
+        self.dimension_id(self.students, (row[EMPLID_POS],))
+        self.location_id(row[IP_ADDRESS_POS])
+        self.dimension_id(self.actions, (row[CALLER_POS], row[ACTION_POS]))
+
+    #------------------------------------
+    # add_dimension_ids
+    #-------------------
+    
+    def add_dimension_ids(self, new_ids):
+        '''
+        Take over lookup table ids that the parent of
+        a parallel ingest assigned.
+        
+        :param new_ids: (table, key, id) for each new id
+        :type new_ids: [(str, tuple, int)]
+        '''
+        dims = {dim.table : dim for dim in self.dimension_bufs.keys()}
+        for table, key, dim_id in new_ids:
+            dims[table].ids[key] = dim_id
+
+    #------------------------------------
+    # epoch_secs
+    #-------------------
+    
+    def epoch_secs(self, log_time):
+        '''
+        Like log_time_secs(), but returns None for
+        values that are not datetimes, like 'NULL'.
+        
+        :rtype: {None | int}
+        '''
+        try:
+            return self.log_time_secs(log_time)
+        except (ValueError, TypeError):
+            return None
+
+    #------------------------------------
+    # extract_environment
+    #-------------------
+    
+    def extract_environment(self, row, row_id):
+        '''
+        Extract both the 'currently-pinned' strm and crs_id nums,
+        and the enrollment history from the ENVIRONMENT field,
+        scanning the field only once. See extract_pins() and
+        extract_enrl_history() for the formats.
+        
+        :param row:
+        :type row:
+        :param row_id:
+        :type row_id:
+        '''
+        pins, enrl_hist = self.env_scanner.scan(row[ENVIRONMENT_POS])
+        self._buffer_context_pins(row_id, pins)
+        self._buffer_enrl_history(row_id, enrl_hist)
+
     #------------------------------------
     # extract_pins
     #-------------------
@@ -497,114 +1319,61 @@ class ActivityLogCleaner(object):
                                        DESCRIPTION: "Operating Systems and Systems Programming">,
                                        ...
                                     ] 
-        we try both for each row (sigh...)
+        The early variety is tried first. Either way, a 
+        triplet is buffered for each pin:
         
-        For the later variety we go in two steps: get
-        the above-shown list out of the row. Then pick
-        out STRM and CRSE_ID. 
+               (row_id, strm, crs_id)
         
         :param row:
         :type row:
         :param row_id:
         :type row_id:
         '''
-
-        # Avoid creating new strings from the row
-        mv = memoryview(bytes(row[ENVIRONMENT_POS], 'utf8'))
-        
-        match_early_var = self.context_pinned_early_var_pat.search(mv)
-        if match_early_var is not None:
-            self._clean_pins(row_id, match_early_var, 'early_var_res')
-            return
-        # Try the late variety:
-        match_late_var = self.context_pinned_late_var_phase1_pat.search(mv)
-        if match_late_var is not None:
-            self._clean_pins(row_id, match_late_var, 'late_var_res')
-        return
+        self._buffer_context_pins(row_id, self.env_scanner.pins(row[ENVIRONMENT_POS]))
 
     #------------------------------------
-    # _clean_pins
+    # _buffer_context_pins
     #-------------------
 
-    def _clean_pins(self, row_id, match_obj, match_type):
+    def _buffer_context_pins(self, row_id, pins):
         '''
-        Called when pins were provided as part of an activity. 
-        The match type is either 'early_var_res' or 'late_var_res'.
-        Early varieties look like:
-        
-            b'1156:208582, 1162:120904, ...'
+        Buffer a (row_id, strm, crs_id) triplet for 
+        each of the given (strm, crs_id) pairs.
+        '''
+        for strm, crs_id in pins:
+            self.buffer(self.pins_in_context_buf, (row_id, strm, crs_id))
+
+    #------------------------------------
+    # extract_enrl_history
+    #-------------------
+    
+    def extract_enrl_history(self, row, row_id):
+        '''
+        Extract the enrollment history. Early variety:
         
-        while late varieties look like:
+            ...course_history_ids:[102794, 105644, 105645, 105649]...
         
-            [#<Enrollment STRM: 1214, CLASS_NBR: 25600, CRSE_ID: 204608, 
-                CATALOG_NBR: "151", SUBJECT: "ARCHLGY", 
-                DESCRIPTION: "Ten Things: An Archaeology of Design ...">, 
-             #<Enrollment STRM: 1214, CLASS_NBR: 18259, CRSE_ID: 105670, 
-                CATALOG_NBR: "140", SUBJECT: "CS", 
-                DESCRIPTION: "Operating Systems and Systems Programming">,
-                ...
-             ]
+        Later variety:
         
-        Either way, we create a triplet for each pin:
+            ..."registered_courses"=>[#<Enrollment STRM: nil, ... CRSE_ID: 156872, ...>, 
+                                      #<Enrollment...>]
         
-               (row_id, strm, crs_id)
-
-        The match object is known to be non-None, and group(1) will
-        contain the finding:
+        A (row_id, crs_id) pair is buffered for each course.
         
+        :param row:
+        :type row:
         :param row_id:
         :type row_id:
-        :param match_obj:
-        :type match_obj:
-        :param match_type:
-        :type match_type:
-        '''
-        if match_type == 'early_var_res':
-            for strm_crs_id_pair in match_obj.group(1).split(b','):
-                if len(strm_crs_id_pair) > 0:
-                    try:
-                        strm, crs_id = strm_crs_id_pair.split(b':')
-                    except ValueError as _e:
-                        self.log.err(f"Could not split strm from crs_id in {match_obj.group(1)}") 
-                    self.buffer(self.pins_in_context_buf, (row_id, int(strm), int(crs_id)))
-            return
-        else:
-            # Must proceed in two steps. First, pick out
-            # all the STRM and CRSE_ID number pairs:
-
-            # Get: 
-            #   [(b'1214', b'204608'), (b'1214', b'105670'), (b'1214', b'105687'), ...]
-            res_list = self.context_pinned_late_var_phase2_pat.findall(match_obj.group(1))
-            if res_list is None:
-                return
-            # Create the triplets, and buffer them:
-            for strm, crs_id in res_list:
-                self.buffer(self.pins_in_context_buf, (row_id, int(strm), int(crs_id)))
+        '''
+        self._buffer_enrl_history(row_id, self.env_scanner.enrollment_history(row[ENVIRONMENT_POS]))
 
     #------------------------------------
-    # extract_enrl_history
+    # _buffer_enrl_history
     #-------------------
-    
-    def extract_enrl_history(self, row, row_id):
-        
-        mv = memoryview(bytes(row[ENVIRONMENT_POS], 'utf8'))
-        # Try the early-version log format:
-        
-        crs_id_match = self.context_enrl_hist_early_pat.search(mv)
-        if crs_id_match is not None:
-            self.buffer_int_arr(self.enrl_hist_buf, row_id, crs_id_match.group(1))
-            
-        else:
-            # Try later form:
-            crs_id_envs_match = self.context_enrl_hist_late_phase1_pat.search(mv)
-            if crs_id_envs_match is None:
-                return
-            # Pick the CRSE_ID nums out of the environment objs.
-            # Result will be [b'123456', b'789012, ...]
-            crse_id_arr_of_bstrings = self.context_enrl_hist_late_phase2_pat.findall(crs_id_envs_match.group(1))
-            int_arr = [int(el) for el in crse_id_arr_of_bstrings]
-            self.buffer_int_arr(self.enrl_hist_buf, row_id, int_arr)
 
+    def _buffer_enrl_history(self, row_id, enrl_hist):
+        if enrl_hist is not None:
+            self.buffer_int_arr(self.enrl_hist_buf, row_id, enrl_hist)
 
     #------------------------------------
     # extract_course_select
@@ -670,6 +1439,7 @@ class ActivityLogCleaner(object):
         
         try:
             self.crs_search_states[emplid]['search_term_accumulator'] = search_term_so_far
+            self.crs_search_states[emplid]['last_seen'] = row[-2]
             if cur_return_output != 'NULL':
                 self.crs_search_states[emplid]['output'] = cur_return_output
         except KeyError:
@@ -697,9 +1467,124 @@ class ActivityLogCleaner(object):
                                         	 'action' : row[ACTION_POS],
                                         	 'created_at' : row[-2],
                                         	 'updated_at' : row[-1],
+                                             'last_seen' : row[-2],
                                              'search_term_accumulator' : search_term_so_far,
                                              'output' : cur_return_output
                                             }
+            self._push_search(emplid, self.crs_search_states[emplid])
+
+    #------------------------------------
+    # expire_searches
+    #-------------------
+    
+    def expire_searches(self, cur_log_time):
+        '''
+        Commit the pending searches whose last keystroke was
+        at least self.search_timeout seconds before cur_log_time.
+        Each costs O(log n) in the number of pending searches.
+        
+        :param cur_log_time: created_at of the row being processed
+        :type cur_log_time: str
+        '''
+        try:
+            cur_secs = self.log_time_secs(cur_log_time)
+        except ValueError:
+            return
+        heap = self.search_heap
+        while len(heap) > 0 and heap[0][0] + self.search_timeout <= cur_secs:
+            seen_secs, row_id, emplid = heapq.heappop(heap)
+            try:
+                search_state = self.crs_search_states[emplid]
+            except KeyError:
+                continue
+            # A later search of the same visitor?
+            if search_state['row_id'] != row_id:
+                continue
+            last_seen_secs = self._last_seen_secs(search_state, seen_secs)
+            if last_seen_secs > seen_secs:
+                # Typed since the entry was pushed:
+                heapq.heappush(heap, (last_seen_secs, row_id, emplid))
+            else:
+                self.commit_search_action(emplid)
+        self._set_search_deadline()
+
+    #------------------------------------
+    # rebuild_search_heap
+    #-------------------
+    
+    def rebuild_search_heap(self):
+        '''
+        Recreate the search heap from crs_search_states,
+        after those were replaced, like when resuming from
+        a checkpoint.
+        '''
+        self.search_heap = []
+        for emplid, search_state in self.crs_search_states.items():
+            self._push_search(emplid, search_state)
+
+    #------------------------------------
+    # log_time_secs
+    #-------------------
+    
+    def log_time_secs(self, log_time):
+        '''
+        Convert a created_at value, like '2015-10-24 07:59:37',
+        into seconds. Raises ValueError for other strings.
+        
+        :rtype: int
+        '''
+        return (datetime.datetime.fromisoformat(log_time) - self.LOG_EPOCH) // self.ONE_SEC
+
+    #------------------------------------
+    # _push_search
+    #-------------------
+    
+    def _push_search(self, emplid, search_state):
+        '''
+        Add a new pending search to the heap, unless
+        timeouts are off, or its time is unusable.
+        '''
+        if self.search_timeout <= 0:
+            return
+        seen_secs = self._last_seen_secs(search_state)
+        if seen_secs is None:
+            return
+        heapq.heappush(self.search_heap, (seen_secs, search_state['row_id'], emplid))
+        self._set_search_deadline()
+
+    #------------------------------------
+    # _last_seen_secs
+    #-------------------
+    
+    def _last_seen_secs(self, search_state, default=None):
+        '''
+        Return the log time of a search's latest keystroke
+        in seconds. Searches in checkpoints of earlier
+        versions have only their created_at. If neither
+        is a time, default is returned.
+        
+        :rtype: {None | int}
+        '''
+        for time_key in ('last_seen', 'created_at'):
+            try:
+                return self.log_time_secs(search_state[time_key])
+            except (KeyError, ValueError):
+                pass
+        return default
+
+    #------------------------------------
+    # _set_search_deadline
+    #-------------------
+    
+    def _set_search_deadline(self):
+        if len(self.crs_search_states) == 0:
+            # Only entries of committed searches are left:
+            self.search_heap = []
+        if len(self.search_heap) == 0:
+            self.search_deadline = self.NO_SEARCH_DEADLINE
+        else:
+            deadline = self.LOG_EPOCH + datetime.timedelta(seconds=self.search_heap[0][0] + self.search_timeout)
+            self.search_deadline = deadline.isoformat(' ')
 
 
     #------------------------------------
@@ -729,20 +1614,19 @@ class ActivityLogCleaner(object):
         if self.crs_search_states is None or len(self.crs_search_states) == 0:
             return
          
-        cur_log_time_obj = datetime.datetime.strptime(cur_log_time, '%Y-%m-%d %H:%M:%S')
         if time_threshold is not None:
-            time_threshold_obj = datetime.timedelta(seconds=time_threshold)
+            cur_log_secs = self.log_time_secs(cur_log_time)
         
         # Make a copy, b/c commit_search_action() will
         # delete entries from the original:
         for emplid, search_state in self.crs_search_states.copy().items():
-            search_start = search_state['created_at']
             if time_threshold is not None:
-                search_start_obj = datetime.datetime.strptime(search_start, '%Y-%m-%d %H:%M:%S')
-                if cur_log_time_obj - search_start_obj >= time_threshold_obj:
+                last_seen_secs = self._last_seen_secs(search_state, cur_log_secs)
+                if cur_log_secs - last_seen_secs >= time_threshold:
                     self.commit_search_action(emplid)
             else:
                 self.commit_search_action(emplid)
+        self._set_search_deadline()
 
     #------------------------------------
     # commit_search_action
@@ -873,6 +1757,28 @@ class ActivityLogCleaner(object):
 
 # --------------------- Utilities ------------
 
+    #------------------------------------
+    # _new_buffer
+    #-------------------
+    
+    def _new_buffer(self, name, capacity, typecodes):
+        '''
+        Return a BufferClass, or if self.columnar_buffers
+        is True, a ColumnarBuffer with the given column
+        typecodes.
+        
+        :param typecodes: 'q' for each int column, None for
+            all others
+        :type typecodes: ({None | str})
+        '''
+        if self.columnar_buffers:
+            buf = ColumnarBuffer(name, capacity, typecodes)
+        else:
+            buf = BufferClass(name, capacity)
+        self.buffer_typecodes[buf] = typecodes
+        return buf
+
+
     #------------------------------------
     # buffer
     #-------------------
@@ -881,7 +1787,9 @@ class ActivityLogCleaner(object):
         '''
         Append content to buffer. When buffer is
         full as per DB_BATCH_SIZE_BIG, all buffers are
-        written to the database, and are emptied.
+        written to the database, and are emptied. With
+        a flush_coordinator, it decides which buffers 
+        are written.
         
         Example content:
         
@@ -899,7 +1807,10 @@ class ActivityLogCleaner(object):
         '''
         
         buf.append(content)
-        if buf.full():
+        if self.flush_coordinator is not None:
+            for buf_to_flush in self.flush_coordinator.added(buf, content):
+                self.flush_buffer(buf_to_flush)
+        elif buf.full():
             self.flush_buffer(buf)
 
     #------------------------------------
@@ -925,16 +1836,19 @@ class ActivityLogCleaner(object):
         :type buf:
         :param row_id,
         :type row_id,
-        :param simple_arr: bin string containing a list of ints,
+        :param simple_arr: (bin) string containing a list of ints,
             or a list of ints
-        :type simple_arr: {b[int] | [int]}
+        :type simple_arr: {b[int] | str | [int]}
         '''
 
         # Turn the bin str into an array of int.
         #    b'[102794, 105644, 105645, 105649]'
-        # => [102794, 105644, 105645, 105649]
-        if type(simple_arr) == bytes:
-            int_arr = eval(simple_arr)
+        # => array('q', [102794, 105644, 105645, 105649])
+        # Malformed lists are counted by the parser:
+        if type(simple_arr) in (bytes, str):
+            int_arr = self.int_parser.parse(simple_arr)
+            if int_arr is None:
+                return
         else:
             int_arr = simple_arr
 
@@ -943,8 +1857,11 @@ class ActivityLogCleaner(object):
         # buffer:
 
         if len(int_arr) > 0:
-            buf.extend(list(map(lambda arr_el: (row_id, arr_el), int_arr)))
-        if buf.full():
+            buf.extend_pairs(row_id, int_arr)
+        if self.flush_coordinator is not None:
+            for buf_to_flush in self.flush_coordinator.added_pairs(buf, len(int_arr)):
+                self.flush_buffer(buf_to_flush)
+        elif buf.full():
             self.flush_buffer(buf)
 
     #------------------------------------
@@ -954,129 +1871,236 @@ class ActivityLogCleaner(object):
     def open_db(self, uname=None, db_name=None, pwd=None, start_fresh=False):
         #print("SkIPPING DB")
         #return
-        if pwd is None:
-            try:
-                pwd_file = os.path.join(os.getenv('HOME'), '.ssh/mysql')
-                with open(pwd_file, 'r') as fd:
-                    pwd = fd.read().strip()
-            except Exception as e:
-                raise PermissionError(f"Cannot read MySQL pwd from {pwd_file}: {repr(e)}")
-
-        if uname is None:
-            uname = getpass.getuser()
-        if db_name is None:
-            db_name = self.DB_NAME
-
-        try:
-            db = MySQLDB(user=uname, passwd=pwd, db=db_name) 
-        except Exception as e:
-            raise RuntimeError(f"Cannot access db for user {uname} db {self.DB_NAME}: {repr(e)}")
+        db = self.connect_db(uname=uname, db_name=db_name, pwd=pwd)
 
         self.db = db
 
         # Check whether Activities table exists, and 
         # warn about wiping out all tables:
-        res_iter = db.query('''SELECT COUNT(*)
-                          FROM information_schema.tables 
-                          WHERE table_schema = DATABASE()
-                          AND table_name = "Activities";
-                          )
-                          ''')
-        activity_tbl_exists = next(res_iter)
-        try:
-            # Terminate the query iterator
-            # WTF is going on? Should not be needed,
-            # but otherwise bogus MySQL programming error
-            # on next query:
-            next(res_iter)
-        except Exception:
-            pass
-            
-        if activity_tbl_exists:
+        if db.table_exists('Activities'):
             response = input("Tables already exist, wipe them? (y/n): ")
             if response in ('y', 'Y'):
                 self.start_fresh = True
             else:
-                # Find last entry in activity log:
-                last_row_id = next(db.query("SELECT MAX(row_id) from activities"))
-                self.start_fresh = last_row_id
+                checkpoint_path = IngestCheckpoint.path_for(self.activity_log_path)
+                checkpoint = IngestCheckpoint.load(checkpoint_path)
+                if checkpoint is None or not checkpoint.matches(self.activity_log_path):
+                    # The tables' buffers are flushed at different
+                    # times, so no row id tells how far all of them
+                    # got:
+                    raise RuntimeError(f"No checkpoint of {self.activity_log_path} to resume from; "
+                                       f"rerun, and have the tables wiped")
+                self.start_fresh = checkpoint
         else:
             self.start_fresh = False
 
         # Test whether all necessary tables exist:
         for tbl_nm, _cols in self.buffer_tables.values():
-            res = next(db.query(f'''SELECT COUNT(*)
-                                FROM information_schema.tables 
-                               WHERE table_schema = "{self.DB_NAME}"
-                                 AND table_name = "{tbl_nm}";'''
-            ))
-            if res == 0:
+            if not db.table_exists(tbl_nm):
                 self.create_tbl(tbl_nm)
 
             # Truncate table if starting over:
             if self.start_fresh == True:
-                db.truncateTable(tbl_nm)
+                db.truncate_table(tbl_nm)
+
+        if self.compact_schema:
+            self.create_views()
 
-        # No truncated, overlong search terms yet:
-        self.truncated_search_terms = 0
+        if self.start_fresh == True:
+            IngestCheckpoint.remove(IngestCheckpoint.path_for(self.activity_log_path))
+        else:
+            # Continue with the ids of the earlier ingest:
+            self.load_dimensions()
+            if isinstance(self.start_fresh, IngestCheckpoint):
+                self.restore_checkpoint(self.start_fresh)
+
+        # Batches must fit into the server's packets:
+        if self.flush_coordinator is not None:
+            max_packet = db.max_packet_bytes()
+            if max_packet is not None:
+                self.flush_coordinator.max_packet_bytes = max_packet
+
+        # Extracted rows go into the db:
+        self.sink = self.make_db_sink(db)
 
         return db
 
+    #------------------------------------
+    # restore_checkpoint
+    #-------------------
+    
+    def restore_checkpoint(self, checkpoint):
+        '''
+        Return the db and the pending searches to the
+        state of the given checkpoint: rows written after
+        the checkpoint was taken are deleted, as are the 
+        CrseSearches rows of searches that were still 
+        pending then. Those searches are restored into
+        crs_search_states, and are completed by the rows
+        that follow the checkpoint.
+        
+        :param checkpoint: the checkpoint to resume from
+        :type checkpoint: IngestCheckpoint
+        '''
+        last_row_id = 0 if checkpoint.last_row_id is None else checkpoint.last_row_id
+        for buf, (tbl_nm, _cols) in self.buffer_tables.items():
+            # Lookup table rows written after the checkpoint
+            # are kept; they are loaded with the others:
+            if buf in self.dimension_bufs.values():
+                continue
+            self.db.execute(f"DELETE FROM {tbl_nm} WHERE row_id > {last_row_id}")
+        pending_row_ids = checkpoint.pending_search_row_ids()
+        if len(pending_row_ids) > 0:
+            id_list = ','.join(str(row_id) for row_id in pending_row_ids)
+            self.db.execute(f"DELETE FROM CrseSearches WHERE row_id IN ({id_list})")
+        self.crs_search_states = copy.deepcopy(checkpoint.search_states)
+        self.rebuild_search_heap()
+        self.cur_id = checkpoint.last_row_id
+        self.log.info(f"Resuming after row {last_row_id}, at offset {checkpoint.offset}, "
+                      f"with {len(self.crs_search_states)} pending searches")
+
+    #------------------------------------
+    # load_dimensions
+    #-------------------
+    
+    def load_dimensions(self):
+        '''
+        Fill the DimensionTables of the compact schema
+        from their lookup tables, so that a resumed ingest
+        keeps the ids that were assigned before.
+        '''
+        for dim in self.dimension_bufs.keys():
+            dim.load(self.db.query(f"SELECT {', '.join(dim.col_names)} FROM {dim.table} ORDER BY {dim.id_col}"))
+            self.log.info(f"Loaded {len(dim)} entries of {dim.table}")
+
+    #------------------------------------
+    # make_db_sink
+    #-------------------
+    
+    def make_db_sink(self, db):
+        '''
+        Return the sink through which flush_buffer()
+        writes to the given db connection.
+        
+        :param db: open connection
+        :type db: DbBackend
+        :return: sink for writing buffers to the db
+        :rtype: {DbTableSink | LoadDataTableSink | AsyncTableSink}
+        '''
+        if self.bulk_load:
+            # Worker connections need the bulk settings too; 
+            # the main connection already has them:
+            if db is not self.db:
+                self.bulk_session.apply_session_settings(db)
+        if self.load_data:
+            sink = LoadDataTableSink(db)
+        else:
+            sink = DbTableSink(db)
+        if self.async_writer:
+            sink = AsyncTableSink(sink)
+        if self.flush_coordinator is not None:
+            sink.latency_observer = self.flush_coordinator.record_flush
+        return sink
+
+    #------------------------------------
+    # make_parquet_sink
+    #-------------------
+    
+    def make_parquet_sink(self, part_prefix=''):
+        '''
+        Return the sink through which flush_buffer()
+        writes Parquet files below self.parquet_dir.
+        
+        :param part_prefix: distinguishes the part files
+            of the workers of a parallel export
+        :type part_prefix: str
+        :return: sink for writing buffers to Parquet files
+        :rtype: {ParquetTableSink | AsyncTableSink}
+        '''
+        sink = ParquetTableSink(self.parquet_dir, part_prefix=part_prefix)
+        if self.async_writer:
+            sink = AsyncTableSink(sink)
+        if self.flush_coordinator is not None:
+            sink.latency_observer = self.flush_coordinator.record_flush
+        return sink
+
+    #------------------------------------
+    # connect_db
+    #-------------------
+
+    def connect_db(self, uname=None, db_name=None, pwd=None):
+        '''
+        Return a new connection to the db, without
+        checking or creating any tables. Used by open_db(),
+        and by worker processes that need their own 
+        connection. With a sqlite_path, the arguments are
+        ignored, and the SQLite file is opened.
+        
+        :param uname: MySQL user; default: current user
+        :type uname: {None | str}
+        :param db_name: database to use; default: self.DB_NAME
+        :type db_name: {None | str}
+        :param pwd: MySQL password; default: content of ~/.ssh/mysql
+        :type pwd: {None | str}
+        :return: connection
+        :rtype: {MySqlBackend | SqliteBackend}
+        '''
+        if self.sqlite_path is not None:
+            return SqliteBackend(self.sqlite_path)
+
+        if pwd is None:
+            try:
+                pwd_file = os.path.join(os.getenv('HOME'), '.ssh/mysql')
+                with open(pwd_file, 'r') as fd:
+                    pwd = fd.read().strip()
+            except Exception as e:
+                raise PermissionError(f"Cannot read MySQL pwd from {pwd_file}: {repr(e)}")
+
+        if uname is None:
+            uname = getpass.getuser()
+        if db_name is None:
+            db_name = self.DB_NAME
+
+        try:
+            db = MySQLDB(user=uname, passwd=pwd, db=db_name) 
+        except Exception as e:
+            raise RuntimeError(f"Cannot access db for user {uname} db {self.DB_NAME}: {repr(e)}")
+
+        return MySqlBackend(db, db_name)
+
     #------------------------------------
     # create_tbl
     #-------------------
     
     def create_tbl(self, tbl_nm):
+        '''
+        Create the given table as in TABLE_SCHEMAS.
+        '''
+        col_specs, primary_key = self.TABLE_SCHEMAS[tbl_nm]
+        self.db.create_table(tbl_nm, col_specs, primary_key=primary_key)
 
-        if tbl_nm in ['Pins', 'UnPins', 'CrseSelects', 'EnrollmentHist']:
-            self.db.createTable(tbl_nm, {'row_id': 'int',
-                                         'crs_id' : 'int'
-                                         })
-        elif tbl_nm == 'ContextPins':
-            self.db.createTable(tbl_nm, {'row_id': 'int',
-                                         'quarter_id' : 'int',
-                                         'crs_id' : 'int'
-                                         })
-        elif tbl_nm == 'CrseSearches':
-            self.db.createTable(tbl_nm, {'row_id': 'int',
-                                         'search_term' : f'varchar({self.MAX_SEARCH_TERM_LEN})',
-                                         'crs_res' : 'text', 
-                                         'instructor_res' : 'text'
-                                         })
-
-        elif tbl_nm == 'Activities':
-            self.db.execute('''CREATE TABLE Activities (
-                            row_id     int NOT NULL,
-                            student    varchar(100),
-                            ip_addr    varchar(16),
-                            category   varchar(30),
-                            action_nm  varchar(30),
-                            created_at datetime,
-                            updated_at datetime,
-                            PRIMARY KEY(row_id)
-                            ) engine=MyISAM
-                            '''
-            )
-            
-        elif tbl_nm == 'InstructorLookups':
-            self.db.createTable(tbl_nm, {'row_id': 'int',
-                                         'instructor' : 'varchar(40)'
-                                         })
-            
-        elif tbl_nm == 'IpLocation':
-            self.db.createTable(tbl_nm, {'row_id' : 'int',
-                                         'country_code' : 'varchar(2)',
-                                         'country' : 'varchar(60)',
-                                         'state' : 'varchar(100)',
-                                         'city' : 'varchar(100)',
-                                         'lat' : 'varchar(40)',
-                                         'longitude' : 'varchar(40)',
-                                         'zip' : 'varchar(20)', 
-                                         'time_zone' : 'varchar(10)',
-                                         'country_phone' : 'varchar(5)', 
-                                         'area_code' : 'varchar(40)'})
-        # I prefer MyISAM engine:
-        self.db.execute(f"ALTER TABLE {tbl_nm} engine=MyISAM;")
+    #------------------------------------
+    # create_views
+    #-------------------
+    
+    def create_views(self):
+        '''
+        Create or update the views of the compact schema.
+        A table of a view's name, left by an ingest without
+        the compact schema, is dropped if all tables are being
+        wiped anyway; else the two schemas cannot be mixed.
+        
+        :raise RuntimeError: if a table is in the way of a view
+        '''
+        times = {'created_at' : self.db.epoch_to_datetime('act.created_at'),
+                 'updated_at' : self.db.epoch_to_datetime('act.updated_at')}
+        for view_nm, view_query in self.COMPACT_VIEWS.items():
+            if self.db.table_type(view_nm) == 'BASE TABLE':
+                if self.start_fresh != True:
+                    raise RuntimeError(f"Table {view_nm} exists; cannot resume it with the compact schema")
+                self.log.info(f"Replacing table {view_nm} with a view")
+                self.db.drop_table(view_nm)
+            self.db.create_view(view_nm, view_query.format(**times))
 
     #------------------------------------
     # drop_tables
@@ -1089,13 +2113,11 @@ class ActivityLogCleaner(object):
         '''
 
         for tbl_nm, _cols in self.buffer_tables.values():
-            query = f'''SELECT COUNT(*)
-                          FROM information_schema.tables 
-                         WHERE table_schema = "{self.DB_NAME}"
-                           AND table_name = "{tbl_nm}";'''
-            tbl_exists = next(self.db.query(query))
-            if tbl_exists == 1:
-                self.db.dropTable(tbl_nm)
+            if self.db.table_exists(tbl_nm):
+                self.db.drop_table(tbl_nm)
+        if self.compact_schema:
+            for view_nm in self.COMPACT_VIEWS.keys():
+                self.db.drop_view(view_nm)
 
     #------------------------------------
     # _index_if_not_exists
@@ -1120,15 +2142,8 @@ class ActivityLogCleaner(object):
         :type col_nm: str
         '''
         
-        try:
-            _res = next(self.db.query(f'''SELECT * FROM information_schema.statistics 
-                                         WHERE table_schema = "{self.DB_NAME}"
-                                           AND table_name = "{tbl_nm}" 
-                                           AND column_name = "{col_nm}";'''
-            ))
-        except StopIteration:
-            # Doesn't exist yet:
-            self.db.execute(f"CREATE INDEX {idx_nm} ON {tbl_nm}({col_nm});")
+        if not self.db.index_exists(tbl_nm, col_nm):
+            self.db.create_index(idx_nm, tbl_nm, col_nm)
 
     #------------------------------------
     # flush_buffer
@@ -1137,7 +2152,7 @@ class ActivityLogCleaner(object):
     def flush_buffer(self, buf):
         '''
         Empty the given buffer into its appropriate
-        database table, and truncate the buffer.
+        database table via self.sink, and truncate the buffer.
         
         We handle all buffers that are mapped to db
         tables in self.buffer_tables. The data in the buffers
@@ -1153,23 +2168,11 @@ class ActivityLogCleaner(object):
         '''
 
         dest_tbl, col_names = self.buffer_tables[buf]
-        # Try to write, create the table if needed:
-        (errs, warns) = self.db.bulkInsert(dest_tbl, col_names, buf)
-        
-        if errs is not None:
-            self.log.err(f"Errors insert into tbl {dest_tbl}: {errs}")
-        if warns is not None:
-            # Filter out the overlong search terms:
-            for warn in warns:
-                if warn[2].find("Data truncated for column 'search_term'") > -1:
-                    self.truncated_search_terms += 1
-                    print(f"Search terms truncated: {self.truncated_search_terms}")
-                else:
-                    self.log.warn(f"Warnings insert into tbl {dest_tbl}: {warns}")
-
-            self.log.warn(f"Warnings insert into tbl {dest_tbl}: {warns}")
+        self.sink.write(dest_tbl, col_names, buf.batch())
 
         buf.truncate()
+        if self.flush_coordinator is not None:
+            self.flush_coordinator.flushed(buf)
 
     #------------------------------------
     # is_gzipped
@@ -1259,24 +2262,21 @@ class ActivityLogCleaner(object):
             if len(crs_id_str_list) > 0:
                 # Turn ['123456', '123456'] into 
                 # '[123456, 123456]'
-                crs_ids = str([int(crs_id_str) for crs_id_str in crs_id_str_list])
-                return crs_ids
+                return self.int_parser.format(crs_id_str_list)
 
         # Is it format 3?
         crs_id_list = self.SRC_SIMPLE_RES_LIST_PAT.findall(out_dict_str)
         if len(crs_id_list) > 0:
             # Turn ['123456', '543215'] into
             #    '[123456, 543215]'
-            crs_ids = str([int(crs_id_str) for crs_id_str in crs_id_list])
-            return crs_ids 
+            return self.int_parser.format(crs_id_list)
         
         # Is it format 4?
         combo_list = self.SRC_COMBO_RES_PAT.findall(out_dict_str)
         if len(combo_list) > 0:
             # Replace all the useless combo entries into 
             # a list of crs_id 0, and make a string for storage:
-            crs_ids = str([0]*len(combo_list))
-            return crs_ids
+            return self.int_parser.format_zeros(len(combo_list))
         
         return None
         
@@ -1324,6 +2324,27 @@ class BufferClass:
     def extend(self, elements):
         self.arr.extend(elements)
 
+    #------------------------------------
+    # extend_pairs
+    #-------------------
+    
+    def extend_pairs(self, first, seconds):
+        '''
+        Append a (first, second) tuple for each
+        of seconds.
+        '''
+        self.arr.extend([(first, second) for second in seconds])
+
+    #------------------------------------
+    # batch
+    #-------------------
+    
+    def batch(self):
+        '''
+        Return the buffered rows for a sink.
+        '''
+        return self.arr
+
     #------------------------------------
     # truncate
     #-------------------
@@ -1400,6 +2421,85 @@ if __name__ == '__main__':
                         type=str,
                         help=f'databases user; default {getpass.getuser()}')
 
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        help='number of worker processes for parsing; default: 1',
+                        default=1)
+
+    parser.add_argument('-a', '--asyncwriter',
+                        action='store_true',
+                        help='write to the db in a background thread while parsing; default: False',
+                        default=False)
+
+    parser.add_argument('-l', '--loaddata',
+                        action='store_true',
+                        help='write to the db via LOAD DATA LOCAL INFILE rather than INSERT; default: False',
+                        default=False)
+
+    parser.add_argument('-b', '--bulkload',
+                        action='store_true',
+                        help='disable table keys during the load, and rebuild them afterwards; default: False',
+                        default=False)
+
+    parser.add_argument('-c', '--columnar',
+                        action='store_true',
+                        help='buffer rows in typed column arrays rather than tuples; default: False',
+                        default=False)
+
+    parser.add_argument('-k', '--compact',
+                        action='store_true',
+                        help=('store activities with int student, action, and location ids, and epoch second\n'
+                              'times, behind views of the original Activities and IpLocation; default: False'),
+                        default=False)
+
+    parser.add_argument('-t', '--searchtimeout',
+                        type=int,
+                        help=(f'seconds of log time without typing after which pending searches are committed;\n'
+                              f'0: never, with memory unbounded; default: {ActivityLogCleaner.SEARCH_SESSION_TIMEOUT}'),
+                        default=None)
+
+    parser.add_argument('-m', '--membudget',
+                        type=int,
+                        help=('megabytes all buffers may hold together; batch sizes then adapt\n'
+                              'to insert latencies and max_allowed_packet; default: fixed batch sizes'),
+                        default=None)
+
+    parser.add_argument('--ipcache',
+                        type=str,
+                        help='file in which IP locations are cached across runs; default: no file',
+                        default=None)
+
+    parser.add_argument('--parquet',
+                        type=str,
+                        help=('directory into which to export the tables as Parquet files,\n'
+                              'instead of writing them to the db; default: write to the db'),
+                        default=None)
+
+    parser.add_argument('--sqlite',
+                        type=str,
+                        help='SQLite file to write the tables into, instead of MySQL; default: MySQL',
+                        default=None)
+
+    parser.add_argument('--fromrow',
+                        type=int,
+                        help='id of the first row to ingest; default: first row of the log',
+                        default=None)
+
+    parser.add_argument('--torow',
+                        type=int,
+                        help='id of the last row to ingest; default: last row of the log',
+                        default=None)
+
+    parser.add_argument('--fromdate',
+                        type=str,
+                        help='ingest rows created on or after this date, like 2017-01-01',
+                        default=None)
+
+    parser.add_argument('--todate',
+                        type=str,
+                        help='ingest rows created before this date, like 2018-01-01',
+                        default=None)
+
     parser.add_argument('activity_log_path',
                         type=str,
                         help='Path to activity tsv file; may be gzipped or unzipped')
@@ -1420,11 +2520,34 @@ if __name__ == '__main__':
         pwd = getpass.getpass(prompt=f"Database password for {user}")
     else:
         pwd = None
+
+    row_range = None
+    if args.fromrow is not None or args.torow is not None:
+        row_range = (args.fromrow, args.torow)
+    date_range = None
+    if args.fromdate is not None or args.todate is not None:
+        date_range = (args.fromdate, args.todate)
+    if row_range is not None and date_range is not None:
+        print("Specify a row range or a date range, not both")
+        sys.exit(1)
     
     ActivityLogCleaner(args.activity_log_path,
                        db_user=user,
                        db_pwd=pwd,
-                       start_fresh=True
+                       start_fresh=True,
+                       num_workers=args.workers,
+                       async_writer=args.asyncwriter,
+                       load_data=args.loaddata,
+                       bulk_load=args.bulkload,
+                       columnar_buffers=args.columnar,
+                       memory_budget=None if args.membudget is None else args.membudget * 1024 * 1024,
+                       search_timeout=args.searchtimeout,
+                       compact_schema=args.compact,
+                       ip_cache_path=args.ipcache,
+                       parquet_dir=args.parquet,
+                       sqlite_path=args.sqlite,
+                       row_range=row_range,
+                       date_range=date_range
                        )
     
     #ActivityLogCleaner('/Users/paepcke/Project/Carta/Data/CartaData/ActivityLog/activity_logDec21_2018.csv')
@@ -0,0 +1,888 @@
+'''
+Created on Oct 18, 2026
+
+Micro benchmarks for the hot spots of the activity log
+cleaning. Each benchmark times the current implementation
+against the one it replaced, on synthetic input shaped
+like the log, and checks that both produce the same
+results.
+
+Usage:
+
+    benchmarks.py [--rows N] [benchmark_name ...]
+
+Without names, all benchmarks run.
+'''
+
+from array import array
+import argparse
+import csv
+import gc
+from io import TextIOWrapper
+import os
+import pickle
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+from actlog.activity_log_cleaning import ActivityLogCleaner, BufferClass
+from actlog.columnar import ColumnarBuffer
+from actlog.db_backends import SqliteBackend
+from actlog.env_scanner import EnvironmentScanner
+from actlog.flush_coordinator import FlushCoordinator
+from actlog.int_lists import IntListParser
+from actlog import ipToFullLocation
+from actlog.ipToFullLocation import IpFullLocation
+from actlog.ip_cache import IpLocationCache
+from actlog.ip_table_file import IpRangeColumns, IpTableFile
+from actlog.pipeline import CollectingSink
+
+
+# ------------------------- Sample Data ----------------
+
+#------------------------------------
+# sample_environments
+#-------------------
+
+def sample_environments(num_pins=8, num_enrollments=40, num_recommendations=200):
+    '''
+    Return ENVIRONMENT values of initial_recommendation
+    rows in each era's format, keyed by a short description.
+    The recommendation lists that surround the sections of
+    interest make up most of a real field.
+
+    :rtype: {str : str}
+    '''
+    crs_ids = [100000 + 7 * i for i in range(max(num_pins, num_enrollments, num_recommendations))]
+
+    early_recs = ', '.join(f"#<Combo CRSE_ID: {crs_id}, SCORE: 0.{i:04}>"
+                           for i, crs_id in enumerate(crs_ids[:num_recommendations]))
+    early_pins = ', '.join(f"1156:{crs_id}" for crs_id in crs_ids[:num_pins])
+    early_hist = ', '.join(str(crs_id) for crs_id in crs_ids[:num_enrollments])
+    early = (f"{{controller:pages, action:initial_recommendation, "
+             f"pinned:{{{early_pins}}}, course_history_ids:[{early_hist}], "
+             f"recommendations:[{early_recs}]}}")
+
+    late_recs = ', '.join(f'#<Recommendation CRSE_ID: {crs_id}, SUBJECT: "CS", SCORE: 0.{i:04}>'
+                          for i, crs_id in enumerate(crs_ids[:num_recommendations]))
+    late_pins = ', '.join(f'#<Enrollment STRM: 1214, CLASS_NBR: {20000 + i}, CRSE_ID: {crs_id}, '
+                          f'CATALOG_NBR: "{i}", SUBJECT: "CS", DESCRIPTION: "Course {i}">'
+                          for i, crs_id in enumerate(crs_ids[:num_pins]))
+    late_hist = ', '.join(f'#<Enrollment STRM: nil, CLASS_NBR: nil, CRSE_GRADE_OFF: "A", '
+                          f'CRSE_ID: {crs_id}, CATALOG_NBR: "{i}", SUBJECT: "CS">'
+                          for i, crs_id in enumerate(crs_ids[:num_enrollments]))
+    late = (f'{{"recommendations"=>[{late_recs}], '
+            f'"pinned_courses"=>[{late_pins}], '
+            f'"registered_courses"=>[{late_hist}]}}')
+
+    # Neither pins nor history; the regexes of the
+    # early variety fail only after backtracking:
+    neither = f'{{"recommendations"=>[{late_recs}]}}'
+
+    return {'early (2015-2016)' : early,
+            'late (2017-)' : late,
+            'no sections' : neither}
+
+#------------------------------------
+# sample_activities
+#-------------------
+
+def sample_activities(num_rows, num_students=500, num_ips=2000, num_locations=300):
+    '''
+    Return num_rows log rows that repeat students,
+    caller/action pairs, and IP addresses about as
+    often as the log does, and an ip_dict for them.
+
+    :rtype: ([[str]], SampleIpLocations)
+    '''
+    caller_actions = [('get_course_info', 'view'), ('find_search', 'search'),
+                      ('update_rec', 'pin'), ('update_rec', 'unpin'),
+                      ('get_recommendations', 'index'), ('instructor_profile', 'instructor'),
+                      ('initial_recommendation', 'index'), ('post_feedback', 'feedback')]
+    rows = []
+    for row_id in range(1, num_rows + 1):
+        caller, action = caller_actions[row_id % len(caller_actions)]
+        created_at = f"2017-{1 + row_id % 12:02}-{1 + row_id % 28:02} {row_id % 24:02}:{row_id % 60:02}:00"
+        rows.append([str(row_id),
+                     f"$2b$15$Kk3zHbZyk9q2K4skrd/47OvPtG/KBoE41TftO6xwO{row_id % num_students:014}",
+                     f"171.64.{row_id % num_ips // 256}.{row_id % num_ips % 256}",
+                     caller, action, 'NULL', 'NULL', 'NULL', 'Mozilla',
+                     created_at, created_at])
+    locations = {f"171.64.{ip_idx // 256}.{ip_idx % 256}" : 
+                     ('US', 'United States', 'California', f"City{ip_idx % num_locations}",
+                      37.421262, -122.163949, '94305', '-07:00', '1', '650')
+                 for ip_idx in range(num_ips)}
+    return (rows, SampleIpLocations(locations))
+
+class SampleIpLocations:
+    '''
+    Stands in for IpFullLocation, knowing only
+    the given locations.
+    '''
+    def __init__(self, locations):
+        self.locations = locations
+
+    def get(self, ip_str, default=None):
+        return self.locations.get(ip_str, default)
+
+#------------------------------------
+# sample_ip_table
+#-------------------
+
+def sample_ip_table(num_ranges=200000, num_locations=300, seed=0):
+    '''
+    Return an IpFullLocation over the ranges of
+    sample_ip_ranges(), and the start of each range.
+
+    :rtype: (IpFullLocation, [int])
+    '''
+    ranges = sample_ip_ranges(num_ranges, num_locations, seed)
+    ip_table = IpFullLocation.fromRanges(ranges)
+    return (ip_table, [ip_range[IpFullLocation.START_IP_POS] for ip_range in ranges])
+
+#------------------------------------
+# sample_ip_ranges
+#-------------------
+
+def sample_ip_ranges(num_ranges=200000, num_locations=300, seed=0):
+    '''
+    Return num_ranges range tuples, like those of the IP
+    database, of random sizes, with every tenth range
+    followed by a hole. Each range has its own copies
+    of the strings, as when read from the csv file.
+
+    :rtype: [tuple]
+    '''
+    rng = random.Random(seed)
+    starts = sorted(rng.sample(range(1, 2**32), num_ranges))
+    ranges = []
+    for range_idx, start in enumerate(starts):
+        if range_idx + 1 < len(starts):
+            end = starts[range_idx + 1] - 1
+        else:
+            end = 2**32 - 1
+        if range_idx % 10 == 9:
+            end = (start + end) // 2
+        city_idx = range_idx % num_locations
+        ranges.append((start, end) + tuple(''.join(field) for field in 
+                                           ('US', 'United States', 'California', f"City{city_idx}"))
+                      + (37.0 + city_idx / 1000, -122.0 - city_idx / 1000)
+                      + tuple(''.join(field) for field in ('94305', '-07:00', '1', '650')))
+    return ranges
+
+#------------------------------------
+# ip_str
+#-------------------
+
+def ip_str(ip_int):
+    '''
+    Dotted quad of an int address.
+    '''
+    return f"{ip_int >> 24}.{(ip_int >> 16) & 255}.{(ip_int >> 8) & 255}.{ip_int & 255}"
+
+# ------------------------- ENVIRONMENT Scanning ----------------
+
+# The regular expressions ActivityLogCleaner used before
+# the EnvironmentScanner, applied to the utf8 encoded field:
+LEGACY_PINS_EARLY_PAT = re.compile(b'.*pinned:{([^}]*)}.*')
+LEGACY_PINS_LATE_PHASE1_PAT = re.compile(b'.*pinned_courses"=>\\[([^]]*)].*')
+LEGACY_PINS_LATE_PHASE2_PAT = re.compile(b'STRM: ([0-9]{4}), CLASS_NBR: [^,]*, CRSE_ID: ([0-9]{6})')
+LEGACY_ENRL_HIST_EARLY_PAT = re.compile(b'course_history_ids:([^\\]]*])')
+LEGACY_ENRL_HIST_LATE_PHASE1_PAT = re.compile(b'registered_courses"=>([^\\]]*])')
+LEGACY_ENRL_HIST_LATE_PHASE2_PAT = re.compile(b'CRSE_ID: ([0-9]{6})')
+
+#------------------------------------
+# legacy_scan
+#-------------------
+
+def legacy_scan(environment):
+    '''
+    The former extract_pins() and extract_enrl_history(),
+    minus the buffering, with results shaped like those
+    of EnvironmentScanner.scan().
+    '''
+    # extract_pins():
+    mv = memoryview(bytes(environment, 'utf8'))
+    pins = []
+    match = LEGACY_PINS_EARLY_PAT.search(mv)
+    if match is not None:
+        for strm_crs_id_pair in match.group(1).split(b','):
+            if len(strm_crs_id_pair) > 0:
+                strm, crs_id = strm_crs_id_pair.split(b':')
+                pins.append((int(strm), int(crs_id)))
+    else:
+        match = LEGACY_PINS_LATE_PHASE1_PAT.search(mv)
+        if match is not None:
+            pins = [(int(strm), int(crs_id))
+                    for strm, crs_id in LEGACY_PINS_LATE_PHASE2_PAT.findall(match.group(1))]
+
+    # extract_enrl_history():
+    mv = memoryview(bytes(environment, 'utf8'))
+    match = LEGACY_ENRL_HIST_EARLY_PAT.search(mv)
+    if match is not None:
+        enrl_hist = match.group(1).decode('utf8')
+    else:
+        match = LEGACY_ENRL_HIST_LATE_PHASE1_PAT.search(mv)
+        if match is None:
+            enrl_hist = None
+        else:
+            enrl_hist = [int(crs_id) for crs_id
+                         in LEGACY_ENRL_HIST_LATE_PHASE2_PAT.findall(match.group(1))]
+    return (pins, enrl_hist)
+
+#------------------------------------
+# bench_env_scan
+#-------------------
+
+def bench_env_scan(num_rows):
+    '''
+    Time finding pins and enrollment history in
+    ENVIRONMENT fields of each era.
+    '''
+    scanner = EnvironmentScanner()
+    results = []
+    for era, environment in sample_environments().items():
+        if legacy_scan(environment) != scanner.scan(environment):
+            raise AssertionError(f"Scanner and legacy regexes disagree on '{era}' sample")
+        before = _per_row_secs(lambda: legacy_scan(environment), num_rows)
+        after = _per_row_secs(lambda: scanner.scan(environment), num_rows)
+        results.append((f"{era}, {len(environment)} chars", before, after))
+    return results
+
+# ------------------------- Int Lists ----------------
+
+#------------------------------------
+# bench_int_lists
+#-------------------
+
+def bench_int_lists(num_rows):
+    '''
+    Time turning enrollment history text into ints,
+    eval() against IntListParser.parse(), and formatting
+    search result crs_ids for storage.
+    '''
+    parser = IntListParser()
+    results = []
+    for num_ints in (5, 40, 200):
+        crs_id_strs = [str(100000 + 7 * i) for i in range(num_ints)]
+        list_bytes = bytes('[' + ', '.join(crs_id_strs) + ']', 'utf8')
+        if list(eval(list_bytes)) != list(parser.parse(list_bytes)):
+            raise AssertionError(f"Parser and eval() disagree on {num_ints} ints")
+        before = _per_row_secs(lambda: eval(list_bytes), num_rows)
+        after = _per_row_secs(lambda: parser.parse(list_bytes), num_rows)
+        results.append((f"parse {num_ints} ints", before, after))
+
+        legacy_format = lambda: str([int(crs_id_str) for crs_id_str in crs_id_strs])
+        if legacy_format() != parser.format(crs_id_strs):
+            raise AssertionError(f"Formatting {num_ints} crs_ids differs")
+        before = _per_row_secs(legacy_format, num_rows)
+        after = _per_row_secs(lambda: parser.format(crs_id_strs), num_rows)
+        results.append((f"format {num_ints} crs_ids", before, after))
+    return results
+
+# ------------------------- Buffers ----------------
+
+#------------------------------------
+# bench_buffers
+#-------------------
+
+def bench_buffers(num_rows):
+    '''
+    Fill an enrollment history buffer up to one batch of
+    DB_BATCH_SIZE_BIG rows, 40 courses per log row, as a
+    BufferClass of tuples, and as a ColumnarBuffer. Compares
+    the time per buffered row, the peak memory per buffered
+    row, and the number of garbage collections per batch.
+    num_rows is not used; a batch has a fixed size.
+    '''
+    capacity = ActivityLogCleaner.DB_BATCH_SIZE_BIG
+    crs_ids = array('q', [100000 + 7 * i for i in range(40)])
+
+    def fill_tuples():
+        buf = BufferClass('enrl_hist_buf', capacity)
+        row_id = 0
+        while not buf.full():
+            # The former buffer_int_arr():
+            buf.extend(list(map(lambda arr_el: (row_id, arr_el), crs_ids)))
+            row_id += 1
+        return buf
+
+    def fill_columns():
+        buf = ColumnarBuffer('enrl_hist_buf', capacity, ('q', 'q'))
+        row_id = 0
+        while not buf.full():
+            buf.extend_pairs(row_id, crs_ids)
+            row_id += 1
+        return buf
+
+    if fill_tuples().arr != fill_columns().arr:
+        raise AssertionError("Buffers differ")
+
+    results = []
+    num_buffered = len(fill_tuples().arr)
+    before = min(timeit.repeat(fill_tuples, number=1, repeat=5)) / num_buffered
+    after = min(timeit.repeat(fill_columns, number=1, repeat=5)) / num_buffered
+    results.append((f"fill {num_buffered} rows, per row", before, after, 's'))
+
+    before, before_gcs = _peak_bytes_and_gcs(fill_tuples)
+    after, after_gcs = _peak_bytes_and_gcs(fill_columns)
+    results.append(("peak memory per row", before / num_buffered, after / num_buffered, 'B'))
+    results.append(("garbage collections per batch", before_gcs, after_gcs, ''))
+    return results
+
+# ------------------------- Compact Schema ----------------
+
+#------------------------------------
+# bench_compact_schema
+#-------------------
+
+def bench_compact_schema(num_rows):
+    '''
+    Add num_rows activities with the original schema,
+    and with the compact one. Compares the time per
+    activity, and the bytes sent to the db per activity,
+    as estimated by the FlushCoordinator, with the rows
+    of lookup tables included.
+    '''
+    rows, ip_dict = sample_activities(num_rows)
+
+    def add_activities(compact_schema):
+        cleaner = ActivityLogCleaner(None, compact_schema=compact_schema, unittesting=True)
+        cleaner.ip_dict = ip_dict
+        cleaner.sink = CollectingSink()
+        for row in rows:
+            cleaner.add_activity_record(row)
+        cleaner.flush_all_buffers()
+        return cleaner.sink.batches
+
+    coordinator = FlushCoordinator()
+    results = []
+    before = min(timeit.repeat(lambda: add_activities(False), number=1, repeat=3)) / num_rows
+    after = min(timeit.repeat(lambda: add_activities(True), number=1, repeat=3)) / num_rows
+    results.append(("add activity", before, after))
+
+    before, after = (sum(coordinator.row_bytes(row) for rec_batch in add_activities(compact_schema)
+                         for row in rec_batch.rows) / num_rows
+                     for compact_schema in (False, True))
+    results.append(("bytes per activity", before, after, 'B'))
+    return results
+
+# ------------------------- IP Locations ----------------
+
+#------------------------------------
+# bench_ip_lookup
+#-------------------
+
+def bench_ip_lookup(num_rows):
+    '''
+    Look up num_rows random addresses that are covered by
+    the table, by walking the buckets of ipDict, as lookupIP()
+    did, and by binary search in the sorted range starts.
+    Addresses below 1.0.0.0 are left out; the former lookup
+    gave up on those before reaching the first bucket.
+    '''
+    ranges = sample_ip_ranges()
+    ip_table = IpFullLocation.fromRanges(ranges)
+    ip_dict = legacy_ip_dict(ranges)
+    rng = random.Random(1)
+    ips = []
+    while len(ips) < num_rows:
+        ip = ip_str(rng.randrange(2**24, 2**32))
+        try:
+            ips.append((ip, ip_table.lookupIP(ip)))
+        except KeyError:
+            continue
+    for ip, location in ips:
+        if legacy_lookup(ip_table, ip_dict, ip) != location:
+            raise AssertionError(f"Lookups of {ip} differ")
+
+    before = _per_row_secs(lambda: [legacy_lookup(ip_table, ip_dict, ip) for ip, _location in ips], 1) / num_rows
+    after = _per_row_secs(lambda: [ip_table.lookupIP(ip) for ip, _location in ips], 1) / num_rows
+    return [("lookup of random address", before, after)]
+
+#------------------------------------
+# legacy_lookup
+#-------------------
+
+def legacy_lookup(ip_table, ip_dict, ip_str):
+    '''
+    The former IpFullLocation.lookupIP(), which walks
+    back over the bucket keys of ipDict until it finds
+    a chain, and then scans the chain.
+    '''
+    (ipNum, lookupKey) = ip_table.ipStrToIntAndKey(ip_str)
+    if ipNum is None or lookupKey is None:
+        raise ValueError("IP string is not a valid IP address: '%s'" % str(ip_str))
+    ipRangeChain = ()
+    while int(lookupKey) > 0:
+        try:
+            ipRangeChain = ip_dict[lookupKey]
+            if ipRangeChain[0][0] > ipNum:
+                raise KeyError()
+            break
+        except KeyError:
+            lookupKey = str(int(lookupKey) - 1).zfill(4)[0:4]
+            continue
+    for ipInfo in ipRangeChain:
+        if ipNum > ipInfo[IpFullLocation.END_IP_POS]:
+            continue
+        return ipInfo[IpFullLocation.TWO_LETTER_POS:IpFullLocation.AREA_PHONE_POS + 1]
+    raise KeyError("Ip %s not found in location translator." % ip_str)
+
+#------------------------------------
+# legacy_ip_dict
+#-------------------
+
+def legacy_ip_dict(ranges):
+    '''
+    Bucket range tuples by the first four decimal digits
+    of their start, as IpFullLocation.ipDict does.
+    '''
+    ip_dict = {0 : []}
+    for ip_range in ranges:
+        hash_key = str(ip_range[IpFullLocation.START_IP_POS]).zfill(10)[0:4]
+        ip_dict.setdefault(hash_key, []).append(ip_range)
+    return ip_dict
+
+#------------------------------------
+# bench_ip_cache
+#-------------------
+
+def bench_ip_cache(num_rows):
+    '''
+    Look up num_rows addresses, drawn from 5000 distinct
+    ones, as the activity log repeats its visitors' addresses,
+    with IpFullLocation.get(), and through an IpLocationCache.
+    '''
+    ip_table, starts = sample_ip_table()
+    rng = random.Random(1)
+    distinct_ips = [ip_str(rng.choice(starts) + rng.randrange(16)) for _i in range(5000)]
+    ips = [rng.choice(distinct_ips) for _i in range(num_rows)]
+    ip_cache = IpLocationCache(ip_table)
+    if [ip_table.get(ip) for ip in ips] != [ip_cache.get(ip) for ip in ips]:
+        raise AssertionError("Cached and uncached locations differ")
+
+    def lookup_all(ip_dict):
+        for ip in ips:
+            ip_dict.get(ip)
+
+    before = min(timeit.repeat(lambda: lookup_all(ip_table), number=1, repeat=3)) / num_rows
+    after = min(timeit.repeat(lambda: lookup_all(ip_cache), number=1, repeat=3)) / num_rows
+    return [(f"{num_rows} lookups of 5000 addresses", before, after)]
+
+#------------------------------------
+# bench_ip_batch
+#-------------------
+
+def bench_ip_batch(num_rows):
+    '''
+    Locate num_rows random addresses one by one with
+    IpFullLocation.get(), and all at once with lookup_many()
+    and locations(). The batch is faster with NumPy.
+    '''
+    ip_table, _starts = sample_ip_table()
+    rng = random.Random(1)
+    ips = [ip_str(rng.randrange(2**32)) for _i in range(num_rows)]
+    if [ip_table.get(ip) for ip in ips] != ip_table.locations(ip_table.lookup_many(ips)):
+        raise AssertionError("Batch and single lookups differ")
+
+    before = min(timeit.repeat(lambda: [ip_table.get(ip) for ip in ips], number=1, repeat=3)) / num_rows
+    after = min(timeit.repeat(lambda: ip_table.locations(ip_table.lookup_many(ips)), 
+                              number=1, repeat=3)) / num_rows
+    with_numpy = 'with' if ipToFullLocation.np is not None else 'without'
+    return [(f"{num_rows} addresses, {with_numpy} NumPy", before, after)]
+
+#------------------------------------
+# bench_ip_table_open
+#-------------------
+
+def bench_ip_table_open(num_rows):
+    '''
+    Open an IP table of num_rows ranges by unpickling
+    ipDict, as IpFullLocation() did, and from a binary table
+    file. Reports the time and the memory allocated to open,
+    and the time of single lookups.
+    '''
+    ranges = sample_ip_ranges(num_ranges=num_rows)
+    ip_table = IpFullLocation.fromRanges(ranges)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pickle_path = os.path.join(tmp_dir, 'ipDict.pickle')
+        with open(pickle_path, 'wb') as fd:
+            pickle.dump(legacy_ip_dict(ranges), fd)
+        table_file_path = os.path.join(tmp_dir, IpFullLocation.TABLE_FILE)
+        IpTableFile.write(ip_table.rangeColumns, table_file_path)
+
+        def open_pickle():
+            with open(pickle_path, 'rb') as fd:
+                return pickle.load(fd)
+
+        def open_table_file():
+            return IpFullLocation(table_file_path)
+
+        file_table = open_table_file()
+        rng = random.Random(1)
+        ips = [ip_str(rng.randrange(2**32)) for _i in range(10000)]
+        if [ip_table.get(ip) for ip in ips] != [file_table.get(ip) for ip in ips]:
+            raise AssertionError("Lookups in pickled and binary tables differ")
+
+        results = [(f"open {num_rows} ranges", 
+                    min(timeit.repeat(open_pickle, number=1, repeat=3)),
+                    min(timeit.repeat(open_table_file, number=1, repeat=3))),
+                   (f"memory to open {num_rows} ranges", 
+                    _peak_bytes_and_gcs(open_pickle)[0] / 1024**2,
+                    _peak_bytes_and_gcs(open_table_file)[0] / 1024**2,
+                    'MB'),
+                   ("lookup of random address",
+                    _per_row_secs(lambda: [ip_table.get(ip) for ip in ips], 1) / len(ips),
+                    _per_row_secs(lambda: [file_table.get(ip) for ip in ips], 1) / len(ips))
+                   ]
+        # Release the mapping before the directory goes:
+        del file_table
+        gc.collect()
+    return results
+
+#------------------------------------
+# bench_ip_table_memory
+#-------------------
+
+def bench_ip_table_memory(num_rows):
+    '''
+    Memory held by an IP table of num_rows ranges that
+    was unpickled from ipDict, as range tuples bucketed in
+    ipDict and sorted in a list, as IpFullLocation held them
+    before, and as IpRangeColumns.
+    '''
+    ranges = sample_ip_ranges(num_ranges=num_rows)
+    pickled_ip_dict = pickle.dumps(legacy_ip_dict(ranges))
+    del ranges
+
+    def tuple_table():
+        ip_dict = pickle.loads(pickled_ip_dict)
+        return (ip_dict, sorted((ip_range for chain in ip_dict.values() for ip_range in chain),
+                                key=lambda ip_range: ip_range[IpFullLocation.START_IP_POS]))
+
+    def column_table():
+        ip_dict = pickle.loads(pickled_ip_dict)
+        return IpFullLocation.fromRanges(ip_range for chain in ip_dict.values() for ip_range in chain)
+
+    (ip_dict, sorted_ranges) = tuple_table()
+    ip_table = column_table()
+    rng = random.Random(1)
+    # The former lookup mistook addresses in holes
+    # for those of the next range:
+    ips = [ip for ip in (ip_str(rng.randrange(2**24, 2**32)) for _i in range(10000))
+           if ip_table.get(ip) is not None]
+    if [ip_table.get(ip) for ip in ips] != [legacy_lookup(ip_table, ip_dict, ip) for ip in ips]:
+        raise AssertionError("Lookups in tuples and columns differ")
+    del ip_dict, sorted_ranges, ip_table
+
+    return [(f"bytes held by {num_rows} ranges",
+             _retained_bytes(tuple_table) / 1024**2,
+             _retained_bytes(column_table) / 1024**2,
+             'MB')]
+
+#------------------------------------
+# bench_ip_table_build
+#-------------------
+
+def bench_ip_table_build(num_rows):
+    '''
+    Build an IP table of num_rows ranges from a csv file
+    like the commercial one, all fields quoted: with the
+    csv module, stripping quotes from each field, into the
+    tuples of ipDict, which are then sorted into columns, as
+    IpFullLocation() did, and with IpRangeColumns.from_csv() 
+    in one process, and in one process per core.
+    '''
+    ranges = sample_ip_ranges(num_ranges=num_rows)
+    num_workers = os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, IpFullLocation.XLATION_CSV)
+        with open(csv_path, 'w', newline='') as fd:
+            csv.writer(fd, quoting=csv.QUOTE_ALL, lineterminator='\r\n').writerows(ranges)
+        # Enough chunks for all cores:
+        chunk_bytes = max(64 * 1024, os.path.getsize(csv_path) // (4 * num_workers))
+
+        def build_serially():
+            return IpRangeColumns.from_csv(csv_path, num_workers=1, chunk_bytes=chunk_bytes)
+
+        def build_in_parallel():
+            return IpRangeColumns.from_csv(csv_path, num_workers=num_workers, chunk_bytes=chunk_bytes)
+
+        def legacy_build():
+            ip_dict = legacy_csv_build(csv_path)
+            return IpRangeColumns.from_ranges(sorted((ip_range for chain in ip_dict.values() for ip_range in chain),
+                                                     key=lambda ip_range: ip_range[IpFullLocation.START_IP_POS]))
+
+        expected = legacy_build()
+        expected = list(map(expected.range_tuple, range(len(expected))))
+        for columns in (build_serially(), build_in_parallel()):
+            if list(map(columns.range_tuple, range(len(columns)))) != expected:
+                raise AssertionError("Tables built from csv differ")
+
+        before = min(timeit.repeat(legacy_build, number=1, repeat=3))
+        return [(f"build of {num_rows} ranges, 1 process", 
+                 before, min(timeit.repeat(build_serially, number=1, repeat=3))),
+                (f"build of {num_rows} ranges, {num_workers} processes", 
+                 before, min(timeit.repeat(build_in_parallel, number=1, repeat=3))),
+                ]
+
+#------------------------------------
+# legacy_csv_build
+#-------------------
+
+def legacy_csv_build(csv_path):
+    '''
+    The loop of the former IpFullLocation constructor,
+    which built ipDict from the csv file.
+    '''
+    currKey = 0
+    ipDict = {currKey : []}
+    with open(csv_path, 'rb') as csv_fd:
+        for line in csv.reader(TextIOWrapper(csv_fd, 'utf8')):
+            if len(line) == 0 or line[0] == '#' or line == '\n' or line[0] == '0':
+                continue
+            (startIPStr,endIPStr,twoLetterCountry,country, state, city,
+             latitude, longitude, zipcode, timezone, country_phone_code, area_code) = line
+            hashKey = startIPStr.strip('"').zfill(10)[0:4]
+            if hashKey != currKey:
+                ipDict[hashKey] = []
+                currKey = hashKey
+            ipDict[hashKey].append((int(startIPStr.strip('"')), 
+                                    int(endIPStr.strip('"')), 
+                                    twoLetterCountry.strip('"'), 
+                                    country.strip('"'), 
+                                    state.strip('"'),
+                                    city.strip('"'),
+                                    float(latitude),
+                                    float(longitude),
+                                    zipcode.strip('"'),
+                                    timezone.strip('"'),
+                                    country_phone_code.strip('"'),
+                                    area_code.strip('"')
+                                    ))
+    return ipDict
+
+# ------------------------- SQLite ----------------
+
+#------------------------------------
+# bench_sqlite_load
+#-------------------
+
+def bench_sqlite_load(num_rows):
+    '''
+    Run the full pipeline over a log of num_rows
+    activities into an SQLite file, and build the keys
+    and indexes: through a plain connection, with SQLite's
+    default journal and syncing, and primary keys declared
+    up front, and through the SqliteBackend. Checks that 
+    both produce the same tables.
+    '''
+    rows, ip_dict = sample_activities(num_rows)
+    header = ['id', 'emplid', 'ip_address', 'caller', 'action', 'key_parameter',
+              'environment', 'output', 'browser', 'created_at', 'updated_at']
+    # What the extractors of the callers look for:
+    key_parameters = {'get_course_info' : '{selected_course:105670, name:CS140}',
+                      'find_search' : '{search_term:cs 1}',
+                      'update_rec' : '{selected_course:105687, name:CS145}',
+                      'instructor_profile' : '{sunet:rjohari}'}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_path = os.path.join(tmp_dir, 'activity_log.tsv')
+        with open(log_path, 'w') as fd:
+            fd.write('\t'.join(header) + '\n')
+            for row in rows:
+                row[5] = key_parameters.get(row[3], row[5])
+                fd.write('\t'.join(row) + '\n')
+        load_num = iter(range(1000))
+
+        def load(backend_class):
+            db_path = os.path.join(tmp_dir, f"actlog{next(load_num)}.sqlite")
+            cleaner = ActivityLogCleaner(log_path, 
+                                         sqlite_path=db_path, 
+                                         checkpoints=False, 
+                                         columnar_buffers=True, 
+                                         unittesting=True)
+            cleaner.ip_dict = ip_dict
+            cleaner.connect_db = lambda **_kwargs: backend_class(db_path)
+            cleaner.open_db()
+            cleaner.ingest(log_path)
+            if cleaner.db.DEFERS_PRIMARY_KEYS:
+                cleaner.add_primary_keys()
+            cleaner.create_indexes()
+            return cleaner.db
+
+        def table_rows(db):
+            tables = {tbl_nm : list(db.query(f"SELECT * FROM {tbl_nm} ORDER BY row_id"))
+                      for tbl_nm in ('Activities', 'IpLocation', 'CrseSearches', 'Pins')}
+            db.close()
+            return tables
+
+        if table_rows(load(PlainSqliteBackend)) != table_rows(load(SqliteBackend)):
+            raise AssertionError("SQLite loads differ")
+
+        results = []
+        before = min(timeit.repeat(lambda: load(PlainSqliteBackend).close(), number=1, repeat=3)) / num_rows
+        after = min(timeit.repeat(lambda: load(SqliteBackend).close(), number=1, repeat=3)) / num_rows
+        results.append(("ingest into SQLite, per activity", before, after))
+
+        # The db's share: Activities rows in batches of
+        # the cleaner's size, and the primary key:
+        col_specs, primary_key = ActivityLogCleaner.TABLE_SCHEMAS['Activities']
+        col_names = [col_nm for col_nm, _col_type in col_specs]
+        activities = [tuple(row[pos] for pos in (0, 1, 2, 3, 4, 9, 10)) for row in rows]
+        batch_size = ActivityLogCleaner.DB_BATCH_SIZE_BIG
+
+        def insert(backend_class):
+            db = backend_class(os.path.join(tmp_dir, f"actlog{next(load_num)}.sqlite"))
+            db.create_table('Activities', col_specs, primary_key=primary_key)
+            for start in range(0, num_rows, batch_size):
+                db.bulk_insert('Activities', col_names, activities[start:start + batch_size])
+            db.add_primary_key('Activities', primary_key)
+            db.close()
+
+        before = min(timeit.repeat(lambda: insert(PlainSqliteBackend), number=1, repeat=3)) / num_rows
+        after = min(timeit.repeat(lambda: insert(SqliteBackend), number=1, repeat=3)) / num_rows
+        results.append(("Activities inserts and key, per row", before, after))
+        return results
+
+class PlainSqliteBackend(SqliteBackend):
+    '''
+    An SqliteBackend without its tuning: default
+    journal and syncing, and primary keys maintained
+    during the load.
+    '''
+    DEFERS_PRIMARY_KEYS = False
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=self.BUSY_TIMEOUT_SECS, check_same_thread=False)
+
+    def create_table(self, tbl_nm, col_specs, primary_key=None):
+        col_defs = [f"{col_nm} {col_type}" for col_nm, col_type in col_specs]
+        if primary_key is not None:
+            col_defs.append(f"PRIMARY KEY({primary_key})")
+        self.execute(f"CREATE TABLE {tbl_nm} ({', '.join(col_defs)})")
+
+# ------------------------- Helpers ----------------
+
+#------------------------------------
+# _retained_bytes
+#-------------------
+
+def _retained_bytes(func):
+    '''
+    Call func, and return the memory still allocated
+    for its result once it returns.
+    '''
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        gc.collect()
+        retained_bytes, _peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return retained_bytes
+
+#------------------------------------
+# _peak_bytes_and_gcs
+#-------------------
+
+def _peak_bytes_and_gcs(func):
+    '''
+    Call func, and return the peak of memory allocated
+    during the call, and the number of garbage collections
+    it caused, over all generations.
+    '''
+    gc.collect()
+    num_gcs = sum(gen_stats['collections'] for gen_stats in gc.get_stats())
+    tracemalloc.start()
+    try:
+        func()
+        _cur_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    num_gcs = sum(gen_stats['collections'] for gen_stats in gc.get_stats()) - num_gcs
+    return (peak_bytes, num_gcs)
+
+#------------------------------------
+# _per_row_secs
+#-------------------
+
+def _per_row_secs(func, num_rows, repeat=3, budget_secs=1.0):
+    '''
+    Best of repeat timings of up to num_rows calls,
+    per call. Fewer calls are timed if num_rows of them
+    would take longer than budget_secs; the legacy regexes
+    take most of a second on long fields.
+    '''
+    first_call_secs = timeit.timeit(func, number=1)
+    if first_call_secs > 0:
+        num_rows = max(1, min(num_rows, int(budget_secs / first_call_secs)))
+    return min(timeit.repeat(func, number=num_rows, repeat=repeat)) / num_rows
+
+#------------------------------------
+# report
+#-------------------
+
+def report(name, results):
+    '''
+    Print results. Each is (case, before, after), with
+    before and after in seconds, or (case, before, after, unit)
+    for other measures.
+    '''
+    print(f"{name}:")
+    for case, before, after, *unit in results:
+        unit = unit[0] if len(unit) > 0 else 's'
+        ratio = before / after if after > 0 else float('inf')
+        if unit == 's':
+            before, after, unit = (1e6 * before, 1e6 * after, 'us')
+        print(f"    {case:<40} before {before:9.2f}{unit:<2} "
+              f"after {after:9.2f}{unit:<2} ({ratio:.1f}x)")
+
+# Benchmark name --> function(num_rows) returning
+# [(case, secs per row before, secs per row after)]:
+BENCHMARKS = {'env_scan' : bench_env_scan,
+              'int_lists' : bench_int_lists,
+              'buffers' : bench_buffers,
+              'compact_schema' : bench_compact_schema,
+              'ip_lookup' : bench_ip_lookup,
+              'ip_cache' : bench_ip_cache,
+              'ip_batch' : bench_ip_batch,
+              'ip_table_open' : bench_ip_table_open,
+              'ip_table_memory' : bench_ip_table_memory,
+              'ip_table_build' : bench_ip_table_build,
+              'sqlite_load' : bench_sqlite_load,
+              }
+
+# ------------------------ Main ------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]),
+                                     formatter_class=argparse.RawTextHelpFormatter,
+                                     description="Time the cleaner's hot spots before and after their rewrites"
+                                     )
+
+    parser.add_argument('-r', '--rows',
+                        type=int,
+                        help='number of rows per timing; default: 2000',
+                        default=2000)
+
+    parser.add_argument('benchmarks',
+                        nargs='*',
+                        help=f"benchmarks to run; default: all of {list(BENCHMARKS.keys())}")
+
+    args = parser.parse_args()
+
+    for bench_name in args.benchmarks or BENCHMARKS.keys():
+        try:
+            bench_func = BENCHMARKS[bench_name]
+        except KeyError:
+            print(f"Unknown benchmark {bench_name}; choose from {list(BENCHMARKS.keys())}")
+            sys.exit(1)
+        report(bench_name, bench_func(args.rows))
@@ -0,0 +1,225 @@
+'''
+Created on Oct 18, 2026
+
+Support for loading the large MyISAM tables as one
+bulk operation, rather than maintaining their keys
+row by row:
+
+    o BulkLoadSession disables the keys of the tables
+      before the ingest, and rebuilds them afterwards
+      in one sort pass. It also enlarges the session
+      buffers MySQL uses for bulk inserts and key sorting,
+      and restores them when done.
+    o PhaseTimer records the wall clock time of each
+      phase of a run (parsing, key rebuilding, indexing...),
+      and logs them.
+'''
+
+from contextlib import contextmanager
+import time
+
+from logging_service import LoggingService
+
+
+class BulkLoadSession:
+    '''
+    Brackets a bulk load into MyISAM tables:
+
+        session = BulkLoadSession(db, ['Activities', 'Pins', ...])
+        session.apply_session_settings()
+        session.disable_keys()
+        ... load ...
+        session.enable_keys()
+        ... create more indexes ...
+        session.restore_session_settings()
+
+    ALTER TABLE ... DISABLE KEYS only suspends non-unique
+    indexes. Primary keys listed in DEFERRED_PRIMARY_KEYS are
+    therefore dropped as well, if their table is empty at
+    the start, and added back by enable_keys(). A primary key
+    that is missing at the start, say because an earlier run
+    dropped it and then failed, is added by enable_keys() too.
+    Calling enable_keys() again after it finished does nothing,
+    so it may be called once more during cleanup after errors.
+    '''
+
+    # Session settings during the load, in bytes:
+    BULK_INSERT_BUFFER_SIZE = 256 * 1024 * 1024
+    MYISAM_SORT_BUFFER_SIZE = 1024 * 1024 * 1024
+
+    # Primary keys that are cheaper to build after
+    # the load: table name --> key column(s):
+    DEFERRED_PRIMARY_KEYS = {'Activities' : 'row_id'}
+
+    #------------------------------------
+    # Constructor
+    #-------------------
+
+    def __init__(self,
+                 db,
+                 tables,
+                 bulk_insert_buffer_size=None,
+                 myisam_sort_buffer_size=None):
+        '''
+        :param db: open connection; the session settings
+            apply to this connection only
+        :type db: MySqlBackend
+        :param tables: names of the tables to be loaded
+        :type tables: [str]
+        :param bulk_insert_buffer_size: bytes for the MyISAM
+            bulk insert cache during the load
+        :type bulk_insert_buffer_size: {None | int}
+        :param myisam_sort_buffer_size: bytes for sorting
+            while rebuilding keys
+        :type myisam_sort_buffer_size: {None | int}
+        '''
+        self.log = LoggingService()
+        self.db = db
+        self.tables = tables
+        self.settings = {
+            'bulk_insert_buffer_size' : self.BULK_INSERT_BUFFER_SIZE
+                                        if bulk_insert_buffer_size is None
+                                        else bulk_insert_buffer_size,
+            'myisam_sort_buffer_size' : self.MYISAM_SORT_BUFFER_SIZE
+                                        if myisam_sort_buffer_size is None
+                                        else myisam_sort_buffer_size
+            }
+        # Values before apply_session_settings():
+        self.prev_settings = None
+        # Primary keys that enable_keys() is to add; those
+        # that disable_keys() dropped, or found missing:
+        self.dropped_primary_keys = {}
+        # Tables whose keys disable_keys() disabled:
+        self.disabled_tables = set()
+
+    #------------------------------------
+    # apply_session_settings
+    #-------------------
+
+    def apply_session_settings(self, db=None):
+        '''
+        Remember the current values of the bulk load
+        session variables, and set them to the values
+        for bulk loading. Other connections, such as those
+        of ingest workers, may be passed in as db; their
+        previous values are not remembered.
+
+        :param db: connection to configure; default: self.db
+        :type db: {None | MySqlBackend}
+        '''
+        if db is None:
+            db = self.db
+            var_list = ', '.join(f"@@SESSION.{var_nm}" for var_nm in self.settings.keys())
+            prev_values = next(db.query(f"SELECT {var_list}"))
+            self.prev_settings = dict(zip(self.settings.keys(), prev_values))
+        for var_nm, value in self.settings.items():
+            db.execute(f"SET SESSION {var_nm} = {value}")
+
+    #------------------------------------
+    # restore_session_settings
+    #-------------------
+
+    def restore_session_settings(self):
+        if self.prev_settings is None:
+            return
+        for var_nm, value in self.prev_settings.items():
+            self.db.execute(f"SET SESSION {var_nm} = {value}")
+        self.prev_settings = None
+
+    #------------------------------------
+    # disable_keys
+    #-------------------
+
+    def disable_keys(self):
+        for tbl_nm in self.tables:
+            key_cols = self.DEFERRED_PRIMARY_KEYS.get(tbl_nm)
+            if key_cols is not None:
+                if not self._has_primary_key(tbl_nm):
+                    self.log.warn(f"Primary key of {tbl_nm} is missing; adding it after the load")
+                    self.dropped_primary_keys[tbl_nm] = key_cols
+                elif self._is_empty(tbl_nm):
+                    self.log.info(f"Dropping primary key of {tbl_nm} until the load is done")
+                    self.db.execute(f"ALTER TABLE {tbl_nm} DROP PRIMARY KEY")
+                    self.dropped_primary_keys[tbl_nm] = key_cols
+            self.db.execute(f"ALTER TABLE {tbl_nm} DISABLE KEYS")
+            self.disabled_tables.add(tbl_nm)
+
+    #------------------------------------
+    # enable_keys
+    #-------------------
+
+    def enable_keys(self):
+        '''
+        Rebuild the keys that disable_keys() disabled, and
+        add the primary keys it dropped or found missing,
+        logging the time each table takes.
+        '''
+        for tbl_nm in self.tables:
+            if tbl_nm not in self.disabled_tables and tbl_nm not in self.dropped_primary_keys:
+                continue
+            start = time.time()
+            if tbl_nm in self.disabled_tables:
+                self.db.execute(f"ALTER TABLE {tbl_nm} ENABLE KEYS")
+                self.disabled_tables.remove(tbl_nm)
+            try:
+                key_cols = self.dropped_primary_keys.pop(tbl_nm)
+                self.db.execute(f"ALTER TABLE {tbl_nm} ADD PRIMARY KEY({key_cols})")
+            except KeyError:
+                pass
+            self.log.info(f"Rebuilt keys of {tbl_nm} in {time.time() - start:.1f}s")
+
+    #------------------------------------
+    # _has_primary_key
+    #-------------------
+
+    def _has_primary_key(self, tbl_nm):
+        key_parts = list(self.db.query(f"SHOW KEYS FROM {tbl_nm} WHERE Key_name = 'PRIMARY'"))
+        return len(key_parts) > 0
+
+    #------------------------------------
+    # _is_empty
+    #-------------------
+
+    def _is_empty(self, tbl_nm):
+        res_iter = self.db.query(f"SELECT COUNT(*) FROM {tbl_nm}")
+        num_rows = next(res_iter)
+        # Exhaust the iterator, so the next query works:
+        for _res in res_iter:
+            pass
+        return num_rows == 0
+
+# ------------------------- PhaseTimer ----------------
+
+class PhaseTimer:
+    '''
+    Measures the duration of named phases:
+
+        timer = PhaseTimer()
+        with timer.phase('ingest'):
+            ...
+        timer.report()
+    '''
+
+    def __init__(self):
+        self.log = LoggingService()
+        # Phase name --> seconds, in the order
+        # in which phases started:
+        self.durations = {}
+
+    @contextmanager
+    def phase(self, name):
+        self.log.info(f"Phase '{name}'...")
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            self.durations[name] = self.durations.get(name, 0.0) + duration
+            self.log.info(f"Phase '{name}' took {duration:.1f}s")
+
+    def report(self):
+        total = sum(self.durations.values())
+        for name, duration in self.durations.items():
+            share = 100 * duration / total if total > 0 else 0.0
+            self.log.info(f"{name:>20}: {duration:10.1f}s ({share:4.1f}%)")
+        self.log.info(f"{'total':>20}: {total:10.1f}s")
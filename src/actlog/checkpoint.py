@@ -0,0 +1,267 @@
+'''
+Created on Oct 18, 2026
+
+Checkpoints that let an interrupted ingest resume
+where it stopped, instead of re-reading the activity
+log from the start.
+
+A checkpoint is taken right after all buffers were
+flushed, and all writes reached the db. It records:
+
+    o the byte offset in the (uncompressed) activity log
+      of the first line not yet processed,
+    o for gzipped logs, the position in the compressed
+      file at about that point, for progress reporting,
+    o the id of the last row that was processed,
+    o for each table, the highest row id written so far,
+    o the searches that were still being typed at that
+      point, which are not in the db yet.
+
+Checkpoints are kept as JSON in a small file next to
+the log. Each save replaces the file atomically, so a
+crash while saving leaves the previous checkpoint intact.
+'''
+
+import copy
+import hashlib
+import json
+import os
+import time
+
+from logging_service import LoggingService
+
+
+class IngestCheckpoint:
+    '''
+    Where an ingest stood at one point in time:
+
+        checkpoint = IngestCheckpoint.load(IngestCheckpoint.path_for(log_path))
+        if checkpoint is not None and checkpoint.matches(log_path):
+            ... delete rows past checkpoint.last_row_id,
+                seek to checkpoint.offset ...
+    '''
+
+    # Suffix of the checkpoint file next to the log:
+    SUFFIX = '.checkpoint'
+
+    # Number of bytes at the start of the log that
+    # identify it:
+    HEAD_BYTES = 64 * 1024
+
+    #------------------------------------
+    # Constructor
+    #-------------------
+
+    def __init__(self,
+                 log_path,
+                 offset,
+                 last_row_id,
+                 compressed_offset=None,
+                 table_row_ids=None,
+                 search_states=None,
+                 head_digest=None,
+                 head_len=None,
+                 written_at=None):
+        '''
+        :param log_path: the activity log
+        :type log_path: str
+        :param offset: uncompressed byte offset of the first
+            unprocessed line
+        :type offset: int
+        :param last_row_id: id of the last processed row
+        :type last_row_id: {None | int}
+        :param compressed_offset: approximate position in a
+            gzipped log; None for plain logs
+        :type compressed_offset: {None | int}
+        :param table_row_ids: table name --> highest row id written
+        :type table_row_ids: {None | {str : int}}
+        :param search_states: copy of the cleaner's crs_search_states
+        :type search_states: {None | {str : dict}}
+        :param head_digest: fingerprint of the log's first
+            head_len bytes; computed if None
+        :type head_digest: {None | str}
+        :param head_len: number of bytes covered by head_digest
+        :type head_len: {None | int}
+        :param written_at: time of saving, in epoch seconds
+        :type written_at: {None | float}
+        '''
+        self.log_path = log_path
+        self.offset = offset
+        self.last_row_id = last_row_id
+        self.compressed_offset = compressed_offset
+        self.table_row_ids = {} if table_row_ids is None else table_row_ids
+        self.search_states = {} if search_states is None else search_states
+        if head_digest is None:
+            head_len = min(os.path.getsize(log_path), self.HEAD_BYTES)
+            head_digest = self.log_digest(log_path, head_len)
+        self.head_digest = head_digest
+        self.head_len = head_len
+        self.written_at = written_at
+
+    #------------------------------------
+    # path_for
+    #-------------------
+
+    @classmethod
+    def path_for(cls, log_path):
+        '''
+        Return the path of the checkpoint file
+        that belongs to the given log.
+        '''
+        return log_path + cls.SUFFIX
+
+    #------------------------------------
+    # log_digest
+    #-------------------
+
+    @classmethod
+    def log_digest(cls, log_path, num_bytes):
+        '''
+        Return a fingerprint of the first num_bytes of
+        the given (raw, possibly compressed) log file.
+        Used to recognize that a checkpoint was taken
+        on a different file of the same name.
+        '''
+        with open(log_path, 'rb') as fd:
+            return hashlib.sha1(fd.read(num_bytes)).hexdigest()
+
+    #------------------------------------
+    # of_cleaner
+    #-------------------
+
+    @classmethod
+    def of_cleaner(cls, cleaner, log_path, offset, compressed_offset=None):
+        '''
+        Return a checkpoint for the current state of
+        the given cleaner. The cleaner's buffers must have
+        been flushed. Pending searches are copied, since
+        the cleaner keeps modifying them.
+
+        :param cleaner: the cleaner whose progress is recorded
+        :type cleaner: ActivityLogCleaner
+        :param log_path: the activity log being ingested
+        :type log_path: str
+        :param offset: uncompressed offset of the first
+            unprocessed line
+        :type offset: int
+        :param compressed_offset: approximate offset in a
+            gzipped log
+        :type compressed_offset: {None | int}
+        :rtype: IngestCheckpoint
+        '''
+        return cls(log_path,
+                   offset,
+                   cleaner.cur_id,
+                   compressed_offset=compressed_offset,
+                   search_states=copy.deepcopy(cleaner.crs_search_states))
+
+    #------------------------------------
+    # pending_search_row_ids
+    #-------------------
+
+    def pending_search_row_ids(self):
+        '''
+        Row ids of the searches that were still being
+        typed. Their CrseSearches rows may have been
+        written after the checkpoint was taken.
+        '''
+        return sorted(state['row_id'] for state in self.search_states.values())
+
+    #------------------------------------
+    # matches
+    #-------------------
+
+    def matches(self, log_path):
+        '''
+        True if this checkpoint can be used to resume
+        ingesting the given log: the log starts with the
+        same bytes as when the checkpoint was taken, and is
+        not shorter. Logs that grew since are fine; the rows
+        that were appended get imported on resume.
+        '''
+        log = LoggingService()
+        try:
+            if self.log_digest(log_path, self.head_len) != self.head_digest:
+                log.warn(f"Checkpoint was taken on a different {log_path}; ignoring it")
+                return False
+            if self.compressed_offset is None and os.path.getsize(log_path) < self.offset:
+                log.warn(f"{log_path} is shorter than at the checkpoint; ignoring it")
+                return False
+        except OSError as e:
+            log.warn(f"Cannot check checkpoint against {log_path}: {repr(e)}")
+            return False
+        return True
+
+    #------------------------------------
+    # save
+    #-------------------
+
+    def save(self, path=None):
+        '''
+        Write the checkpoint to path, replacing any
+        earlier checkpoint there in one step.
+
+        :param path: destination; default: path_for(self.log_path)
+        :type path: {None | str}
+        '''
+        if path is None:
+            path = self.path_for(self.log_path)
+        self.written_at = time.time()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fd:
+            json.dump(self.to_dict(), fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_path, path)
+
+    #------------------------------------
+    # load
+    #-------------------
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Return the checkpoint saved at path, or None
+        if there is none, or it is unreadable.
+
+        :rtype: {None | IngestCheckpoint}
+        '''
+        try:
+            with open(path, 'r') as fd:
+                return cls(**json.load(fd))
+        except FileNotFoundError:
+            return None
+        except (ValueError, TypeError) as e:
+            LoggingService().warn(f"Ignoring unreadable checkpoint {path}: {repr(e)}")
+            return None
+
+    #------------------------------------
+    # remove
+    #-------------------
+
+    @classmethod
+    def remove(cls, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    #------------------------------------
+    # to_dict
+    #-------------------
+
+    def to_dict(self):
+        return {'log_path' : self.log_path,
+                'offset' : self.offset,
+                'last_row_id' : self.last_row_id,
+                'compressed_offset' : self.compressed_offset,
+                'table_row_ids' : self.table_row_ids,
+                'search_states' : self.search_states,
+                'head_digest' : self.head_digest,
+                'head_len' : self.head_len,
+                'written_at' : self.written_at
+                }
+
+    def __repr__(self):
+        return (f"<IngestCheckpoint {os.path.basename(self.log_path)} "
+                f"row {self.last_row_id} offset {self.offset}>")
@@ -0,0 +1,249 @@
+'''
+Created on Oct 18, 2026
+
+Column oriented alternative to the cleaner's BufferClass.
+
+A BufferClass keeps one tuple per row. For the large
+buffers, like the enrollment history with its 20,000 row
+batches, those tuples and the ints in them are most of
+the objects the ingest creates, and all of them are
+tracked by the garbage collector. A ColumnarBuffer keeps
+each integer column in an array('q') instead, and the
+other columns in plain lists. No tuples are created until
+a sink needs them.
+
+A column that is declared as integer, but is handed a
+value that does not fit an array('q'), like None or a
+str, is turned into a list on the spot, so the buffered
+values are always exactly those that were appended.
+'''
+
+from array import array
+from itertools import repeat
+
+
+class ColumnBatch:
+    '''
+    The content of a ColumnarBuffer at flush time,
+    handed to TableSink.write() in place of a list of
+    tuples. Supports what sinks do with rows: len(),
+    iteration, and indexing, all yielding row tuples.
+    '''
+
+    __slots__ = ('columns',)
+
+    def __init__(self, columns):
+        '''
+        :param columns: equally long arrays or lists,
+            one per table column
+        :type columns: [{array | list}]
+        '''
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __iter__(self):
+        return zip(*self.columns)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return ColumnBatch([col[idx] for col in self.columns])
+        return tuple(col[idx] for col in self.columns)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def tuples(self):
+        '''
+        Return the rows as a list of tuples, for consumers
+        that need a real list, like bulkInsert.
+        '''
+        return list(zip(*self.columns))
+
+    def __repr__(self):
+        return f"<ColumnBatch {len(self.columns)} cols {len(self)} rows>"
+
+
+class ColumnarBuffer:
+    '''
+    Drop-in replacement for BufferClass, given the kind
+    of each column:
+
+        buf = ColumnarBuffer('enrl_hist_buf', 20000, ('q', 'q'))
+        buf.append((10, 123456))
+        buf.extend_pairs(11, array('q', [102794, 105644]))
+        sink.write(tbl_nm, col_names, buf.batch())
+        buf.truncate()
+
+    A typecode of 'q' declares an integer column; None
+    declares a column of arbitrary values.
+    '''
+
+    __slots__ = ('name', 'capacity', 'typecodes', 'columns')
+
+    #------------------------------------
+    # Constructor
+    #-------------------
+
+    def __init__(self, name, capacity, typecodes):
+        '''
+        :param name: name for messages
+        :type name: str
+        :param capacity: number of rows at which full() is True
+        :type capacity: int
+        :param typecodes: for each column, 'q' or None
+        :type typecodes: ({None | str})
+        '''
+        self.name = name
+        self.capacity = capacity
+        self.typecodes = tuple(typecodes)
+        self.truncate()
+
+    #------------------------------------
+    # append
+    #-------------------
+
+    def append(self, elements):
+        '''
+        Add one row.
+
+        :param elements: one value per column
+        :type elements: tuple
+        '''
+        for col_idx, val in enumerate(elements):
+            try:
+                self.columns[col_idx].append(val)
+            except (TypeError, OverflowError):
+                self._to_list(col_idx).append(val)
+
+    #------------------------------------
+    # extend
+    #-------------------
+
+    def extend(self, elements):
+        '''
+        Add several rows.
+
+        :param elements: rows, each with one value per column
+        :type elements: iterable(tuple)
+        '''
+        for row in elements:
+            self.append(row)
+
+    #------------------------------------
+    # extend_pairs
+    #-------------------
+
+    def extend_pairs(self, first, seconds):
+        '''
+        Add one (first, second) row for each of
+        seconds. Used for the (row_id, crs_id) rows of
+        enrollment histories. Both columns are extended
+        in C when they are arrays.
+
+        :param first: value of the first column in all new rows
+        :type first: any
+        :param seconds: values of the second column
+        :type seconds: {array | [any]}
+        '''
+        num_new = len(seconds)
+        try:
+            self.columns[0].extend(repeat(first, num_new))
+        except (TypeError, OverflowError):
+            # Fails on the first value, before any is added:
+            self._to_list(0).extend(repeat(first, num_new))
+        self._extend(1, seconds)
+
+    #------------------------------------
+    # batch
+    #-------------------
+
+    def batch(self):
+        '''
+        Return the buffered rows for a sink. The batch
+        shares the columns with the buffer until the next
+        truncate().
+
+        :rtype: ColumnBatch
+        '''
+        return ColumnBatch(self.columns)
+
+    #------------------------------------
+    # arr
+    #-------------------
+
+    @property
+    def arr(self):
+        '''
+        The buffered rows as a list of tuples, like
+        BufferClass.arr.
+        '''
+        return self.batch().tuples()
+
+    #------------------------------------
+    # truncate
+    #-------------------
+
+    def truncate(self):
+        # New columns, rather than clearing the old
+        # ones, which a batch may still be using:
+        self.columns = [[] if typecode is None else array(typecode)
+                        for typecode in self.typecodes]
+
+    #------------------------------------
+    # full
+    #-------------------
+
+    def full(self):
+        '''
+        True if buffer has as many rows as were
+        specified for its capacity upon creation.
+        '''
+        return len(self.columns[0]) >= self.capacity
+
+    #------------------------------------
+    # _extend
+    #-------------------
+
+    def _extend(self, col_idx, values):
+        '''
+        Extend one column by the values of a sequence,
+        turning it into a list if necessary.
+        '''
+        col = self.columns[col_idx]
+        prev_len = len(col)
+        try:
+            col.extend(values)
+        except (TypeError, OverflowError):
+            # Arrays keep the values added before
+            # the offending one:
+            del col[prev_len:]
+            self._to_list(col_idx).extend(values)
+
+    #------------------------------------
+    # _to_list
+    #-------------------
+
+    def _to_list(self, col_idx):
+        '''
+        Replace the array of the given column with
+        a list of the same values, and return the list.
+        '''
+        col = self.columns[col_idx]
+        if type(col) != list:
+            col = list(col)
+            self.columns[col_idx] = col
+        return col
+
+    def __iter__(self):
+        return iter(self.batch())
+
+    def __hash__(self):
+        return id(self)
+
+    def __repr__(self):
+        return f"<ColumnarBuf {self.name} {hex(id(self))}>"
+
+    def __str__(self):
+        return self.__repr__()
@@ -0,0 +1,430 @@
+'''
+Created on Oct 18, 2026
+
+Storage backends of the ActivityLogCleaner. The cleaner,
+its sinks, and the IndexBuilder reach the db only through
+a DbBackend:
+
+    MySqlBackend  : the MySQL server, through a pymysql_utils
+                    MySQLDB connection
+    SqliteBackend : an embedded SQLite file; needs no server,
+                    for laptop runs, tests, and benchmarks
+
+Statements that both understand, like the DELETE FROM ...
+WHERE row_id > ... of a resumed ingest, or the SELECTs of
+the dimension tables, go through query() and execute().
+Everything dialect specific, like the catalog lookups, the
+DDL, and bulk inserts, has a method of its own.
+
+The SQLite backend runs in WAL mode, inserts whole batches
+with executemany() in one transaction, and defers primary
+keys: they are added as unique indexes once the load is
+done (see add_primary_key()). Index names are qualified
+with their table name, because SQLite's are global.
+'''
+
+import sqlite3
+
+
+#------------------------------------
+# index_covers
+#-------------------
+
+def index_covers(tbl_indexes, col_nm):
+    '''
+    True if one of a table's indexes covers the given
+    column(s). A single column counts as covered if it is
+    part of any index, which is how the cleaner has always
+    decided whether to index it.
+
+    :param tbl_indexes: column name tuples, one per index
+    :type tbl_indexes: [(str)]
+    :param col_nm: column name(s) as they would appear
+        between parentheses in CREATE INDEX, like 'row_id'
+        or 'row_id, subject'
+    :type col_nm: str
+    :rtype: bool
+    '''
+    col_nms = tuple(nm.strip() for nm in col_nm.split(','))
+    for idx_col_nms in tbl_indexes:
+        if idx_col_nms == col_nms:
+            return True
+        if len(col_nms) == 1 and col_nms[0] in idx_col_nms:
+            return True
+    return False
+
+# ------------------------- DbBackend ----------------
+
+class DbBackend:
+    '''
+    The operations the cleaner performs on its db.
+    Subclasses implement all but the derived ones,
+    table_exists() and index_exists().
+    '''
+
+    # Whether several connections may load and
+    # index tables at the same time:
+    CONCURRENT_WRITERS = True
+
+    # Whether create_table() leaves out the primary key,
+    # to be added by add_primary_key() after the load:
+    DEFERS_PRIMARY_KEYS = False
+
+    def query(self, query_str):
+        '''
+        Run a query, and return an iterator over its
+        rows. Rows of one column are returned as that
+        column's value, others as tuples.
+        '''
+        raise NotImplementedError(f"Backend {self.__class__.__name__} must implement query()")
+
+    def execute(self, statement):
+        '''
+        Run a statement that returns no rows.
+
+        :return: errors and warnings, None if there were none
+        :rtype: (any, any)
+        '''
+        raise NotImplementedError(f"Backend {self.__class__.__name__} must implement execute()")
+
+    def bulk_insert(self, tbl_nm, col_names, rows):
+        '''
+        Insert rows into a table.
+
+        :param tbl_nm: table name
+        :type tbl_nm: str
+        :param col_names: column names, in the order of the
+            values in each row
+        :type col_names: (str)
+        :param rows: the rows
+        :type rows: [tuple]
+        :return: errors and warnings, None if there were none
+        :rtype: (any, any)
+        '''
+        raise NotImplementedError(f"Backend {self.__class__.__name__} must implement bulk_insert()")
+
+    def create_table(self, tbl_nm, col_specs, primary_key=None):
+        '''
+        Create a table.
+
+        :param tbl_nm: table name
+        :type tbl_nm: str
+        :param col_specs: (column name, MySQL column type) pairs,
+            like ('row_id', 'int unsigned NOT NULL')
+        :type col_specs: [(str, str)]
+        :param primary_key: primary key column(s), like 'row_id'
+        :type primary_key: {None | str}
+        '''
+        raise NotImplementedError(f"Backend {self.__class__.__name__} must implement create_table()")
+
+    def add_primary_key(self, tbl_nm, primary_key):
+        '''
+        Add the primary key that create_table() deferred,
+        unless it exists already. Backends that do not defer
+        keys need not override this.
+        '''
+        pass
+
+    def truncate_table(self, tbl_nm):
+        raise NotImplementedError(f"Backend {self.__class__.__name__} must implement truncate_table()")
+
+    def drop_table(self, tbl_nm):
+        raise NotImplementedError(f"Backend {self.__class__.__name__} must implement drop_table()")
+
+    def table_type(self, tbl_nm):
+        '''
+        Return 'BASE TABLE' or 'VIEW', or None if
+        there is no table or view of the given name.
+
+        :rtype: {None | str}
+        '''
+        raise NotImplementedError(f"Backend {self.__class__.__name__} must implement table_type()")
+
+    def table_exists(self, tbl_nm):
+        '''
+        True if a table or view of the given name exists.
+        '''
+        return self.table_type(tbl_nm) is not None
+
+    def create_view(self, view_nm, query_str):
+        '''
+        Create the given view, or replace it.
+        '''
+        raise NotImplementedError(f"Backend {self.__class__.__name__} must implement create_view()")
+
+    def drop_view(self, view_nm):
+        '''
+        Drop the given view, if it exists.
+        '''
+        raise NotImplementedError(f"Backend {self.__class__.__name__} must implement drop_view()")
+
+    def epoch_to_datetime(self, col_expr):
+        '''
+        Return an SQL expression that turns the epoch
+        seconds of col_expr into a datetime, independent
+        of any session time zone.
+
+        :rtype: str
+        '''
+        raise NotImplementedError(f"Backend {self.__class__.__name__} must implement epoch_to_datetime()")
+
+    def index_columns(self):
+        '''
+        Return the columns of all existing indexes.
+
+        :return: table name --> list of column name tuples,
+            one tuple per index
+        :rtype: {str : [(str)]}
+        '''
+        raise NotImplementedError(f"Backend {self.__class__.__name__} must implement index_columns()")
+
+    def index_exists(self, tbl_nm, col_nm):
+        '''
+        True if the given column(s) of a table are
+        indexed (see index_covers()).
+        '''
+        return index_covers(self.index_columns().get(tbl_nm, []), col_nm)
+
+    def create_index(self, idx_nm, tbl_nm, col_nm):
+        '''
+        Create an index.
+
+        :param idx_nm: index name
+        :type idx_nm: str
+        :param tbl_nm: table name
+        :type tbl_nm: str
+        :param col_nm: column name(s) as they would appear
+            between parentheses in CREATE INDEX
+        :type col_nm: str
+        '''
+        raise NotImplementedError(f"Backend {self.__class__.__name__} must implement create_index()")
+
+    def table_sizes(self):
+        '''
+        Return the approximate size of each table,
+        for ordering work by size.
+
+        :return: table name --> size
+        :rtype: {str : int}
+        '''
+        raise NotImplementedError(f"Backend {self.__class__.__name__} must implement table_sizes()")
+
+    def max_packet_bytes(self):
+        '''
+        Largest statement the db accepts, in bytes;
+        None if there is no such limit.
+
+        :rtype: {None | int}
+        '''
+        return None
+
+    def close(self):
+        pass
+
+# ------------------------- MySqlBackend ----------------
+
+class MySqlBackend(DbBackend):
+    '''
+    Wraps a MySQLDB connection:
+
+        db = MySqlBackend(MySQLDB(user=..., passwd=..., db='activity_log'), 'activity_log')
+
+    Tables are created as MyISAM.
+    '''
+
+    def __init__(self, db, db_name):
+        '''
+        :param db: open connection
+        :type db: MySQLDB
+        :param db_name: name of the database that holds the tables
+        :type db_name: str
+        '''
+        self.db = db
+        self.db_name = db_name
+
+    def query(self, query_str):
+        return self.db.query(query_str)
+
+    def execute(self, statement):
+        return self.db.execute(statement)
+
+    def bulk_insert(self, tbl_nm, col_names, rows):
+        return self.db.bulkInsert(tbl_nm, col_names, rows)
+
+    def create_table(self, tbl_nm, col_specs, primary_key=None):
+        col_defs = [f"{col_nm} {col_type}" for col_nm, col_type in col_specs]
+        if primary_key is not None:
+            col_defs.append(f"PRIMARY KEY({primary_key})")
+        self.db.execute(f"CREATE TABLE {tbl_nm} ({', '.join(col_defs)}) engine=MyISAM")
+
+    def truncate_table(self, tbl_nm):
+        self.db.truncateTable(tbl_nm)
+
+    def drop_table(self, tbl_nm):
+        self.db.dropTable(tbl_nm)
+
+    def table_type(self, tbl_nm):
+        return next(self.db.query(f'''SELECT table_type
+                                        FROM information_schema.tables
+                                       WHERE table_schema = "{self.db_name}"
+                                         AND table_name = "{tbl_nm}";'''
+                                  ), None)
+
+    def create_view(self, view_nm, query_str):
+        self.db.execute(f"CREATE OR REPLACE VIEW {view_nm} AS {query_str}")
+
+    def drop_view(self, view_nm):
+        self.db.execute(f"DROP VIEW IF EXISTS {view_nm}")
+
+    def epoch_to_datetime(self, col_expr):
+        return f"TIMESTAMP '1970-01-01 00:00:00' + INTERVAL {col_expr} SECOND"
+
+    def index_columns(self):
+        res = self.db.query(f'''SELECT table_name, index_name, column_name
+                                  FROM information_schema.statistics
+                                 WHERE table_schema = "{self.db_name}"
+                                 ORDER BY table_name, index_name, seq_in_index;''')
+        # (table name, index name) --> [column names]:
+        idx_cols = {}
+        for tbl_nm, idx_nm, col_nm in res:
+            idx_cols.setdefault((tbl_nm, idx_nm), []).append(col_nm)
+        existing = {}
+        for (tbl_nm, _idx_nm), col_nms in idx_cols.items():
+            existing.setdefault(tbl_nm, []).append(tuple(col_nms))
+        return existing
+
+    def create_index(self, idx_nm, tbl_nm, col_nm):
+        self.db.execute(f"CREATE INDEX {idx_nm} ON {tbl_nm}({col_nm});")
+
+    def table_sizes(self):
+        '''
+        Data size in bytes of each table.
+        '''
+        res = self.db.query(f'''SELECT table_name, data_length
+                                  FROM information_schema.tables
+                                 WHERE table_schema = "{self.db_name}";''')
+        return {tbl_nm : (0 if data_len is None else int(data_len))
+                for tbl_nm, data_len in res}
+
+    def max_packet_bytes(self):
+        return int(next(self.db.query("SELECT @@max_allowed_packet")))
+
+    def close(self):
+        self.db.close()
+
+# ------------------------- SqliteBackend ----------------
+
+class SqliteBackend(DbBackend):
+    '''
+    Keeps the tables in one SQLite file:
+
+        db = SqliteBackend('/tmp/activity_log.sqlite')
+
+    MySQL column types are used as they are; SQLite
+    derives its type affinities from them. Several
+    connections may be open on one file, like those of
+    the workers of a parallel ingest; their writes are
+    serialized, waiting up to BUSY_TIMEOUT_SECS for
+    each other.
+    '''
+
+    CONCURRENT_WRITERS = False
+    DEFERS_PRIMARY_KEYS = True
+
+    # Seconds a connection waits for another one's
+    # write to finish:
+    BUSY_TIMEOUT_SECS = 600
+
+    # Page cache per connection, in KiB:
+    CACHE_KIB = 256 * 1024
+
+    def __init__(self, db_path):
+        '''
+        :param db_path: the db file; created if needed
+        :type db_path: str
+        '''
+        self.db_path = db_path
+        # Connections of the IndexBuilder's threads are
+        # closed by the thread that started the pool:
+        self.conn = sqlite3.connect(db_path, timeout=self.BUSY_TIMEOUT_SECS, check_same_thread=False)
+        # Readers do not block the writer, and commits
+        # need no fsync of the db file:
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute(f"PRAGMA cache_size = -{self.CACHE_KIB}")
+        self.conn.execute("PRAGMA temp_store = MEMORY")
+
+    def query(self, query_str):
+        # Fetched right away, so that no statement is
+        # still open when the next write commits:
+        return iter([row[0] if len(row) == 1 else row
+                     for row in self.conn.execute(query_str)])
+
+    def execute(self, statement):
+        with self.conn:
+            self.conn.execute(statement)
+        return (None, None)
+
+    def bulk_insert(self, tbl_nm, col_names, rows):
+        placeholders = ', '.join('?' * len(col_names))
+        with self.conn:
+            self.conn.executemany(f"INSERT INTO {tbl_nm} ({', '.join(col_names)}) VALUES ({placeholders})",
+                                  rows)
+        return (None, None)
+
+    def create_table(self, tbl_nm, col_specs, primary_key=None):
+        # The primary key comes with add_primary_key():
+        col_defs = [f"{col_nm} {col_type}" for col_nm, col_type in col_specs]
+        self.execute(f"CREATE TABLE {tbl_nm} ({', '.join(col_defs)})")
+
+    def add_primary_key(self, tbl_nm, primary_key):
+        self.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {tbl_nm}_pk ON {tbl_nm}({primary_key})")
+
+    def truncate_table(self, tbl_nm):
+        self.execute(f"DELETE FROM {tbl_nm}")
+
+    def drop_table(self, tbl_nm):
+        self.execute(f"DROP TABLE IF EXISTS {tbl_nm}")
+
+    def table_type(self, tbl_nm):
+        sqlite_type = next(self.query(f"SELECT type FROM sqlite_master WHERE name = '{tbl_nm}' "
+                                      f"AND type IN ('table', 'view')"), None)
+        if sqlite_type is None:
+            return None
+        return 'VIEW' if sqlite_type == 'view' else 'BASE TABLE'
+
+    def create_view(self, view_nm, query_str):
+        with self.conn:
+            self.conn.execute(f"DROP VIEW IF EXISTS {view_nm}")
+            self.conn.execute(f"CREATE VIEW {view_nm} AS {query_str}")
+
+    def drop_view(self, view_nm):
+        self.execute(f"DROP VIEW IF EXISTS {view_nm}")
+
+    def epoch_to_datetime(self, col_expr):
+        return f"datetime({col_expr}, 'unixepoch')"
+
+    def index_columns(self):
+        existing = {}
+        indexes = list(self.conn.execute("SELECT tbl_name, name FROM sqlite_master WHERE type = 'index'"))
+        for tbl_nm, idx_nm in indexes:
+            col_nms = tuple(col_nm for _seqno, _cid, col_nm
+                            in self.conn.execute(f"PRAGMA index_info('{idx_nm}')"))
+            existing.setdefault(tbl_nm, []).append(col_nms)
+        return existing
+
+    def create_index(self, idx_nm, tbl_nm, col_nm):
+        self.execute(f"CREATE INDEX {tbl_nm}_{idx_nm} ON {tbl_nm}({col_nm})")
+
+    def table_sizes(self):
+        '''
+        Highest rowid of each table, which is its number
+        of rows, unless rows were deleted; found without
+        scanning the table.
+        '''
+        tbl_nms = list(self.query("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        return {tbl_nm : (next(self.query(f"SELECT MAX(rowid) FROM {tbl_nm}")) or 0)
+                for tbl_nm in tbl_nms}
+
+    def close(self):
+        self.conn.close()
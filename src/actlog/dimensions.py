@@ -0,0 +1,117 @@
+'''
+Created on Oct 18, 2026
+
+Dictionary encoding of values that repeat across
+many activity rows, like the caller/action pairs of
+the Activities table.
+
+A DimensionTable assigns a small int id to each
+distinct key the first time the key is seen during the
+ingest. The cleaner stores the id in the fact rows,
+and writes each new (id, key...) row once, into a
+lookup table of the same name.
+
+Ids are never changed once assigned:
+
+    o A resumed ingest first loads the lookup table
+      from the db, and continues numbering after the
+      highest id found there.
+    o In a parallel ingest, only the parent process
+      assigns ids, in log order, as the serial ingest
+      does. It passes the new ids to the workers along
+      with their rows (see ParallelIngester), so each key
+      has one id, the same as in a serial ingest.
+'''
+
+
+class DimensionTable:
+    '''
+    Maps keys, which are tuples of column values,
+    to int ids:
+
+        actions = DimensionTable('Actions', 'action_id', ('category', 'action_nm'))
+        actions.add(('pin', 'pin'))              --> 1
+        actions.ids[('pin', 'pin')]              --> 1
+        actions.add(('find_search', 'search'))   --> 2
+    '''
+
+    # Id of the first key in an empty table:
+    FIRST_ID = 1
+
+    #------------------------------------
+    # Constructor
+    #-------------------
+
+    def __init__(self, table, id_col, key_cols):
+        '''
+        :param table: name of the lookup table
+        :type table: str
+        :param id_col: name of the id column
+        :type id_col: str
+        :param key_cols: names of the key columns
+        :type key_cols: (str)
+        '''
+        self.table = table
+        self.id_col = id_col
+        self.key_cols = tuple(key_cols)
+        # Key tuple --> id:
+        self.ids = {}
+        self.next_id = self.FIRST_ID
+
+    #------------------------------------
+    # col_names
+    #-------------------
+
+    @property
+    def col_names(self):
+        '''
+        Columns of the lookup table, id first.
+        '''
+        return (self.id_col,) + self.key_cols
+
+    #------------------------------------
+    # add
+    #-------------------
+
+    def add(self, key):
+        '''
+        Assign the next id to a key that has none yet,
+        and return the id.
+
+        :param key: one value per key column
+        :type key: tuple
+        :rtype: int
+        '''
+        dim_id = self.next_id
+        self.ids[key] = dim_id
+        self.next_id += 1
+        return dim_id
+
+    #------------------------------------
+    # load
+    #-------------------
+
+    def load(self, rows):
+        '''
+        Add the rows of the lookup table, as written
+        by an earlier ingest. Of several ids of one key,
+        the first is used. New ids are numbered after
+        the highest loaded id.
+
+        :param rows: (id, key values...) rows
+        :type rows: iterable(tuple)
+        '''
+        for row in rows:
+            dim_id = row[0]
+            self.ids.setdefault(tuple(row[1:]), dim_id)
+            if dim_id >= self.next_id:
+                self.next_id = dim_id + 1
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __hash__(self):
+        return id(self)
+
+    def __repr__(self):
+        return f"<DimensionTable {self.table} {len(self)} keys>"
@@ -0,0 +1,189 @@
+'''
+Created on Oct 18, 2026
+
+Finds the pinned courses, and the enrollment history
+in the (often very long) ENVIRONMENT field of
+initial_recommendation rows. Both log eras are handled:
+
+Early variety:
+
+    ...{pinned:{1156:208582, 1162:120904}, course_history_ids:[102794, 105644], ...
+
+Later variety:
+
+    ..."pinned_courses"=>[#<Enrollment STRM: 1214, CLASS_NBR: 25600, CRSE_ID: 204608, ...>, ...]
+    ..."registered_courses"=>[#<Enrollment STRM: nil, ..., CRSE_ID: 105687, ...>, ...]
+
+The sections are located with str.find() and str.rfind()
+on fixed anchors, which run in C without backtracking.
+Only the (short) sections are then picked apart. The
+field is searched as the str the csv reader produced;
+it is not encoded to bytes.
+
+Which occurrence of an anchor is used follows the regular
+expressions the cleaner used before:
+
+    o Pins: '.*pinned:{([^}]*)}.*' and its late counterpart
+      start with a greedy '.*', which does not cross newlines.
+      They therefore match the last occurrence of the anchor
+      within the first line of the field that has one.
+    o Enrollment history: 'course_history_ids:([^\]]*])' and
+      its late counterpart match the first occurrence.
+'''
+
+import re
+
+from actlog.int_lists import IntListParser
+
+
+class EnvironmentScanner:
+    '''
+    Extracts pins and enrollment history from
+    ENVIRONMENT field values:
+
+        scanner = EnvironmentScanner()
+        pins, enrl_hist = scanner.scan(row[ENVIRONMENT_POS])
+    '''
+
+    PINS_EARLY_ANCHOR = 'pinned:{'
+    PINS_LATE_ANCHOR = 'pinned_courses"=>['
+    ENRL_HIST_EARLY_ANCHOR = 'course_history_ids:'
+    ENRL_HIST_LATE_ANCHOR = 'registered_courses"=>'
+
+    # Pick STRM and CRSE_ID nums out of the late pins section.
+    # Intended to be used with findall(). Returns:
+    #   [('1214', '204608'), ('1214', '105670'), ...]
+    pins_late_pat = re.compile(r'STRM: ([0-9]{4}), CLASS_NBR: [^,]*, CRSE_ID: ([0-9]{6})')
+
+    # Pick CRSE_ID nums out of the late enrollment section:
+    enrl_hist_late_pat = re.compile(r'CRSE_ID: ([0-9]{6})')
+
+    def __init__(self, int_parser=None):
+        '''
+        :param int_parser: parser that converts, and counts
+            malformed pins; shared with the caller
+        :type int_parser: {None | IntListParser}
+        '''
+        self.int_parser = IntListParser() if int_parser is None else int_parser
+
+    #------------------------------------
+    # scan
+    #-------------------
+
+    def scan(self, environment):
+        '''
+        Return the pins and the enrollment history
+        found in an ENVIRONMENT value.
+
+        The enrollment history of the early variety is
+        returned as the text of the list, like '[102794, 105644]',
+        that of the late variety as a list of crs_id ints.
+
+        :param environment: the ENVIRONMENT field of a row
+        :type environment: str
+        :return: (strm, crs_id) int pairs of the pins, and
+            the enrollment history; None if there is none
+        :rtype: ([(int, int)], {None | str | [int]})
+        '''
+        return (self.pins(environment), self.enrollment_history(environment))
+
+    #------------------------------------
+    # pins
+    #-------------------
+
+    def pins(self, environment):
+        '''
+        Return (strm, crs_id) int pairs of the pins in
+        the given ENVIRONMENT value; the early variety takes
+        precedence. Early pairs that do not parse are counted
+        in self.int_parser, and skipped.
+
+        :rtype: [(int, int)]
+        '''
+        section = self._last_closed_in_first_line(environment, self.PINS_EARLY_ANCHOR, '}')
+        if section is not None:
+            start, end = section
+            return self.int_parser.parse_pairs(environment[start:end])
+
+        section = self._last_closed_in_first_line(environment, self.PINS_LATE_ANCHOR, ']')
+        if section is None:
+            return []
+        start, end = section
+        return [(int(strm), int(crs_id))
+                for strm, crs_id in self.pins_late_pat.findall(environment, start, end)]
+
+    #------------------------------------
+    # enrollment_history
+    #-------------------
+
+    def enrollment_history(self, environment):
+        '''
+        Return the enrollment history in the given
+        ENVIRONMENT value; the early variety takes precedence.
+
+        :return: the early variety's list text, like
+            '[102794, 105644]', or the late variety's crs_ids,
+            or None if neither is present
+        :rtype: {None | str | [int]}
+        '''
+        section = self._first_closed(environment, self.ENRL_HIST_EARLY_ANCHOR, ']')
+        if section is not None:
+            start, end = section
+            # Include the closing bracket:
+            return environment[start:end + 1]
+
+        section = self._first_closed(environment, self.ENRL_HIST_LATE_ANCHOR, ']')
+        if section is None:
+            return None
+        start, end = section
+        return self.int_parser.ints(self.enrl_hist_late_pat.findall(environment, start, end))
+
+    #------------------------------------
+    # _first_closed
+    #-------------------
+
+    def _first_closed(self, text, anchor, closer):
+        '''
+        Find the first occurrence of anchor that is
+        followed by closer somewhere. Return the start of
+        the text after the anchor, and the position of the
+        first closer after that, or None.
+        '''
+        anchor_pos = text.find(anchor)
+        if anchor_pos < 0:
+            return None
+        start = anchor_pos + len(anchor)
+        end = text.find(closer, start)
+        if end < 0:
+            return None
+        return (start, end)
+
+    #------------------------------------
+    # _last_closed_in_first_line
+    #-------------------
+
+    def _last_closed_in_first_line(self, text, anchor, closer):
+        '''
+        Like _first_closed(), but use the last occurrence
+        of anchor in the first line that contains one, as
+        long as a closer follows it somewhere. If it does
+        not, earlier occurrences in that line are tried.
+        Occurrences in later lines are never used: if the
+        first occurrence has no closer after it, none has.
+        '''
+        first_pos = text.find(anchor)
+        if first_pos < 0:
+            return None
+        line_end = text.find('\n', first_pos)
+        if line_end < 0:
+            line_end = len(text)
+        anchor_pos = text.rfind(anchor, first_pos, line_end)
+        while anchor_pos >= first_pos:
+            start = anchor_pos + len(anchor)
+            end = text.find(closer, start)
+            if end >= 0:
+                return (start, end)
+            # Closers between an earlier occurrence
+            # and this one count for the earlier one:
+            anchor_pos = text.rfind(anchor, first_pos, anchor_pos + len(anchor) - 1)
+        return None
@@ -0,0 +1,309 @@
+'''
+Created on Oct 18, 2026
+
+Decides when the cleaner's buffers are flushed, based
+on their approximate size in bytes rather than on fixed
+row counts alone.
+
+Without a coordinator, each buffer is flushed when it
+holds DB_BATCH_SIZE_BIG or DB_BATCH_SIZE_SMALL rows. But
+rows differ widely in size: 1,000 CrseSearches rows with
+long result lists are larger than 20,000 Pins pairs, and
+may exceed the server's max_allowed_packet. The
+FlushCoordinator instead:
+
+    o estimates the size of each buffered row as it would
+      be sent to the server,
+    o flushes a buffer once its batch size in rows is
+      reached, or its bytes approach max_allowed_packet,
+    o flushes the largest buffers first when all buffers
+      together exceed one memory budget,
+    o adjusts each table's batch size after every insert,
+      so that inserts take about TARGET_FLUSH_SECS.
+
+Insert latencies are reported by the sinks, possibly
+from an AsyncTableSink's writer thread. Each report only
+replaces one table's batch size, which needs no lock.
+'''
+
+from logging_service import LoggingService
+
+
+class BufferState:
+    '''
+    What the coordinator knows about one buffer.
+    '''
+
+    __slots__ = ('buf', 'table', 'num_rows', 'nbytes', 'fixed_row_bytes',
+                 'batch_rows', 'max_rows', 'num_flushes')
+
+    def __init__(self, buf, table, fixed_row_bytes, batch_rows, max_rows):
+        self.buf = buf
+        self.table = table
+        self.num_rows = 0
+        self.nbytes = 0
+        self.fixed_row_bytes = fixed_row_bytes
+        self.batch_rows = batch_rows
+        self.max_rows = max_rows
+        self.num_flushes = 0
+
+
+class FlushCoordinator:
+    '''
+    Used by the cleaner like this:
+
+        coordinator = FlushCoordinator(memory_budget=128 * 1024**2)
+        coordinator.register(buf, 'Pins', ('q', 'q'))
+            ...
+        buf.append(row)
+        for buf_to_flush in coordinator.added(buf, row):
+            ... write buf_to_flush, and truncate it ...
+            coordinator.flushed(buf_to_flush)
+
+    and by the sinks, after each insert:
+
+        coordinator.record_flush('Pins', num_rows, secs)
+    '''
+
+    # Default budget for all buffers together, in bytes:
+    MEMORY_BUDGET = 128 * 1024 * 1024
+
+    # Default max_allowed_packet of MySQL 5.7; replaced
+    # by the server's value once connected:
+    MAX_PACKET_BYTES = 4 * 1024 * 1024
+
+    # Batches are kept below this fraction of the packet
+    # size, leaving room for escaping and the statement:
+    PACKET_FRACTION = 0.5
+
+    # Inserts should take about this long; shorter
+    # ones grow the batch size, longer ones shrink it:
+    TARGET_FLUSH_SECS = 1.0
+
+    # Bounds of adapted batch sizes; the upper bound is
+    # a multiple of each buffer's capacity:
+    MIN_BATCH_ROWS = 100
+    MAX_BATCH_FACTOR = 4
+
+    # Estimated bytes of values in an INSERT statement,
+    # including separators:
+    INT_BYTES = 10
+    NULL_BYTES = 6
+    STR_OVERHEAD_BYTES = 4
+    ROW_OVERHEAD_BYTES = 4
+
+    # Returned by added() if nothing is to be flushed:
+    _NOTHING = ()
+
+    #------------------------------------
+    # Constructor
+    #-------------------
+
+    def __init__(self, memory_budget=None, max_packet_bytes=None, target_flush_secs=None):
+        '''
+        :param memory_budget: bytes all buffers may hold together
+        :type memory_budget: {None | int}
+        :param max_packet_bytes: the server's max_allowed_packet
+        :type max_packet_bytes: {None | int}
+        :param target_flush_secs: desired duration of one insert
+        :type target_flush_secs: {None | float}
+        '''
+        self.log = LoggingService()
+        self.memory_budget = self.MEMORY_BUDGET if memory_budget is None else memory_budget
+        self.max_packet_bytes = self.MAX_PACKET_BYTES if max_packet_bytes is None else max_packet_bytes
+        self.target_flush_secs = self.TARGET_FLUSH_SECS if target_flush_secs is None else target_flush_secs
+
+        # Buffer --> BufferState, and table --> BufferState:
+        self.states = {}
+        self.table_states = {}
+        # Bytes in all buffers together:
+        self.total_bytes = 0
+        # Number of times the budget forced flushes:
+        self.num_budget_flushes = 0
+
+    #------------------------------------
+    # max_packet_bytes
+    #-------------------
+
+    @property
+    def max_packet_bytes(self):
+        return self._max_packet_bytes
+
+    @max_packet_bytes.setter
+    def max_packet_bytes(self, num_bytes):
+        self._max_packet_bytes = num_bytes
+        # Largest batch a buffer may accumulate:
+        self.max_batch_bytes = int(num_bytes * self.PACKET_FRACTION)
+
+    #------------------------------------
+    # register
+    #-------------------
+
+    def register(self, buf, table, typecodes):
+        '''
+        Start tracking a buffer. Buffers whose columns are
+        all ints have a fixed row size; the rows of all
+        others are measured as they are added.
+
+        :param buf: the buffer
+        :type buf: {BufferClass | ColumnarBuffer}
+        :param table: table the buffer is flushed to
+        :type table: str
+        :param typecodes: 'q' for each int column, None for others
+        :type typecodes: ({None | str})
+        '''
+        if all(typecode == 'q' for typecode in typecodes):
+            fixed_row_bytes = self.ROW_OVERHEAD_BYTES + self.INT_BYTES * len(typecodes)
+        else:
+            fixed_row_bytes = None
+        state = BufferState(buf,
+                            table,
+                            fixed_row_bytes,
+                            buf.capacity,
+                            max(buf.capacity * self.MAX_BATCH_FACTOR, self.MIN_BATCH_ROWS))
+        self.states[buf] = state
+        self.table_states[table] = state
+
+    #------------------------------------
+    # added
+    #-------------------
+
+    def added(self, buf, row):
+        '''
+        Account for one row that was appended to buf,
+        and return the buffers that are to be flushed now,
+        largest first.
+
+        :param buf: buffer the row was appended to
+        :type buf: {BufferClass | ColumnarBuffer}
+        :param row: the appended row
+        :type row: tuple
+        :rtype: ({BufferClass | ColumnarBuffer})
+        '''
+        state = self.states[buf]
+        row_bytes = state.fixed_row_bytes
+        if row_bytes is None:
+            row_bytes = self.row_bytes(row)
+        return self._grown(state, 1, row_bytes)
+
+    #------------------------------------
+    # added_pairs
+    #-------------------
+
+    def added_pairs(self, buf, num_pairs):
+        '''
+        Like added(), for num_pairs rows of two
+        int columns, as added by extend_pairs().
+        '''
+        state = self.states[buf]
+        row_bytes = self.ROW_OVERHEAD_BYTES + 2 * self.INT_BYTES
+        return self._grown(state, num_pairs, num_pairs * row_bytes)
+
+    #------------------------------------
+    # flushed
+    #-------------------
+
+    def flushed(self, buf):
+        '''
+        Note that the given buffer was emptied.
+        '''
+        state = self.states[buf]
+        if state.num_rows > 0:
+            state.num_flushes += 1
+        self.total_bytes -= state.nbytes
+        state.nbytes = 0
+        state.num_rows = 0
+
+    #------------------------------------
+    # record_flush
+    #-------------------
+
+    def record_flush(self, table, num_rows, secs):
+        '''
+        Adjust the batch size of the given table after an
+        insert of num_rows took secs. The new size moves
+        half way towards the number of rows that would
+        take target_flush_secs at the measured rate.
+        Called by sinks, possibly from a writer thread.
+
+        :param table: table that was inserted into
+        :type table: str
+        :param num_rows: number of rows inserted
+        :type num_rows: int
+        :param secs: duration of the insert
+        :type secs: float
+        '''
+        try:
+            state = self.table_states[table]
+        except KeyError:
+            return
+        if num_rows == 0 or secs <= 0:
+            return
+        target_rows = num_rows * self.target_flush_secs / secs
+        batch_rows = int((state.batch_rows + target_rows) / 2)
+        state.batch_rows = min(max(batch_rows, self.MIN_BATCH_ROWS), state.max_rows)
+
+    #------------------------------------
+    # row_bytes
+    #-------------------
+
+    def row_bytes(self, row):
+        '''
+        Estimate the size of a row's values in
+        an INSERT statement. Strings count with
+        their UTF-8 length, as sent to the server.
+        '''
+        num_bytes = self.ROW_OVERHEAD_BYTES
+        for val in row:
+            if type(val) == str:
+                num_bytes += (len(val) if val.isascii() else len(val.encode('utf8'))) + self.STR_OVERHEAD_BYTES
+            elif val is None:
+                num_bytes += self.NULL_BYTES
+            else:
+                num_bytes += self.INT_BYTES
+        return num_bytes
+
+    #------------------------------------
+    # report
+    #-------------------
+
+    def report(self):
+        for table, state in sorted(self.table_states.items()):
+            self.log.info(f"Batch size for {table}: {state.batch_rows} rows "
+                          f"after {state.num_flushes} flushes")
+        if self.num_budget_flushes > 0:
+            self.log.info(f"Memory budget of {self.memory_budget} bytes forced "
+                          f"{self.num_budget_flushes} early flushes")
+
+    #------------------------------------
+    # _grown
+    #-------------------
+
+    def _grown(self, state, num_rows, num_bytes):
+        state.num_rows += num_rows
+        state.nbytes += num_bytes
+        self.total_bytes += num_bytes
+        if state.num_rows >= state.batch_rows or state.nbytes >= self.max_batch_bytes:
+            return (state.buf,)
+        if self.total_bytes >= self.memory_budget:
+            return self._largest_first()
+        return self._NOTHING
+
+    #------------------------------------
+    # _largest_first
+    #-------------------
+
+    def _largest_first(self):
+        '''
+        Return the largest buffers whose flushing brings
+        the total down to half the budget.
+        '''
+        self.num_budget_flushes += 1
+        to_flush = []
+        remaining = self.total_bytes
+        for state in sorted(self.states.values(), key=lambda state: state.nbytes, reverse=True):
+            if remaining <= self.memory_budget / 2 or state.nbytes == 0:
+                break
+            to_flush.append(state.buf)
+            remaining -= state.nbytes
+        return to_flush
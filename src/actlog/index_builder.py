@@ -0,0 +1,144 @@
+'''
+Created on Oct 18, 2026
+
+Builds the indexes of the activity log tables after
+the ingest, using a small pool of db connections. All
+indexes of one table are built on the same connection,
+one after the other, so that a MyISAM table is never
+altered by two connections at once. Different tables are
+indexed concurrently, largest table first.
+
+Which indexes already exist, and how large each table
+is, is asked of the db backend once up front.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from logging_service import LoggingService
+
+from actlog.db_backends import index_covers
+
+
+class IndexBuilder:
+    '''
+    Creates missing indexes, given specs of the form
+
+        (index_name, table_name, column_names)
+
+    where column_names is a string as it would appear
+    between parentheses in CREATE INDEX, like 'row_id'
+    or 'row_id, subject'.
+    '''
+
+    # Number of concurrent connections:
+    POOL_SIZE = 4
+
+    #------------------------------------
+    # Constructor
+    #-------------------
+
+    def __init__(self, connect, index_specs, pool_size=None, prepare=None):
+        '''
+        :param connect: callable without arguments that returns a
+            new db connection
+        :type connect: callable
+        :param index_specs: (index_name, table_name, column_names) triplets
+        :type index_specs: [(str, str, str)]
+        :param pool_size: max number of tables indexed concurrently
+        :type pool_size: {None | int}
+        :param prepare: optional callable that is given each new
+            connection, e.g. to set session variables
+        :type prepare: {None | callable}
+        '''
+        self.log = LoggingService()
+        self.connect = connect
+        self.index_specs = index_specs
+        self.pool_size = self.POOL_SIZE if pool_size is None else pool_size
+        self.prepare = prepare
+
+        # Connections used by the pool threads:
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    #------------------------------------
+    # build
+    #-------------------
+
+    def build(self):
+        '''
+        Create all indexes that do not exist yet, and
+        return how long each took.
+
+        :return: (table_name, index_name, seconds) for each
+            created index; grouped by table, largest table
+            first, and within a table in the order of the specs
+        :rtype: [(str, str, float)]
+        '''
+        db = self.connect()
+        try:
+            existing = db.index_columns()
+            table_sizes = db.table_sizes()
+        finally:
+            db.close()
+
+        # Table name --> specs of indexes to create:
+        todo = {}
+        for idx_nm, tbl_nm, col_nm in self.index_specs:
+            if tbl_nm not in table_sizes:
+                self.log.warn(f"Table {tbl_nm} does not exist; not creating index {idx_nm}")
+                continue
+            if index_covers(existing.get(tbl_nm, []), col_nm):
+                continue
+            todo.setdefault(tbl_nm, []).append((idx_nm, col_nm))
+
+        # Largest tables first, so that they do not
+        # end up running alone at the end:
+        tables = sorted(todo.keys(), key=lambda tbl_nm: table_sizes[tbl_nm], reverse=True)
+
+        durations = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+                futures = [pool.submit(self._build_table_indexes, tbl_nm, todo[tbl_nm])
+                           for tbl_nm in tables]
+                for future in futures:
+                    durations.extend(future.result())
+        finally:
+            for db in self._connections:
+                db.close()
+            self._connections = []
+        return durations
+
+    #------------------------------------
+    # _build_table_indexes
+    #-------------------
+
+    def _build_table_indexes(self, tbl_nm, specs):
+        db = self._thread_connection()
+        durations = []
+        for idx_nm, col_nm in specs:
+            self.log.info(f"Creating index {idx_nm} on {tbl_nm}({col_nm})...")
+            start = time.time()
+            db.create_index(idx_nm, tbl_nm, col_nm)
+            duration = time.time() - start
+            self.log.info(f"Index {idx_nm} on {tbl_nm}({col_nm}) took {duration:.1f}s")
+            durations.append((tbl_nm, idx_nm, duration))
+        return durations
+
+    #------------------------------------
+    # _thread_connection
+    #-------------------
+
+    def _thread_connection(self):
+        try:
+            return self._local.db
+        except AttributeError:
+            db = self.connect()
+            if self.prepare is not None:
+                self.prepare(db)
+            self._local.db = db
+            with self._connections_lock:
+                self._connections.append(db)
+            return db
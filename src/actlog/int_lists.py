@@ -0,0 +1,157 @@
+'''
+Created on Oct 18, 2026
+
+Parses and formats the bracketed integer lists that
+occur throughout the activity log, like
+
+    '[102794, 105644, 105645]'     enrollment history
+    '1156:208582, 1162:120904'     early context pins
+    ['213685', '213686']           crs_ids found by a regex
+
+The lists are split and converted with str.split()
+and int(), which run in C, instead of eval(). Malformed
+input is counted, and yields None, rather than raising
+in the middle of an ingest.
+'''
+
+from array import array
+
+
+class IntListParser:
+    '''
+    Shared by the cleaner, and its EnvironmentScanner:
+
+        parser = IntListParser()
+        parser.parse('[102794, 105644]')  --> array('q', [102794, 105644])
+        parser.parse('[1, Foo]')          --> None; parser.num_malformed is 1
+        parser.format(['213685', '213686']) --> '[213685, 213686]'
+    '''
+
+    # Type code of the arrays returned by parse():
+    TYPECODE = 'q'
+
+    #------------------------------------
+    # Constructor
+    #-------------------
+
+    def __init__(self):
+        # Number of lists or pairs that could
+        # not be parsed:
+        self.num_malformed = 0
+
+    #------------------------------------
+    # parse
+    #-------------------
+
+    def parse(self, list_text):
+        '''
+        Return the ints of a bracketed, comma separated
+        list. Whitespace around the elements, and one
+        trailing comma are allowed, as they were by eval().
+
+        :param list_text: text like '[102794, 105644]'
+        :type list_text: {str | bytes}
+        :return: the ints, or None if list_text is malformed
+        :rtype: {None | array}
+        '''
+        list_text = list_text.strip()
+        if len(list_text) < 2 or list_text[:1] not in ('[', b'[') or list_text[-1:] not in (']', b']'):
+            self.num_malformed += 1
+            return None
+        return self.parse_elements(list_text[1:-1])
+
+    #------------------------------------
+    # parse_elements
+    #-------------------
+
+    def parse_elements(self, elements_text):
+        '''
+        Like parse(), but for the text between the
+        brackets.
+
+        :param elements_text: text like '102794, 105644'
+        :type elements_text: {str | bytes}
+        :rtype: {None | array}
+        '''
+        elements = elements_text.split(',' if type(elements_text) == str else b',')
+        # '[]', or a trailing comma:
+        if len(elements[-1].strip()) == 0:
+            elements.pop()
+        try:
+            return array(self.TYPECODE, map(int, elements))
+        except (ValueError, OverflowError):
+            self.num_malformed += 1
+            return None
+
+    #------------------------------------
+    # parse_pairs
+    #-------------------
+
+    def parse_pairs(self, pairs_text, sep=':'):
+        '''
+        Return the int pairs of a comma separated list
+        of sep separated pairs. Empty elements are skipped.
+        Malformed pairs are counted, and skipped as well.
+
+        :param pairs_text: text like '1156:208582, 1162:120904'
+        :type pairs_text: str
+        :param sep: separator within each pair
+        :type sep: str
+        :rtype: [(int, int)]
+        '''
+        pairs = []
+        for pair_text in pairs_text.split(','):
+            if len(pair_text) == 0:
+                continue
+            try:
+                first, second = pair_text.split(sep)
+                pairs.append((int(first), int(second)))
+            except ValueError:
+                self.num_malformed += 1
+        return pairs
+
+    #------------------------------------
+    # ints
+    #-------------------
+
+    def ints(self, digit_strs):
+        '''
+        Convert strings of digits, as returned by
+        a regex findall(), into ints.
+
+        :rtype: [int]
+        '''
+        return list(map(int, digit_strs))
+
+    #------------------------------------
+    # format
+    #-------------------
+
+    def format(self, digit_strs):
+        '''
+        Return the text str() would produce for the
+        list of ints in digit_strs, without building the
+        list: ['0123', '456'] --> '[123, 456]'
+
+        The strings are joined as they are, unless one
+        has a leading zero, which int() would drop.
+
+        :param digit_strs: strings of digits only, as
+            captured by a regex like '[0-9]{6}'
+        :type digit_strs: [str]
+        :rtype: str
+        '''
+        joined = ', '.join(digit_strs)
+        if joined[:1] == '0' or ', 0' in joined:
+            joined = ', '.join(map(str, map(int, digit_strs)))
+        return '[' + joined + ']'
+
+    #------------------------------------
+    # format_zeros
+    #-------------------
+
+    def format_zeros(self, count):
+        '''
+        Return str([0] * count), without building the list.
+        '''
+        return '[' + ', '.join('0' * count) + ']'
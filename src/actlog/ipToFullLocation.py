@@ -15,22 +15,62 @@ does no harm.
 
 The out-facing method is lookupIP(ipString)
 
+Run as a script, the module geolocates a file of addresses, 
+one per line, or in a named column of a tsv or csv file:
+
+    ipToFullLocation.py [-c ip_col] [-d ,] [-o located.tsv] [ips.tsv]
+
+Lookups binary search a sorted array of all range starts,
+which takes O(log n) steps for any address. The ranges are
+held column by column in self.rangeColumns, with each 
+distinct string stored once; the location tuple of a range
+is only built when the range is looked up. See 
+ip_table_file.py.
+
+The table is built from the csv file, and saved in ipTable.bin,
+in a binary format that is mapped into memory rather than 
+unpickled. The file is stamped with the csv file's size, 
+modification time, and hash; once the csv file changes, 
+the table is rebuilt. Without csv and table file, the legacy
+ipDict.pickle is loaded, which buckets the range tuples by 
+the first four decimal digits of their start. ipDict is 
+released once the columns are built.
+
+Many addresses are resolved at once by lookup_many() or
+lookup_ints(), which return the index of each address's 
+range, and by locations(), which turns the indexes into 
+location tuples. With NumPy, all ranges are found by one
+searchsorted().
+
 The underlying IP->FullLOcation information comes from http://software77.net/geo-ip/,
 and is expected to be in data/IP-COUNTRY-REGION-CITY-LATITUDE-LONGITUDE-ZIPCODE-TIMEZONE-AREACODE.CSV
 
 @author: paepcke
 '''
 
+from array import array
+import argparse
+from bisect import bisect_right
 import csv
-from io import TextIOWrapper
+from itertools import islice, repeat
+from operator import itemgetter
 import os
 from pathlib import Path
 import pickle
 import sys
-from zipfile import ZipFile
+import time
+import warnings
 
 from logging_service import LoggingService
 
+from actlog.ip_table_file import IpRangeColumns, IpTableFile
+
+# NumPy is optional; batch lookups use it if present:
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 class IpFullLocation:
     '''
@@ -51,129 +91,342 @@ class IpFullLocation:
     
     XLATION_CSV = 'IP-COUNTRY-REGION-CITY-LATITUDE-LONGITUDE-ZIPCODE-TIMEZONE-AREACODE.CSV'
 
+    # The commercial csv file, relative to this script:
+    DEFAULT_SOURCE = '../../data/DB15-IP-COUNTRY-REGION-CITY-LATITUDE-LONGITUDE-ZIPCODE-TIMEZONE-AREACODE_CommercialLicense.CSV.ZIP'
+
+    # Binary table built from the csv file:
+    TABLE_FILE = 'ipTable.bin'
+    
+    # Names of the columns that geolocate_stream() 
+    # appends, as in the IpLocation table:
+    LOCATION_COLS = ('country_code', 'country', 'state', 'city', 'lat', 'longitude', 
+                     'zip', 'time_zone', 'country_phone', 'area_code')
+    
+    # Lines that geolocate_stream() looks up at a time,
+    # and between reports of its progress:
+    BATCH_SIZE = 10000
+    REPORT_EVERY = 1000000
+
+    # Range index of addresses without a location
+    # in batch lookups:
+    NOT_FOUND = -1
+    
+    # Stands in for malformed addresses in batch lookups;
+    # beyond all ranges:
+    NOT_AN_IP = 2**32
+
 
     #--------------------------
     # Constructor 
     #----------------
 
-    def __init__(self, ipTablePath=None):
+    def __init__(self, ipTablePath=None, tableFilePath=None, numWorkers=None):
         '''
-        Create an in-memory dict for quickly looking up IP addresses.
+        Create an in-memory table for quickly looking up IP addresses.
         The underlying IP->Country information comes from http://software77.net/geo-ip/
-        If an unzipped table from their Web site is not passed in, then 
-        the table is expected to reside in subdirectory 'data' of this script's directory
-        under the name IpFullLocation.XLATION_CSV. Their table contains
-        columns for (decimal)startRange, endRange, and the other values.
+        If a table from their Web site is not passed in, then the
+        (zipped) table is expected at DEFAULT_SOURCE, relative to
+        this script's directory. Their table contains columns for 
+        (decimal)startRange, endRange, and the other values.
         
-        The lookup table we construct uses the first four digits of the 
-        starting ranges as key. Values are an array of tuples:
-            (startIpRange,endIPRange,2-letterCode,3-letterCode,Country)
-        All IPs in one key's values thus start with the key's digits.
-        The arrays are just a few tuples long, so the scan through them
-        is fast. The arrays are ordered by rising start and (therefore)
-        end IP.
+        The table is built from the csv file into self.rangeColumns, 
+        and saved in the binary table file at tableFilePath, stamped
+        with the csv file's size, modification time, and hash. Later 
+        instances map that file into memory instead, as long as the
+        csv file has not changed since; otherwise they rebuild the 
+        table file. Lacking both files, the legacy ipDict.pickle
+        is loaded, if it exists.
         
-        We also construct a simpler dict that maps a country's three-letter
-        code to a tuple: (two-letter code, three-letter code, full country name).
+        If ipTablePath is a binary table file, that file is opened 
+        without looking for a csv file.
+        
+        We also construct a simpler dict that maps a country's two-letter
+        code to a tuple: (two-letter code, full country name, region, city).
+        
+        :param ipTablePath: csv, zip, or table file; None for DEFAULT_SOURCE
+        :type ipTablePath: {None | str}
+        :param tableFilePath: table file to use, and to write after a
+            build; None for TABLE_FILE next to this script
+        :type tableFilePath: {None | str}
+        :param numWorkers: number of processes that parse the csv 
+            file; None for one per core
+        :type numWorkers: {None | int}
         '''
         
         self.log = LoggingService()
         cur_dir = os.path.dirname(__file__)
-        # Paths to pickled dict files:
-        ip_dict_path = os.path.join(cur_dir, 'ipDict.pickle')
-        two_letter_dict_path = os.path.join(cur_dir, 'twoLetterKeyedDict.pickle')
-        
-        currKey = 0
-        self.ipDict = {currKey : []}
-        self.twoLetterKeyedDict = {}
+        if tableFilePath is None:
+            tableFilePath = os.path.join(cur_dir, IpFullLocation.TABLE_FILE)
+        self.ipDict = None
+        if ipTablePath is not None and Path(ipTablePath).suffix == '.bin':
+            self.openTableFile(ipTablePath)
+            return
         if ipTablePath is None:
-            # Check for presence of ipDict.pickle and 
-            # self.twoLetterKeyedDict.pickle. If they exist,
-            # load them, and we are done:
-            if os.path.exists(ip_dict_path) and os.path.exists(two_letter_dict_path):
-                for path in (ip_dict_path, two_letter_dict_path):
-                    try:
-                        with open(path, 'rb') as fd:
-                            if path == ip_dict_path:
-                                self.ipDict = pickle.load(fd)
-                            else:
-                                self.twoLetterKeyedDict = pickle.load(fd)
-                    except Exception as e:
-                        self.log.info(f"Tried to load pickled dicts, but failed: {repr(e)}")
-                    else:
-                        return
-            # No pickled dicts available, read from (possibly zipped) csv file:
-            ipTablePath  = os.path.join(
-                cur_dir,
-                '../../data/DB15-IP-COUNTRY-REGION-CITY-LATITUDE-LONGITUDE-ZIPCODE-TIMEZONE-AREACODE_CommercialLicense.CSV.ZIP')
-            if not os.path.exists(ipTablePath):
-                self.log.err(f"Could not load dicts from pickle, nor csv file at {ipTablePath}. Quitting")
-                sys.exit(1)
-
-        # Have path to (possibly zipped) csv file: find
-        # which it is, and create an fd to the csv file:
-        tbl_path = Path(ipTablePath)
-        if tbl_path.suffix in ('.zip', '.ZIP'):
-            zip_file = ZipFile(ipTablePath)
-            csv_fd   = zip_file.open('IP-COUNTRY-REGION-CITY-LATITUDE-LONGITUDE-ZIPCODE-TIMEZONE-AREACODE.CSV')
+            ipTablePath = os.path.join(cur_dir, IpFullLocation.DEFAULT_SOURCE)
+
+        if os.path.exists(tableFilePath):
+            try:
+                tableFile = IpTableFile(tableFilePath)
+            except ValueError as e:
+                self.log.warn(f"Rebuilding IP table file: {e}")
+            else:
+                if not os.path.exists(ipTablePath) or tableFile.is_built_from(ipTablePath):
+                    self.useTableFile(tableFile)
+                    return
+                self.log.info(f"IP table file {tableFilePath} is outdated; rebuilding from {ipTablePath}")
+        elif not os.path.exists(ipTablePath):
+            self.loadPickles(cur_dir)
+            return
+        self.buildTableFile(ipTablePath, tableFilePath, numWorkers)
+
+    #--------------------------
+    # buildTableFile 
+    #----------------
+
+    def buildTableFile(self, csvPath, tableFilePath, numWorkers=None):
+        '''
+        Build the table from the (possibly zipped) csv file,
+        and save it at tableFilePath, stamped with the csv 
+        file's identity.
+        :param csvPath: csv or zip file of the IP database
+        :type csvPath: str
+        :param tableFilePath: table file to write
+        :type tableFilePath: str
+        :param numWorkers: number of processes that parse the 
+            csv file; None for one per core
+        :type numWorkers: {None | int}
+        '''
+        self.log.info(f"Building IP table from {csvPath}...")
+        startTime = time.time()
+        self.version = IpTableFile.stamp_of(csvPath)
+        rangeColumns = IpRangeColumns.from_csv(csvPath, member=IpFullLocation.XLATION_CSV, num_workers=numWorkers)
+        self.useRangeColumns(rangeColumns)
+        self.twoLetterKeyedDict = rangeColumns.two_letter_keyed_dict()
+        self.log.info(f"Built IP table of {len(rangeColumns)} ranges in {time.time() - startTime:.1f}s")
+        try:
+            IpTableFile.write(rangeColumns, tableFilePath, source_stamp=self.version)
+        except OSError as e:
+            self.log.warn(f"Could not save IP table file {tableFilePath}: {repr(e)}")
         else:
-            zip_file = None
-            csv_fd = open(tbl_path, 'r')
+            self.log.info(f"Saved IP table to {tableFilePath}")
+
+    #--------------------------
+    # loadPickles 
+    #----------------
+
+    def loadPickles(self, pickleDir):
+        '''
+        Load the table from ipDict.pickle, as saved by earlier
+        versions. Nothing tells whether the pickle is current.
+        Exits if there is no pickle.
+        :param pickleDir: directory of the pickle
+        :type pickleDir: str
+        '''
+        ip_dict_path = os.path.join(pickleDir, 'ipDict.pickle')
+        try:
+            with open(ip_dict_path, 'rb') as fd:
+                self.ipDict = pickle.load(fd)
+        except Exception as e:
+            self.log.err(f"Could not load the IP table from csv, table file, nor {ip_dict_path}: {repr(e)}. Quitting")
+            sys.exit(1)
+        self.log.warn(f"Loaded IP table from {ip_dict_path}, which may be outdated")
+        self.version = self.sourceVersion(ip_dict_path)
+        self.buildRangeIndex()
+        self.ipDict = None
+        self.twoLetterKeyedDict = self.rangeColumns.two_letter_keyed_dict()
+
+    #--------------------------
+    # fromRanges 
+    #----------------
+
+    @classmethod
+    def fromRanges(cls, ranges):
+        '''
+        Create a table from range tuples like those in
+        ipDict, without reading any file:
+            (startIP, endIP, twoLetterCountry, country, state, city,
+             latitude, longitude, zipcode, timezone, 
+             country_phone_code, area_code)
+        Used for tests, and benchmarks.
+        :param ranges: the range tuples
+        :type ranges: iterable(tuple)
+        :return: new table
+        :rtype: IpFullLocation
+        '''
+        ipTable = cls.__new__(cls)
+        ipTable.log = LoggingService()
+        ipTable.version = None
+        ipTable.ipDict = None
+        ipTable.useRangeColumns(IpRangeColumns.from_ranges(sorted(ranges, 
+                                                                  key=itemgetter(IpFullLocation.START_IP_POS))))
+        ipTable.twoLetterKeyedDict = ipTable.rangeColumns.two_letter_keyed_dict()
+        return ipTable
+
+    #--------------------------
+    # buildRangeIndex 
+    #----------------
+
+    def buildRangeIndex(self):
+        '''
+        Create the columns used by lookupIP() from the 
+        range tuples in ipDict, sorted by start. 
+        self.rangeStarts and self.rangeEnds are the first
+        and last addresses of the ranges.
+        '''
+        ranges = sorted((ipInfo for chain in self.ipDict.values() for ipInfo in chain),
+                        key=itemgetter(IpFullLocation.START_IP_POS))
+        self.useRangeColumns(IpRangeColumns.from_ranges(ranges))
+
+    #--------------------------
+    # useRangeColumns 
+    #----------------
+
+    def useRangeColumns(self, rangeColumns):
+        '''
+        Look up addresses in the given columns.
+        :param rangeColumns: the ranges, sorted by start
+        :type rangeColumns: IpRangeColumns
+        '''
+        self.rangeColumns = rangeColumns
+        self.rangeStarts = rangeColumns.starts
+        self.rangeEnds = rangeColumns.ends
+
+    #--------------------------
+    # openTableFile 
+    #----------------
+
+    def openTableFile(self, tableFilePath):
+        '''
+        Map a binary table file, written by IpTableFile.write(),
+        into memory, and look up addresses in it.
+        :param tableFilePath: path to the table file
+        :type tableFilePath: str
+        '''
+        self.useTableFile(IpTableFile(tableFilePath))
+
+    #--------------------------
+    # useTableFile 
+    #----------------
+
+    def useTableFile(self, tableFile):
+        '''
+        Look up addresses in an opened table file.
+        :param tableFile: the table file
+        :type tableFile: IpTableFile
+        '''
+        self.version = tableFile.source_stamp
+        if self.version is None:
+            self.version = self.sourceVersion(tableFile.path)
+        self.useRangeColumns(tableFile)
+        self.twoLetterKeyedDict = tableFile.two_letter_keyed_dict()
+
+    #--------------------------
+    # lookup_many 
+    #----------------
+
+    def lookup_many(self, ip_strs):
+        '''
+        Find the ranges of many IP addresses at once.
+        Malformed addresses, like 'NULL', are not found.
+        :param ip_strs: IP strings like '171.64.75.72'
+        :type ip_strs: [str]
+        :return: for each address the index of its range
+            in the table, or NOT_FOUND
+        :rtype: {np.ndarray | array}
+        '''
+        return self.lookup_ints(self.ip_strs_to_ints(ip_strs))
+
+    #--------------------------
+    # lookup_ints 
+    #----------------
+
+    def lookup_ints(self, ip_ints):
+        '''
+        Like lookup_many(), for addresses that are ints
+        already, like the ip_ints returned by ip_strs_to_ints().
+        Uses one searchsorted() if NumPy is available, else 
+        one bisect per address.
+        :param ip_ints: numeric IP addresses
+        :type ip_ints: {np.ndarray | array | [int]}
+        :return: for each address the index of its range
+            in the table, or NOT_FOUND
+        :rtype: {np.ndarray | array}
+        '''
+        if np is None:
+            starts = self.rangeStarts
+            ends = self.rangeEnds
+            not_found = IpFullLocation.NOT_FOUND
+            # bisect_right() returns the index after the range:
+            return array('q', [range_end_idx - 1 if range_end_idx > 0 and ip_int <= ends[range_end_idx - 1] 
+                               else not_found
+                               for range_end_idx, ip_int 
+                               in zip(map(bisect_right, repeat(starts), ip_ints), ip_ints)])
         
-        # Start huffing:
-        self.log.info("Reading csv and processing file...")
+        # Views of the range arrays, without copying:
+        starts = np.frombuffer(self.rangeStarts, dtype=np.uint32)
+        ends = np.frombuffer(self.rangeEnds, dtype=np.uint32)
+        ip_ints = np.asarray(ip_ints, dtype=np.int64)
+        # Searching uint32 avoids converting the starts: 
+        in_ip_space = (ip_ints >= 0) & (ip_ints < 2**32)
+        range_idxs = np.searchsorted(starts, 
+                                     np.where(in_ip_space, ip_ints, 0).astype(np.uint32), 
+                                     side='right') - 1
+        found = in_ip_space & (range_idxs >= 0)
+        found &= ip_ints <= ends[np.maximum(range_idxs, 0)]
+        return np.where(found, range_idxs, IpFullLocation.NOT_FOUND)
+
+    #--------------------------
+    # locations 
+    #----------------
+
+    def locations(self, range_idxs, default=None):
+        '''
+        Turn the range indexes of a batch lookup into
+        the tuples lookupIP() returns.
+        :param range_idxs: as returned by lookup_many()
+        :type range_idxs: {np.ndarray | array}
+        :param default: value for addresses that were not found
+        :type default: <any>
+        :return: one location tuple, or default, per index
+        :rtype: [{tuple | any}]
+        '''
+        location = self.rangeColumns.location
+        return [default if range_idx < 0 else location(range_idx)
+                for range_idx in range_idxs.tolist()]
+
+    #--------------------------
+    # ip_strs_to_ints 
+    #----------------
+
+    def ip_strs_to_ints(self, ip_strs):
+        '''
+        Convert many IP strings to ints, parsing all
+        of them in one go. Malformed addresses become
+        NOT_AN_IP, which is in no range.
+        :param ip_strs: IP strings like '171.64.75.72'
+        :type ip_strs: [str]
+        :return: numeric addresses
+        :rtype: {np.ndarray | array}
+        '''
         try:
-            for line in csv.reader(TextIOWrapper(csv_fd, 'utf8')):
-                if len(line) == 0 or line[0] == '#' or line == '\n' or line[0] == '0':
-                    continue
-                try: 
-                    (startIPStr,endIPStr,twoLetterCountry,country, state, city,
-                     latitude, longitude, zipcode, timezone, country_phone_code, area_code) = line
-                except ValueError as e:
-                    print("Irregularity in IP db line '%s': %s" % (line, repr(e)))
-                    continue
-                # Use first four digits of start ip as hash key:
-                hashKey = startIPStr.strip('"').zfill(10)[0:4]
-                if hashKey != currKey:
-                    self.ipDict[hashKey] = []
-                    currKey = hashKey
-                self.ipDict[hashKey].append((int(startIPStr.strip('"')), 
-                                                       int(endIPStr.strip('"')), 
-                                                       twoLetterCountry.strip('"'), 
-                                                       country.strip('"'), 
-                                                       state.strip('"'),
-                                                       city.strip('"'),
-                                                       float(latitude),
-                                                       float(longitude),
-                                                       zipcode.strip('"'),
-                                                       timezone.strip('"'),
-                                                       country_phone_code.strip('"'),
-                                                       area_code.strip('"')
-                                                       )
-                                                    )
-                self.twoLetterKeyedDict[twoLetterCountry.strip('"')] = (twoLetterCountry.strip('"'), 
-                                                                        country.strip('"'),
-                                                                        state.strip('"'),
-                                                                        city.strip('"')
-                                                                        )
-                
-        finally:
-            self.log.info("Done reading csv and processing file")
-            
-            csv_fd.close()
-            if zip_file is not None:
-                zip_file.close()
-                
-            # Save the computed dicts to pickles:
-            self.log.info(f"Saving ipDict to {ip_dict_path}")
-            with open(ip_dict_path, 'wb') as fd:
-                pickle.dump(self.ipDict, fd)
-            self.log.info(f"Done saving ipDict.")
-            
-            self.log.info(f"Saving twoLetterKeyedDict to {two_letter_dict_path}")
-            with open(two_letter_dict_path, 'wb') as fd:
-                pickle.dump(self.twoLetterKeyedDict, fd)
-            self.log.info(f"Done saving twoLetterKeyedDict.")
+            if not all(map((3).__eq__, map(str.count, ip_strs, repeat('.')))):
+                raise ValueError("Not all strings have four octets")
+            if np is None:
+                octets = list(map(int, '.'.join(ip_strs).split('.')))
+                return array('q', map(IpFullLocation._combineOctets, 
+                                      octets[0::4], octets[1::4], octets[2::4], octets[3::4]))
+            with warnings.catch_warnings():
+                # NumPy only warns about text it cannot parse:
+                warnings.simplefilter('error', DeprecationWarning)
+                octets = np.fromstring('.'.join(ip_strs), dtype=np.int64, sep='.')
+            if len(octets) != 4 * len(ip_strs):
+                raise ValueError("Not all octets are numbers")
+        except (ValueError, TypeError, DeprecationWarning):
+            # Convert one by one, to find the bad ones:
+            ip_ints = array('q', map(self._ipStrToIntOrNotAnIp, ip_strs))
+            return ip_ints if np is None else np.frombuffer(ip_ints, dtype=np.int64)
+        octets = octets.reshape(-1, 4)
+        return (octets[:,0] << 24) + (octets[:,1] << 16) + (octets[:,2] << 8) + octets[:,3]
 
     #--------------------------
     #  get
@@ -198,6 +451,25 @@ class IpFullLocation:
         except KeyError:
             return default
 
+    #--------------------------
+    # sourceVersion 
+    #----------------
+
+    @staticmethod
+    def sourceVersion(path):
+        '''
+        Identify the content of the file from which the
+        table is loaded by the file's name, size, and
+        modification time. Caches of lookup results are
+        only valid for one version.
+        :param path: path to pickle or csv file
+        :type path: str
+        :return: version string
+        :rtype: str
+        '''
+        stat = os.stat(path)
+        return f"{os.path.basename(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
     #--------------------------
     # getBy3LetterCode 
     #----------------
@@ -221,47 +493,128 @@ class IpFullLocation:
         :raise ValueError: when given IP address is None
         :raise KeyError: when the country for the given IP is not found. 
         '''
-        (ipNum, lookupKey) = self.ipStrToIntAndKey(ipStr)
-        if ipNum is None or lookupKey is None:
+        ipNum = self.ipStrToInt(ipStr)
+        if ipNum is None:
             raise ValueError("IP string is not a valid IP address: '%s'" % str(ipStr))
-        ipRangeChain = ()
-        while int(lookupKey) > 0:
-            try:
-                ipRangeChain = self.ipDict[lookupKey]
-                if ipRangeChain is None:
-                    raise ValueError("IP string is not a valid IP address: '%s'" % str(ipStr))
-                # Sometimes the correct entry is *lower* than
-                # where the initial lookup key points:
-                if ipRangeChain[0][0] > ipNum:
-                    # Backtrack to an earlier key:
-                    raise KeyError()
-                break
-            except KeyError:
-                lookupKey = str(int(lookupKey) - 1).zfill(4)[0:4]
-                continue
+        # The last range that starts at or before ipNum:
+        rangeIdx = bisect_right(self.rangeStarts, ipNum) - 1
+        if rangeIdx < 0 or ipNum > self.rangeEnds[rangeIdx]:
+            # The IP is before the first range, or in 
+            # a hole of the IP-->Country table:
+            raise KeyError("Ip %s not found in location translator." % ipStr)
+        return self.rangeColumns.location(rangeIdx)
         
-        for ipInfo in ipRangeChain:
-            # Have (rangeStart,rangeEnd,country2Let,country3Let,county)
-            # Sorted by rangeStart:
-            if ipNum > ipInfo[IpFullLocation.END_IP_POS]:
-                continue
-            return(ipInfo[IpFullLocation.TWO_LETTER_POS], 
-                   ipInfo[IpFullLocation.COUNTRY_POS],
-                   ipInfo[IpFullLocation.STATE_POS],
-                   ipInfo[IpFullLocation.CITY_POS],
-                   ipInfo[IpFullLocation.LAT_POS],
-                   ipInfo[IpFullLocation.LONG_POS],
-                   ipInfo[IpFullLocation.ZIP_POS],
-                   ipInfo[IpFullLocation.TIMEZONE_POS],
-                   ipInfo[IpFullLocation.COUNTRY_PHONE_POS],
-                   ipInfo[IpFullLocation.AREA_PHONE_POS]
-                   )
-        # If we get here, the IP is in a range in which
-        # the IP-->Country table has a hole:
-        raise KeyError("Ip %s not found in location translator." % ipStr)
+    #--------------------------
+    # geolocate_stream 
+    #----------------
+
+    def geolocate_stream(self, in_fd, out_fd, ip_col=None, delimiter='\t', batch_size=None):
+        '''
+        Append location columns to lines of IP addresses, 
+        batch_size lines at a time, looked up by lookup_many(). 
+        The input has either one address per line, or, if 
+        ip_col is given, a header line and the address in 
+        column ip_col. The output has a header line with the 
+        names of LOCATION_COLS. Location columns of addresses 
+        that are not found are empty. 
+        :param in_fd: input lines
+        :type in_fd: file
+        :param out_fd: where to write the output
+        :type out_fd: file
+        :param ip_col: name of the column of the addresses;
+            None for one address per line
+        :type ip_col: {None | str}
+        :param delimiter: field delimiter of input and output
+        :type delimiter: str
+        :param batch_size: lines per lookup; None for BATCH_SIZE
+        :type batch_size: {None | int}
+        :return: number of lines geolocated, not counting the header
+        :rtype: int
+        :raise ValueError: if the header has no column ip_col
+        '''
+        if batch_size is None:
+            batch_size = IpFullLocation.BATCH_SIZE
+        writer = csv.writer(out_fd, delimiter=delimiter, lineterminator='\n')
+        if ip_col is None:
+            rows = ([line.strip()] for line in in_fd)
+            header = ['ip']
+            ip_pos = 0
+        else:
+            rows = csv.reader(in_fd, delimiter=delimiter)
+            header = next(rows, [])
+            try:
+                ip_pos = header.index(ip_col)
+            except ValueError:
+                raise ValueError(f"Input has no column '{ip_col}'; columns are {header}")
+        writer.writerow(header + list(IpFullLocation.LOCATION_COLS))
         
+        missing = ('',) * len(IpFullLocation.LOCATION_COLS)
+        num_lines = 0
+        next_report = IpFullLocation.REPORT_EVERY
+        start_time = time.time()
+        while True:
+            batch = list(islice(rows, batch_size))
+            if len(batch) == 0:
+                break
+            ip_strs = [row[ip_pos] if len(row) > ip_pos else '' for row in batch]
+            locations = self.locations(self.lookup_many(ip_strs), default=missing)
+            writer.writerows(row + list(location) for row, location in zip(batch, locations))
+            num_lines += len(batch)
+            if num_lines >= next_report:
+                self._reportRate(num_lines, start_time)
+                next_report += IpFullLocation.REPORT_EVERY
+        self._reportRate(num_lines, start_time)
+        return num_lines
+
+    #--------------------------
+    # _reportRate 
+    #----------------
+
+    def _reportRate(self, numLines, startTime):
+        secs = max(time.time() - startTime, 1e-6)
+        self.log.info(f"Geolocated {numLines} lines in {secs:.1f}s ({numLines / secs:.0f} lines/s)")
+
     # ------------------------------------- Utility Methods ---------------
         
+    #--------------------------
+    # ipStrToInt
+    #----------------
+
+    def ipStrToInt(self, ipStr):
+        '''
+        Given an IP string, return its numeric value.
+        :param ipStr: ip string like '171.64.65.66'
+        :type ipStr: string
+        :return: the ip int, like 2873115970, or None if ipStr
+            does not have four octets
+        :rtype: {None | int}
+        '''
+        try:
+            (oct0,oct1,oct2,oct3) = ipStr.split('.')
+        except ValueError:
+            # Given ip str does not contain four octets:
+            return None
+        return int(oct3) + (int(oct2) << 8) + (int(oct1) << 16) + (int(oct0) << 24)
+
+    #--------------------------
+    # _ipStrToIntOrNotAnIp
+    #----------------
+
+    def _ipStrToIntOrNotAnIp(self, ipStr):
+        try:
+            ipNum = self.ipStrToInt(ipStr)
+        except (ValueError, AttributeError):
+            return IpFullLocation.NOT_AN_IP
+        return IpFullLocation.NOT_AN_IP if ipNum is None else ipNum
+
+    #--------------------------
+    # _combineOctets
+    #----------------
+
+    @staticmethod
+    def _combineOctets(oct0, oct1, oct2, oct3):
+        return (oct0 << 24) + (oct1 << 16) + (oct2 << 8) + oct3
+
     #--------------------------
     # ipStrToIntAndKey
     #----------------
@@ -302,31 +655,47 @@ class IpFullLocation:
         
     #---------------------------- Main ---------------------------
 
-# if __name__ == '__main__':
-#
-#     DEFAULT_DB_FILE = os.path.join(os.path.dirname(__file__), 'data/%s' % IpFullLocation.XLATION_CSV),
-#     parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]), formatter_class=argparse.RawTextHelpFormatter)
-#     parser.add_argument('-d', '--dbfile',
-#                         help='fully qualified name of IP decoding CSV file. Default: %s' % DEFAULT_DB_FILE,
-#                         default=DEFAULT_DB_FILE);
-#     parser.add_argument('-t', '--test',
-#                         help='run a self test',
-#                         action='store_true');
-#     parser.add_argument('ipaddr',
-#                         help='IP address to look up.'
-#                         )
-#
-#     args = parser.parse_args();
-#
-#     if args.test:
-#         IpFullLocation().testAll()
-#         sys.exit()
-#
-#     lookup_dict = IpFullLocation()
-#     (twoLetter,country,region,city,latitude,longitude,zipcode,timezone,phone_country_code,phone_area_code) = lookup_dict.get(args.ipaddr)
-#     print('%s; %s; %s; %s; %s; %s; %s; %s; %s; %s' %\
-#           (twoLetter,country,region,city,latitude,longitude,zipcode,timezone,phone_country_code,phone_area_code)
-#           )
-    
-    
-    
\ No newline at end of file
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]), 
+                                     formatter_class=argparse.RawTextHelpFormatter,
+                                     description="Geolocate IP addresses, one per line, or in a column of a tsv/csv file.\n"
+                                                 "Writes the input with location columns appended."
+                                     )
+    parser.add_argument('-c', '--column',
+                        help='name of the column that holds the addresses; the input then has a header line.\n'
+                             'Default: the input has one address per line',
+                        default=None)
+    parser.add_argument('-d', '--delimiter',
+                        help='field delimiter of input and output; default: tab',
+                        default='\t')
+    parser.add_argument('-b', '--batch',
+                        type=int,
+                        help=f'number of lines looked up together; default: {IpFullLocation.BATCH_SIZE}',
+                        default=None)
+    parser.add_argument('-t', '--table',
+                        help='csv, zip, or table file of the IP database; default: the table file next to this script,\n'
+                             f'or {IpFullLocation.DEFAULT_SOURCE}',
+                        default=None)
+    parser.add_argument('-o', '--output',
+                        help='file to write; default: stdout',
+                        default=None)
+    parser.add_argument('ip_file',
+                        nargs='?',
+                        help='file to geolocate; default: stdin',
+                        default=None)
+
+    args = parser.parse_args()
+
+    ip_table = IpFullLocation(args.table)
+    in_fd = sys.stdin if args.ip_file is None else open(args.ip_file, 'r', newline='')
+    out_fd = sys.stdout if args.output is None else open(args.output, 'w', newline='')
+    try:
+        ip_table.geolocate_stream(in_fd, out_fd, 
+                                  ip_col=args.column, 
+                                  delimiter=args.delimiter, 
+                                  batch_size=args.batch)
+    finally:
+        for fd in (in_fd, out_fd):
+            if fd not in (sys.stdin, sys.stdout):
+                fd.close()
@@ -0,0 +1,268 @@
+'''
+Created on Oct 18, 2026
+
+Memoizes IP address to location lookups. The activity
+log repeats the same campus and ISP addresses hundreds
+of thousands of times, and each IpFullLocation lookup
+splits the address, backtracks over bucket keys, and
+scans a chain of ranges.
+
+An IpLocationCache sits in front of an IpFullLocation,
+and offers the same get() and lookupIP() methods. It
+keeps the most recently used addresses, up to a bound.
+Addresses that are not in the table, and malformed ones
+like 'NULL' are cached as well, as misses.
+
+Optionally the cache is saved to a file at the end of an
+ingest, and loaded by the next one. In parallel ingests,
+the workers' lookups are merged into the parent's cache,
+which saves them once. The file records the
+version of the IP table it was built from; it is ignored
+once the table changes.
+'''
+
+from collections import OrderedDict
+import os
+import pickle
+
+from logging_service import LoggingService
+
+
+class IpLocationCache:
+    '''
+    Used like an IpFullLocation:
+
+        ip_dict = IpLocationCache(IpFullLocation(), cache_path='/tmp/ip_locations.cache')
+        ip_dict.get('171.64.75.72', default=unknown_location)
+            ...
+        ip_dict.report()
+        ip_dict.save()
+
+    A forked copy hands its lookups back to the original:
+
+        ip_dict.merge(forked_ip_dict.new_entries())
+    '''
+
+    # Default number of addresses kept:
+    MAX_ENTRIES = 200000
+
+    # Cached result of addresses without a location:
+    _NOT_FOUND = None
+
+    #------------------------------------
+    # Constructor
+    #-------------------
+
+    def __init__(self, ip_table, max_entries=None, cache_path=None):
+        '''
+        :param ip_table: the table to consult on cache misses
+        :type ip_table: IpFullLocation
+        :param max_entries: number of addresses kept
+        :type max_entries: {None | int}
+        :param cache_path: file from which to load the cache,
+            and to which save() writes it; None for no file
+        :type cache_path: {None | str}
+        '''
+        self.log = LoggingService()
+        self.ip_table = ip_table
+        self.max_entries = self.MAX_ENTRIES if max_entries is None else max_entries
+        self.cache_path = cache_path
+        # IP string --> location tuple, or _NOT_FOUND;
+        # least recently used first:
+        self.entries = OrderedDict()
+        # Cached addresses that were looked up in
+        # ip_table, rather than loaded or merged:
+        self.looked_up = set()
+        self.num_hits = 0
+        self.num_misses = 0
+        # Misses that found no location:
+        self.num_not_found = 0
+        if cache_path is not None:
+            self.load()
+
+    #------------------------------------
+    # version
+    #-------------------
+
+    @property
+    def version(self):
+        '''
+        Version of the underlying IP table, or
+        None if it does not tell.
+        '''
+        return getattr(self.ip_table, 'version', None)
+
+    #------------------------------------
+    # get
+    #-------------------
+
+    def get(self, ip_str, default=None):
+        '''
+        Like IpFullLocation.get(), but malformed addresses
+        return default as well, rather than raising ValueError.
+
+        :param ip_str: IP address, like '171.64.75.72'
+        :type ip_str: str
+        :param default: returned if there is no location for ip_str
+        :type default: any
+        :return: 2-letter country code, country, region, city,
+            lat, long, zipcode, timezone, country_phone_code,
+            area_phone_code; or default
+        :rtype: {tuple | any}
+        '''
+        entries = self.entries
+        try:
+            location = entries[ip_str]
+        except KeyError:
+            location = self._lookup(ip_str)
+            entries[ip_str] = location
+            self.looked_up.add(ip_str)
+            if len(entries) > self.max_entries:
+                self._evict()
+        else:
+            self.num_hits += 1
+            entries.move_to_end(ip_str)
+        if location is self._NOT_FOUND:
+            return default
+        return location
+
+    #------------------------------------
+    # lookupIP
+    #-------------------
+
+    def lookupIP(self, ip_str):
+        '''
+        Like IpFullLocation.lookupIP(), but raises KeyError
+        for malformed addresses as well.
+        '''
+        location = self.get(ip_str)
+        if location is None:
+            raise KeyError(f"Ip {ip_str} not found in location translator.")
+        return location
+
+    #------------------------------------
+    # new_entries
+    #-------------------
+
+    def new_entries(self):
+        '''
+        Addresses this cache looked up in the IP table,
+        and still holds, with their cached results.
+
+        :return: (IP string, location tuple or _NOT_FOUND) pairs
+        :rtype: [(str, {tuple | None})]
+        '''
+        return [(ip_str, self.entries[ip_str]) for ip_str in self.looked_up]
+
+    #------------------------------------
+    # merge
+    #-------------------
+
+    def merge(self, entries):
+        '''
+        Add the given entries, as returned by new_entries()
+        of another cache, as most recently used. Addresses
+        already cached keep their place.
+
+        :param entries: (IP string, cached result) pairs
+        :type entries: [(str, {tuple | None})]
+        '''
+        for ip_str, location in entries:
+            if ip_str not in self.entries:
+                self.entries[ip_str] = location
+        while len(self.entries) > self.max_entries:
+            self._evict()
+
+    #------------------------------------
+    # report
+    #-------------------
+
+    def report(self):
+        num_lookups = self.num_hits + self.num_misses
+        if num_lookups == 0:
+            return
+        self.log.info(f"IP location cache: {num_lookups} lookups, "
+                      f"{100 * self.num_hits / num_lookups:.1f}% hits, "
+                      f"{self.num_misses} misses, of which {self.num_not_found} without location; "
+                      f"{len(self.entries)} addresses cached")
+
+    #------------------------------------
+    # save
+    #-------------------
+
+    def save(self):
+        '''
+        Write the cached addresses to self.cache_path,
+        replacing the previous file in one step. Several
+        processes may save concurrently; the last one wins.
+        '''
+        if self.cache_path is None:
+            return
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as fd:
+            pickle.dump({'version' : self.version,
+                         'entries' : list(self.entries.items())
+                         },
+                        fd)
+        os.replace(tmp_path, self.cache_path)
+        self.log.info(f"Saved {len(self.entries)} IP locations to {self.cache_path}")
+
+    #------------------------------------
+    # load
+    #-------------------
+
+    def load(self):
+        '''
+        Fill the cache from self.cache_path, if that
+        file exists, and was made from the same version
+        of the IP table.
+        '''
+        try:
+            with open(self.cache_path, 'rb') as fd:
+                saved = pickle.load(fd)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.log.warn(f"Ignoring unreadable IP location cache {self.cache_path}: {repr(e)}")
+            return
+        if saved['version'] is None or saved['version'] != self.version:
+            self.log.info(f"Ignoring IP location cache {self.cache_path} of another IP table version")
+            return
+        # Most recently used last:
+        self.entries = OrderedDict(saved['entries'][-self.max_entries:])
+        self.looked_up = set()
+        self.log.info(f"Loaded {len(self.entries)} IP locations from {self.cache_path}")
+
+    #------------------------------------
+    # _evict
+    #-------------------
+
+    def _evict(self):
+        '''
+        Drop the least recently used address.
+        '''
+        ip_str, _location = self.entries.popitem(last=False)
+        self.looked_up.discard(ip_str)
+
+    #------------------------------------
+    # _lookup
+    #-------------------
+
+    def _lookup(self, ip_str):
+        '''
+        Consult the IP table on a cache miss.
+
+        :return: location tuple, or _NOT_FOUND
+        :rtype: {tuple | None}
+        '''
+        self.num_misses += 1
+        try:
+            return self.ip_table.lookupIP(ip_str)
+        except (KeyError, ValueError, AttributeError):
+            # Not in the table, or not an address,
+            # like 'NULL', or None:
+            self.num_not_found += 1
+            return self._NOT_FOUND
+
+    def __len__(self):
+        return len(self.entries)
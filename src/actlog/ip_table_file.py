@@ -0,0 +1,681 @@
+'''
+Created on Oct 18, 2026
+
+Compact representation of the IP location table, in
+memory and in a binary file that is opened with mmap
+instead of being unpickled.
+
+As 12-field tuples, each range holds its own copies of
+strings like 'United States' and '-07:00', and two ints
+and two floats as objects; millions of them take several
+hundred bytes per range. IpRangeColumns instead holds the
+ranges column by column, sorted by their start address:
+
+    o start and end address: one uint32 per range,
+    o latitude and longitude: one float64 per range,
+    o each of the eight string fields, including the phone
+      codes, whose leading zeros matter: one uint32 per
+      range, the index of the value in a list of the
+      distinct strings,
+    o for getBy3LetterCode(): one uint32 per country, the
+      index of the range whose fields describe the country.
+
+That is 56 bytes per range, plus the distinct strings.
+The location tuple of a range is only built when the
+range is looked up.
+
+The columns are built from the csv file of the IP database
+in chunks, in parallel on machines with several cores.
+Lines with all fields quoted, which are all lines of the
+commercial csv file, are split without the csv module.
+
+An IpTableFile holds the same columns as zero-copy
+memoryviews of a mapped file. Unpickling ipDict.pickle
+takes seconds, and a copy of the tuples in every ingest
+worker. Opening a table file takes milliseconds, and
+processes that open the same file share its pages.
+
+The file holds:
+
+    o a header: magic, byte order mark, number of ranges,
+      number of strings, number of countries, and length
+      of the source stamp,
+    o latitude and longitude, where they are 8-byte aligned,
+    o start and end address,
+    o the eight string columns,
+    o the country index,
+    o the source stamp: name, size, modification time, and
+      SHA1 of the csv file the table was built from, so that
+      a table of an outdated csv file is noticed,
+    o the distinct strings, as UTF-8, separated by NUL bytes.
+
+Bisect searches the columns directly, and np.frombuffer()
+turns them into arrays.
+
+The file is created from the CSV.ZIP of the IP database,
+or from ipDict.pickle:
+
+    ip_table_file.py [-o ipTable.bin] [ipDict.pickle | DB15-...CSV.ZIP]
+'''
+
+from array import array
+import argparse
+import csv
+import hashlib
+from itertools import chain, islice
+import mmap
+import multiprocessing
+import os
+from pathlib import Path
+import pickle
+import struct
+import sys
+from zipfile import ZipFile
+
+from logging_service import LoggingService
+
+
+class IpRangeColumns:
+    '''
+    Build the columns from range tuples, or from a csv
+    file, and look up the location of a range:
+
+        columns = IpRangeColumns.from_ranges(sorted_ranges)
+        columns = IpRangeColumns.from_csv('DB15-...CSV.ZIP')
+        columns.starts[10]      --> 16778240
+        columns.location(10)    --> ('AU', 'Australia', 'Victoria', 'Melbourne', ...)
+    '''
+
+    # Positions in the range tuples of the start and end
+    # address, of the float fields, and of the fields
+    # stored as strings:
+    ADDRESS_POSS = (0, 1)
+    FLOAT_FIELD_POSS = (6, 7)
+    STR_FIELD_POSS = (2, 3, 4, 5, 8, 9, 10, 11)
+
+    # Position of the two-letter country code:
+    COUNTRY_CODE_POS = 2
+
+    # Number of fields of a range:
+    NUM_FIELDS = 12
+
+    # Bytes of csv text parsed at a time:
+    CHUNK_BYTES = 16 * 1024 * 1024
+
+    #------------------------------------
+    # Constructor
+    #-------------------
+
+    def __init__(self, starts, ends, latitudes, longitudes, str_cols, strs, country_range_idxs):
+        '''
+        :param starts: first address of each range
+        :type starts: {array | memoryview}
+        :param ends: last address of each range
+        :type ends: {array | memoryview}
+        :param latitudes: latitude of each range
+        :type latitudes: {array | memoryview}
+        :param longitudes: longitude of each range
+        :type longitudes: {array | memoryview}
+        :param str_cols: per string field, the index in
+            strs of each range's value
+        :type str_cols: [{array | memoryview}]
+        :param strs: the distinct strings
+        :type strs: [str]
+        :param country_range_idxs: per country, the range
+            that describes it
+        :type country_range_idxs: {array | memoryview}
+        '''
+        self.starts = starts
+        self.ends = ends
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.str_cols = str_cols
+        self.strs = strs
+        self.country_range_idxs = country_range_idxs
+
+    #------------------------------------
+    # from_ranges
+    #-------------------
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        '''
+        Build the columns of range tuples, like those
+        of IpFullLocation.ipDict.
+
+        :param ranges: the range tuples, sorted by start address
+        :type ranges: [tuple]
+        :rtype: IpRangeColumns
+        '''
+        fields = list(zip(*ranges)) if len(ranges) > 0 else [()] * cls.NUM_FIELDS
+        return cls._from_fields(fields)
+
+    #------------------------------------
+    # from_csv
+    #-------------------
+
+    @classmethod
+    def from_csv(cls, csv_path, member=None, num_workers=None, chunk_bytes=None):
+        '''
+        Build the columns from the csv file of the IP database,
+        which may be zipped. The file is parsed in chunks of
+        chunk_bytes, by num_workers processes.
+
+        :param csv_path: path to the csv or zip file
+        :type csv_path: str
+        :param member: name of the csv file in a zip file;
+            None for its first csv file
+        :type member: {None | str}
+        :param num_workers: number of processes; None for
+            one per core
+        :type num_workers: {None | int}
+        :param chunk_bytes: bytes parsed at a time; None 
+            for CHUNK_BYTES
+        :type chunk_bytes: {None | int}
+        :rtype: IpRangeColumns
+        '''
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        if chunk_bytes is None:
+            chunk_bytes = cls.CHUNK_BYTES
+        zip_file = None
+        if Path(csv_path).suffix.lower() == '.zip':
+            zip_file = ZipFile(csv_path)
+            if member is None:
+                member = next(name for name in zip_file.namelist() if name.lower().endswith('.csv'))
+            csv_fd = zip_file.open(member)
+        else:
+            csv_fd = open(csv_path, 'rb')
+        try:
+            chunks = _csv_chunks(csv_fd, chunk_bytes)
+            first_chunks = list(islice(chunks, 2))
+            chunks = chain(first_chunks, chunks)
+            if num_workers <= 1 or len(first_chunks) < 2:
+                # One string index for all chunks spares
+                # concat() renumbering the strings:
+                str_idxs = {}
+                parts = [_parse_csv_chunk(chunk, str_idxs) for chunk in chunks]
+            else:
+                with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+                    parts = pool.map(_parse_csv_chunk, chunks)
+        finally:
+            csv_fd.close()
+            if zip_file is not None:
+                zip_file.close()
+
+        columns = cls.concat(parts)
+        if any(map(int.__gt__, columns.starts[:-1], columns.starts[1:])):
+            # Not sorted by start address; sort the tuples:
+            columns = cls.from_ranges(sorted(map(columns.range_tuple, range(len(columns)))))
+        return columns
+
+    #------------------------------------
+    # concat
+    #-------------------
+
+    @classmethod
+    def concat(cls, parts):
+        '''
+        Join the columns of consecutive parts of a table.
+
+        :param parts: columns of the parts, in order
+        :type parts: [IpRangeColumns]
+        :rtype: IpRangeColumns
+        '''
+        if len(parts) == 1:
+            return parts[0]
+        starts = array('I')
+        ends = array('I')
+        latitudes = array('d')
+        longitudes = array('d')
+        str_cols = [array('I') for _pos in cls.STR_FIELD_POSS]
+        # String --> index in the joined strs:
+        str_idxs = {}
+        # Country code --> range index:
+        country_range_idxs = {}
+        for part in parts:
+            offset = len(starts)
+            # Index of each of the part's strings in the joined strs:
+            joined_idxs = [str_idxs.setdefault(val, len(str_idxs)) for val in part.strs]
+            if joined_idxs == list(range(len(joined_idxs))):
+                # Same numbering, as in parts that share strings:
+                for str_col, part_col in zip(str_cols, part.str_cols):
+                    str_col.extend(part_col)
+            else:
+                for str_col, part_col in zip(str_cols, part.str_cols):
+                    str_col.extend(map(joined_idxs.__getitem__, part_col))
+            for range_idx in part.country_range_idxs:
+                country_code = part.strs[part.str_cols[0][range_idx]]
+                country_range_idxs[country_code] = offset + range_idx
+            starts.extend(part.starts)
+            ends.extend(part.ends)
+            latitudes.extend(part.latitudes)
+            longitudes.extend(part.longitudes)
+        # Dicts keep insertion order, which is index order:
+        return cls(starts, ends, latitudes, longitudes, str_cols,
+                   list(str_idxs), array('I', country_range_idxs.values()))
+
+    #------------------------------------
+    # location
+    #-------------------
+
+    def location(self, range_idx):
+        '''
+        Return the location of one range, as
+        IpFullLocation.lookupIP() does.
+
+        :param range_idx: index of the range
+        :type range_idx: int
+        :return: 2-letter country code, country, region, city,
+            lat, long, zipcode, timezone, country_phone_code,
+            area_phone_code
+        :rtype: tuple
+        '''
+        strs = self.strs
+        (code_col, country_col, state_col, city_col,
+         zip_col, timezone_col, country_phone_col, area_phone_col) = self.str_cols
+        return (strs[code_col[range_idx]],
+                strs[country_col[range_idx]],
+                strs[state_col[range_idx]],
+                strs[city_col[range_idx]],
+                self.latitudes[range_idx],
+                self.longitudes[range_idx],
+                strs[zip_col[range_idx]],
+                strs[timezone_col[range_idx]],
+                strs[country_phone_col[range_idx]],
+                strs[area_phone_col[range_idx]]
+                )
+
+    #------------------------------------
+    # range_tuple
+    #-------------------
+
+    def range_tuple(self, range_idx):
+        '''
+        Return a range as the 12-tuple of ipDict:
+        start, end, and the location.
+        '''
+        return (self.starts[range_idx], self.ends[range_idx]) + self.location(range_idx)
+
+    #------------------------------------
+    # two_letter_keyed_dict
+    #-------------------
+
+    def two_letter_keyed_dict(self):
+        '''
+        Recreate IpFullLocation.twoLetterKeyedDict: two-letter
+        country code --> (code, country, region, city).
+        '''
+        return {location[0] : location[0:4]
+                for location in map(self.location, self.country_range_idxs)}
+
+    #------------------------------------
+    # _from_fields
+    #-------------------
+
+    @classmethod
+    def _from_fields(cls, fields, str_idxs=None):
+        '''
+        Build the columns from one sequence of values per
+        field, of the types in the range tuples. Strings are
+        numbered in str_idxs, which may be shared with other
+        parts of the table.
+        '''
+        (start_pos, end_pos) = cls.ADDRESS_POSS
+        (lat_pos, long_pos) = cls.FLOAT_FIELD_POSS
+        # String --> index in strs:
+        if str_idxs is None:
+            str_idxs = {}
+        str_cols = []
+        for pos in cls.STR_FIELD_POSS:
+            # Only the distinct values of the field need a loop:
+            for val in dict.fromkeys(fields[pos]):
+                str_idxs.setdefault(val, len(str_idxs))
+            str_cols.append(array('I', map(str_idxs.__getitem__, fields[pos])))
+        # The last range of a country describes it, as
+        # in the twoLetterKeyedDict built from the csv file:
+        country_range_idxs = dict(zip(fields[cls.COUNTRY_CODE_POS], range(len(fields[start_pos]))))
+
+        # Dicts keep insertion order, which is index order:
+        return cls(array('I', fields[start_pos]),
+                   array('I', fields[end_pos]),
+                   array('d', fields[lat_pos]),
+                   array('d', fields[long_pos]),
+                   str_cols,
+                   list(str_idxs),
+                   array('I', country_range_idxs.values()))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {len(self)} ranges>"
+
+
+class IpTableFile(IpRangeColumns):
+    '''
+    Write the columns of an IpFullLocation to a file,
+    and open it:
+
+        IpTableFile.write(ip_table.rangeColumns, 'ipTable.bin',
+                          source_stamp=IpTableFile.stamp_of('DB15-...CSV.ZIP'))
+        table_file = IpTableFile('ipTable.bin')
+        table_file.is_built_from('DB15-...CSV.ZIP')  --> True
+        table_file.location(10)    --> ('AU', 'Australia', 'Victoria', 'Melbourne', ...)
+    '''
+
+    MAGIC = b'ACTLIPT2'
+
+    # Written in the writer's byte order; the reader
+    # refuses files of the other order:
+    BYTE_ORDER_MARK = 0x01020304
+
+    # Magic, byte order mark, number of ranges, number of
+    # strings, number of countries, length of the source
+    # stamp, and padding to 8-byte alignment:
+    HEADER = struct.Struct('=8sIIIII4x')
+
+    # Separates the strings of the string table:
+    STR_SEPARATOR = '\0'
+
+    # Separates the parts of a source stamp:
+    STAMP_SEPARATOR = ':'
+
+    #------------------------------------
+    # Constructor
+    #-------------------
+
+    def __init__(self, path):
+        '''
+        Map the file at path into memory.
+
+        :param path: file written by IpTableFile.write()
+        :type path: str
+        :raise ValueError: if the file is not an IP table
+            file of this version, was written on a machine of
+            another byte order, or is truncated
+        '''
+        self.path = path
+        with open(path, 'rb') as fd:
+            # The mapping stays valid after the fd is closed:
+            self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < self.HEADER.size:
+            raise ValueError(f"File {path} is too short for an IP table")
+        (magic, order_mark, num_ranges, num_strs, num_countries, stamp_len) = self.HEADER.unpack_from(self.mm)
+        if magic != self.MAGIC:
+            raise ValueError(f"File {path} is not an IP table file of this version")
+        if order_mark != self.BYTE_ORDER_MARK:
+            raise ValueError(f"IP table file {path} was written with another byte order")
+
+        view = memoryview(self.mm)
+        offset = self.HEADER.size
+        # Float columns first, where they are 8-byte aligned:
+        (latitudes, offset) = self._column(view, offset, 'd', num_ranges)
+        (longitudes, offset) = self._column(view, offset, 'd', num_ranges)
+        (starts, offset) = self._column(view, offset, 'I', num_ranges)
+        (ends, offset) = self._column(view, offset, 'I', num_ranges)
+        str_cols = []
+        for _pos in self.STR_FIELD_POSS:
+            (str_col, offset) = self._column(view, offset, 'I', num_ranges)
+            str_cols.append(str_col)
+        (country_range_idxs, offset) = self._column(view, offset, 'I', num_countries)
+        (stamp, offset) = self._column(view, offset, 'B', stamp_len)
+        self.source_stamp = str(stamp, 'utf8') if stamp_len > 0 else None
+
+        # Decoding all distinct strings at once is much
+        # cheaper than decoding per lookup:
+        strs = str(view[offset:], 'utf8').split(self.STR_SEPARATOR) if num_strs > 0 else []
+        if len(strs) != num_strs:
+            raise ValueError(f"IP table file {path} has {len(strs)} strings instead of {num_strs}")
+
+        super().__init__(starts, ends, latitudes, longitudes, str_cols, strs, country_range_idxs)
+
+    #------------------------------------
+    # write
+    #-------------------
+
+    @classmethod
+    def write(cls, columns, path, source_stamp=None):
+        '''
+        Write the columns of a table to path, replacing any
+        previous file in one step, so that processes that
+        have the previous file open are not disturbed.
+
+        :param columns: the table
+        :type columns: IpRangeColumns
+        :param path: file to write
+        :type path: str
+        :param source_stamp: stamp_of() the file the table
+            was built from; None if unknown
+        :type source_stamp: {None | str}
+        :raise ValueError: if a string field is not a str, or
+            contains a NUL character
+        '''
+        for val in columns.strs:
+            if type(val) != str or cls.STR_SEPARATOR in val:
+                raise ValueError(f"IP table field is not a NUL-free str: {repr(val)}")
+        stamp = b'' if source_stamp is None else source_stamp.encode('utf8')
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as fd:
+            fd.write(cls.HEADER.pack(cls.MAGIC, cls.BYTE_ORDER_MARK,
+                                     len(columns), len(columns.strs), len(columns.country_range_idxs),
+                                     len(stamp)))
+            for col in [columns.latitudes, columns.longitudes, columns.starts, columns.ends] \
+                       + list(columns.str_cols) + [columns.country_range_idxs]:
+                fd.write(col)
+            fd.write(stamp)
+            fd.write(cls.STR_SEPARATOR.join(columns.strs).encode('utf8'))
+        os.replace(tmp_path, path)
+
+    #------------------------------------
+    # stamp_of
+    #-------------------
+
+    @classmethod
+    def stamp_of(cls, source_path):
+        '''
+        Identify a source file by its name, size,
+        modification time, and SHA1.
+
+        :param source_path: the csv or zip file
+        :type source_path: str
+        :rtype: str
+        '''
+        stat = os.stat(source_path)
+        digest = hashlib.sha1()
+        with open(source_path, 'rb') as fd:
+            for block in iter(lambda: fd.read(1024 * 1024), b''):
+                digest.update(block)
+        return cls.STAMP_SEPARATOR.join((os.path.basename(source_path),
+                                         str(stat.st_size),
+                                         str(int(stat.st_mtime)),
+                                         digest.hexdigest()))
+
+    #------------------------------------
+    # is_built_from
+    #-------------------
+
+    def is_built_from(self, source_path):
+        '''
+        Return whether the table was built from the current
+        content of source_path. Name, size and modification
+        time are compared first; only if they differ, the
+        file is hashed, as after a copy of the same file.
+
+        :param source_path: the csv or zip file
+        :type source_path: str
+        :rtype: bool
+        '''
+        if self.source_stamp is None:
+            return False
+        (name, size, mtime, sha1) = self.source_stamp.rsplit(self.STAMP_SEPARATOR, 3)
+        stat = os.stat(source_path)
+        if (name, size, mtime) == (os.path.basename(source_path), str(stat.st_size), str(int(stat.st_mtime))):
+            return True
+        return self.stamp_of(source_path).rsplit(self.STAMP_SEPARATOR, 1)[1] == sha1
+
+    #------------------------------------
+    # _column
+    #-------------------
+
+    def _column(self, view, offset, typecode, num_vals):
+        '''
+        Return a view of num_vals values of the given
+        type at offset, and the offset after them.
+        '''
+        end = offset + num_vals * struct.calcsize(typecode)
+        if end > len(view):
+            raise ValueError(f"IP table file {self.path} is truncated")
+        return (view[offset:end].cast(typecode), end)
+
+    def __repr__(self):
+        return f"<IpTableFile {self.path} {len(self)} ranges>"
+
+#------------------------------------
+# _csv_chunks
+#-------------------
+
+def _csv_chunks(csv_fd, chunk_bytes):
+    '''
+    Read about chunk_bytes of a binary file at a
+    time, ending at a line end.
+    '''
+    while True:
+        chunk = csv_fd.read(chunk_bytes)
+        if len(chunk) == 0:
+            return
+        yield chunk + csv_fd.readline()
+
+#------------------------------------
+# _parse_csv_chunk
+#-------------------
+
+def _parse_csv_chunk(chunk, str_idxs=None):
+    '''
+    Parse lines of the csv file of the IP database. Lines 
+    of ranges that start at 0 are skipped.
+
+    :param chunk: complete lines of the file
+    :type chunk: bytes
+    :param str_idxs: string --> index, shared by chunks
+    :type str_idxs: {None | {str : int}}
+    :rtype: IpRangeColumns
+    '''
+    num_fields = IpRangeColumns.NUM_FIELDS
+    text = chunk.decode('utf8').rstrip('\r\n')
+    line_end = '\r\n' if '\r' in text[:text.find('\n')] else '\n'
+    # If all fields are quoted, and contain no quotes or
+    # line ends, the whole chunk splits into one flat list
+    # of fields, whose every twelfth element is in one column:
+    body = text.replace(f'"{line_end}"', '","')
+    fields = None
+    if body[:1] == '"' and body[-1:] == '"' and '\n' not in body and '""' not in body:
+        flat_fields = body[1:-1].split('","')
+        if len(flat_fields) % num_fields == 0:
+            fields = [flat_fields[pos::num_fields] for pos in range(num_fields)]
+            try:
+                # Also catches lines with too many or too few
+                # fields, which shift text into these columns:
+                fields = _typed_fields(fields)
+            except ValueError:
+                fields = None
+    if fields is None:
+        fields = _typed_fields(_split_csv_lines(text))
+    return IpRangeColumns._from_fields(fields, str_idxs)
+
+#------------------------------------
+# _split_csv_lines
+#-------------------
+
+def _split_csv_lines(text):
+    '''
+    Parse csv lines one by one, skipping those without
+    the twelve fields, like comments. Lines whose fields
+    are all quoted, and contain no quotes, are split on 
+    '","'; others go through the csv module.
+
+    :return: the values of each field
+    :rtype: [[str]]
+    '''
+    rows = []
+    num_fields = IpRangeColumns.NUM_FIELDS
+    for line in text.splitlines():
+        if line[:1] == '"' and line[-1:] == '"' and '""' not in line:
+            fields = line[1:-1].split('","')
+        else:
+            fields = next(csv.reader([line]), [])
+        if len(fields) != num_fields:
+            if len(line.strip()) > 0 and line[0] != '#':
+                print(f"Irregularity in IP db line '{line}'")
+            continue
+        rows.append(fields)
+    return list(zip(*rows)) if len(rows) > 0 else [()] * num_fields
+
+#------------------------------------
+# _typed_fields
+#-------------------
+
+def _typed_fields(fields):
+    '''
+    Convert the address and float fields of parsed
+    csv lines, dropping ranges that start at 0.
+
+    :param fields: the values of each field
+    :type fields: [[str]]
+    :raise ValueError: if a value does not convert
+    '''
+    start_pos = IpRangeColumns.ADDRESS_POSS[0]
+    if '0' in fields[start_pos]:
+        keep_idxs = [idx for idx, start in enumerate(fields[start_pos]) if start != '0']
+        fields = [[field[idx] for idx in keep_idxs] for field in fields]
+    fields = list(fields)
+    for pos in IpRangeColumns.ADDRESS_POSS:
+        fields[pos] = list(map(int, fields[pos]))
+    for pos in IpRangeColumns.FLOAT_FIELD_POSS:
+        fields[pos] = list(map(float, fields[pos]))
+    return fields
+
+# ------------------------ Main ------------
+if __name__ == '__main__':
+
+    from actlog.ipToFullLocation import IpFullLocation
+
+    cur_dir = os.path.dirname(__file__)
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]),
+                                     formatter_class=argparse.RawTextHelpFormatter,
+                                     description="Convert the IP location table to the mmap-able binary format"
+                                     )
+
+    parser.add_argument('-o', '--output',
+                        type=str,
+                        help=f'file to write; default: {IpFullLocation.TABLE_FILE} next to this script',
+                        default=os.path.join(cur_dir, IpFullLocation.TABLE_FILE))
+
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        help='number of processes that parse a csv file; default: one per core',
+                        default=None)
+
+    parser.add_argument('source',
+                        type=str,
+                        nargs='?',
+                        help='ipDict.pickle, or the (zipped) csv file of the IP database; default: ipDict.pickle',
+                        default=os.path.join(cur_dir, 'ipDict.pickle'))
+
+    args = parser.parse_args()
+
+    log = LoggingService()
+    if args.source.endswith('.pickle'):
+        with open(args.source, 'rb') as fd:
+            ip_dict = pickle.load(fd)
+        ip_table = IpFullLocation.fromRanges(ip_range
+                                             for chain in ip_dict.values()
+                                             for ip_range in chain)
+        columns = ip_table.rangeColumns
+        source_stamp = None
+    else:
+        columns = IpRangeColumns.from_csv(args.source, member=IpFullLocation.XLATION_CSV, num_workers=args.workers)
+        source_stamp = IpTableFile.stamp_of(args.source)
+    IpTableFile.write(columns, args.output, source_stamp=source_stamp)
+    log.info(f"Wrote {len(columns)} IP ranges to {args.output}")
@@ -0,0 +1,513 @@
+'''
+Created on Oct 18, 2026
+
+Sparse index over a raw activity log. The log is
+ordered by row id and created_at, so recording the
+byte offset of every Nth row is enough to start reading
+close to any row id or date, by binary search over
+the index, rather than by scanning from the top.
+
+Offsets are positions in the uncompressed log. For a
+gzipped log, the start of each gzip member is also
+recorded, as an access point: reading can start
+decompressing at the member that contains an offset.
+A gzip file written in one go has only one member.
+rechunk_gzip() rewrites a log as a series of members,
+which makes seeking in it fast.
+
+The index is kept as JSON in a file next to the log,
+and is built once per log file:
+
+    log_index = LogIndex.load_or_build(log_path)
+    offset = log_index.offset_for_row_id(1000000)
+
+Usage from the command line:
+
+    log_index.py [--every N] [--rechunk DEST_GZ] activity_log_path
+'''
+
+import argparse
+import bisect
+import csv
+import gzip
+import json
+import os
+import sys
+import zlib
+
+from logging_service import LoggingService
+
+from actlog.checkpoint import IngestCheckpoint
+from actlog.pipeline import TsvSource
+
+
+class LogIndex:
+    '''
+    Row ids, created_at times, and byte offsets of
+    every Nth row of a log, plus the gzip access points.
+    '''
+
+    # Suffix of the index file next to the log:
+    SUFFIX = '.idx'
+
+    # Rows between index entries:
+    EVERY = 1000
+
+    # Size of the uncompressed data in each
+    # gzip member written by rechunk_gzip():
+    MEMBER_BYTES = 16 * 1024 * 1024
+
+    #------------------------------------
+    # Constructor
+    #-------------------
+
+    def __init__(self,
+                 log_path,
+                 row_ids,
+                 created_ats,
+                 offsets,
+                 access_points=None,
+                 every=None,
+                 indexed_size=None,
+                 head_digest=None,
+                 head_len=None):
+        '''
+        :param log_path: the indexed log
+        :type log_path: str
+        :param row_ids: row id of each entry, ascending
+        :type row_ids: [int]
+        :param created_ats: created_at of each entry, ascending
+        :type created_ats: [str]
+        :param offsets: uncompressed byte offset of the start
+            of each entry's row
+        :type offsets: [int]
+        :param access_points: for gzipped logs, the uncompressed
+            and compressed offsets of the start of each gzip member
+        :type access_points: {None | [(int, int)]}
+        :param every: number of rows between entries
+        :type every: {None | int}
+        :param indexed_size: size of the log file when indexed
+        :type indexed_size: {None | int}
+        :param head_digest: fingerprint of the log's first
+            head_len bytes; computed if None
+        :type head_digest: {None | str}
+        :param head_len: number of bytes covered by head_digest
+        :type head_len: {None | int}
+        '''
+        self.log_path = log_path
+        self.row_ids = row_ids
+        self.created_ats = created_ats
+        self.offsets = offsets
+        self.access_points = access_points
+        self.every = self.EVERY if every is None else every
+        self.indexed_size = os.path.getsize(log_path) if indexed_size is None else indexed_size
+        if head_digest is None:
+            head_len = min(self.indexed_size, IngestCheckpoint.HEAD_BYTES)
+            head_digest = IngestCheckpoint.log_digest(log_path, head_len)
+        self.head_digest = head_digest
+        self.head_len = head_len
+
+    #------------------------------------
+    # path_for
+    #-------------------
+
+    @classmethod
+    def path_for(cls, log_path):
+        return log_path + cls.SUFFIX
+
+    #------------------------------------
+    # load_or_build
+    #-------------------
+
+    @classmethod
+    def load_or_build(cls, log_path, every=None):
+        '''
+        Return the saved index of the given log, if there
+        is one that still fits the log. Else build the index,
+        save it, and return it.
+
+        :rtype: LogIndex
+        '''
+        log_index = cls.load(log_path)
+        if log_index is None:
+            log_index = cls.build(log_path, every=every)
+            log_index.save()
+        return log_index
+
+    #------------------------------------
+    # load
+    #-------------------
+
+    @classmethod
+    def load(cls, log_path):
+        '''
+        Return the saved index of the given log, or
+        None if there is none, or the log has changed
+        other than by growing.
+
+        :rtype: {None | LogIndex}
+        '''
+        try:
+            with open(cls.path_for(log_path), 'r') as fd:
+                log_index = cls(log_path, **json.load(fd))
+        except FileNotFoundError:
+            return None
+        except (ValueError, TypeError) as e:
+            LoggingService().warn(f"Ignoring unreadable index {cls.path_for(log_path)}: {repr(e)}")
+            return None
+        if not log_index.matches(log_path):
+            return None
+        return log_index
+
+    #------------------------------------
+    # matches
+    #-------------------
+
+    def matches(self, log_path):
+        '''
+        True if the log starts with the same bytes as
+        when it was indexed, and has not shrunk.
+        '''
+        try:
+            return (os.path.getsize(log_path) >= self.indexed_size and
+                    IngestCheckpoint.log_digest(log_path, self.head_len) == self.head_digest)
+        except OSError:
+            return False
+
+    #------------------------------------
+    # save
+    #-------------------
+
+    def save(self):
+        path = self.path_for(self.log_path)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fd:
+            json.dump({'row_ids' : self.row_ids,
+                       'created_ats' : self.created_ats,
+                       'offsets' : self.offsets,
+                       'access_points' : self.access_points,
+                       'every' : self.every,
+                       'indexed_size' : self.indexed_size,
+                       'head_digest' : self.head_digest,
+                       'head_len' : self.head_len
+                       }, fd)
+        os.replace(tmp_path, path)
+
+    #------------------------------------
+    # build
+    #-------------------
+
+    @classmethod
+    def build(cls, log_path, every=None):
+        '''
+        Read the whole log, and return its index.
+
+        :param log_path: the log to index
+        :type log_path: str
+        :param every: rows between index entries
+        :type every: {None | int}
+        :rtype: LogIndex
+        '''
+        log = LoggingService()
+        every = cls.EVERY if every is None else every
+        log.info(f"Indexing {log_path} ...")
+
+        access_points = gzip_members(log_path) if is_gzipped(log_path) else None
+
+        row_ids = []
+        created_ats = []
+        offsets = []
+        reader = _OffsetReader(TsvSource(log_path, track_offsets=True))
+        num_rows = 0
+        for row_start, row in reader:
+            try:
+                row_id = int(row[0])
+            except (ValueError, IndexError):
+                continue
+            if num_rows % every == 0:
+                row_ids.append(row_id)
+                # Rows with tabs in a search term have
+                # extra fields, so count from the end:
+                created_ats.append(row[-2])
+                offsets.append(row_start)
+            num_rows += 1
+        log.info(f"Indexed {num_rows} rows with {len(offsets)} entries")
+        return cls(log_path, row_ids, created_ats, offsets,
+                   access_points=access_points,
+                   every=every)
+
+    #------------------------------------
+    # offset_for_row_id
+    #-------------------
+
+    def offset_for_row_id(self, row_id):
+        '''
+        Return the offset of a row at or before the
+        given row id, from where reading finds that row
+        within self.every rows. 0 if the row id precedes
+        the first entry; reading then starts at the top.
+
+        :param row_id: id of the row to find
+        :type row_id: int
+        :return: uncompressed byte offset
+        :rtype: int
+        '''
+        entry_idx = bisect.bisect_right(self.row_ids, row_id) - 1
+        if entry_idx < 0:
+            return 0
+        return self.offsets[entry_idx]
+
+    #------------------------------------
+    # offset_for_date
+    #-------------------
+
+    def offset_for_date(self, created_at):
+        '''
+        Return the offset of a row before the first
+        row created at or after the given time.
+
+        :param created_at: time like '2017-01-01' or
+            '2017-01-01 10:00:00'
+        :type created_at: str
+        :return: uncompressed byte offset
+        :rtype: int
+        '''
+        # The last entry strictly before the time; later
+        # entries might skip rows with an equal time:
+        entry_idx = bisect.bisect_left(self.created_ats, created_at) - 1
+        if entry_idx < 0:
+            return 0
+        return self.offsets[entry_idx]
+
+    #------------------------------------
+    # row_id_for_date
+    #-------------------
+
+    def row_id_for_date(self, created_at):
+        '''
+        Return the id of the first row created at or
+        after the given time, or None if there is no
+        such row. Reads at most self.every rows past the
+        closest index entry.
+
+        :param created_at: time like '2017-01-01'
+        :type created_at: str
+        :rtype: {None | int}
+        '''
+        source = TsvSource(self.log_path,
+                           start_offset=self.offset_for_date(created_at),
+                           track_offsets=True,
+                           log_index=self)
+        for _row_start, row in _OffsetReader(source):
+            try:
+                row_id = int(row[0])
+            except (ValueError, IndexError):
+                continue
+            if row[-2] >= created_at:
+                return row_id
+        return None
+
+    #------------------------------------
+    # row_range_for_dates
+    #-------------------
+
+    def row_range_for_dates(self, start_date=None, end_date=None):
+        '''
+        Return the range of row ids created from start_date
+        (inclusive) to end_date (exclusive). For example,
+        ('2017-01-01', '2018-01-01') covers 2017.
+
+        :return: lowest and highest row id; None where
+            the range is open
+        :rtype: ({None | int}, {None | int})
+        '''
+        min_row_id = None if start_date is None else self.row_id_for_date(start_date)
+        if start_date is not None and min_row_id is None:
+            # Nothing that recent; an empty range:
+            return (self.row_ids[-1] + 1 if len(self.row_ids) > 0 else 1, 0)
+        max_row_id = None
+        if end_date is not None:
+            first_excluded = self.row_id_for_date(end_date)
+            if first_excluded is not None:
+                max_row_id = first_excluded - 1
+        return (min_row_id, max_row_id)
+
+    #------------------------------------
+    # open_at
+    #-------------------
+
+    def open_at(self, offset):
+        '''
+        Return a binary file object for the uncompressed
+        content of the log, positioned at the given offset.
+        For gzipped logs, decompression starts at the
+        closest gzip member at or before the offset.
+
+        :param offset: uncompressed byte offset
+        :type offset: int
+        :rtype: {BufferedReader | GzipFile}
+        '''
+        if self.access_points is None:
+            fd = open(self.log_path, 'rb')
+            fd.seek(offset)
+            return fd
+        member_idx = bisect.bisect_right([uncompressed for uncompressed, _compressed
+                                          in self.access_points], offset) - 1
+        member_idx = max(member_idx, 0)
+        uncompressed, compressed = self.access_points[member_idx]
+        raw_fd = open(self.log_path, 'rb')
+        raw_fd.seek(compressed)
+        fd = _MemberGzipFile(fileobj=raw_fd, mode='rb')
+        fd.seek(offset - uncompressed)
+        return fd
+
+# ------------------------- Helpers ----------------
+
+class _MemberGzipFile(gzip.GzipFile):
+    '''
+    GzipFile on a raw file that was positioned at a
+    member boundary; closes the raw file when closed.
+    '''
+    def close(self):
+        fileobj = self.fileobj
+        try:
+            super().close()
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+
+class _OffsetReader:
+    '''
+    Iterates over (row_start, row) for the rows
+    from a TsvSource with offset tracking, where
+    row_start is the offset of the row's first line.
+    '''
+
+    def __init__(self, source):
+        self.source = source
+        # End of the last line handed to csv:
+        self.offset = None
+
+    def _lines(self):
+        for chunk in self.source.process():
+            for line_idx, line in enumerate(chunk):
+                self.offset = chunk.end_offsets[line_idx]
+                yield line
+
+    def __iter__(self):
+        lines = self._lines()
+        reader = csv.reader(lines, delimiter='\t')
+        row_start = None
+        for row in reader:
+            if row_start is None:
+                row_start = self.source.data_offset
+            yield (row_start, row)
+            # csv does not read ahead, so the next row
+            # starts where this one ended:
+            row_start = self.offset
+
+#------------------------------------
+# is_gzipped
+#-------------------
+
+def is_gzipped(path):
+    with open(path, 'rb') as fd:
+        return fd.read(2) == b'\x1f\x8b'
+
+#------------------------------------
+# gzip_members
+#-------------------
+
+def gzip_members(path, read_size=1024 * 1024):
+    '''
+    Return the uncompressed and compressed offsets
+    of the start of each member of a gzip file. Requires
+    decompressing the whole file once.
+
+    :param path: gzip file
+    :type path: str
+    :return: (uncompressed offset, compressed offset) per member
+    :rtype: [(int, int)]
+    '''
+    members = []
+    uncompressed = 0
+    # Offset in the file of the start of data:
+    data_offset = 0
+    decompressor = None
+    with open(path, 'rb') as fd:
+        data = fd.read(read_size)
+        while len(data) > 0:
+            if decompressor is None:
+                # Zero padding may follow the last member:
+                stripped = data.lstrip(b'\0')
+                data_offset += len(data) - len(stripped)
+                data = stripped
+                if len(data) == 0:
+                    data = fd.read(read_size)
+                    continue
+                members.append((uncompressed, data_offset))
+                decompressor = zlib.decompressobj(wbits=31)
+            uncompressed += len(decompressor.decompress(data))
+            if decompressor.eof:
+                # Member ended; the next one starts in
+                # its unused data:
+                unused = decompressor.unused_data
+                data_offset += len(data) - len(unused)
+                data = unused if len(unused) > 0 else fd.read(read_size)
+                decompressor = None
+            else:
+                data_offset += len(data)
+                data = fd.read(read_size)
+    return members
+
+#------------------------------------
+# rechunk_gzip
+#-------------------
+
+def rechunk_gzip(src_path, dest_path, member_bytes=None):
+    '''
+    Write the uncompressed content of src_path (gzipped
+    or plain) to dest_path as a gzip file made of members
+    of member_bytes uncompressed bytes each. Any gzip tool
+    reads the result like the original; LogIndex uses the
+    member starts as access points.
+    '''
+    member_bytes = LogIndex.MEMBER_BYTES if member_bytes is None else member_bytes
+    opener = gzip.open if is_gzipped(src_path) else open
+    with opener(src_path, 'rb') as src_fd, open(dest_path, 'wb') as dest_fd:
+        while True:
+            data = src_fd.read(member_bytes)
+            if len(data) == 0:
+                break
+            dest_fd.write(gzip.compress(data))
+
+# ------------------------ Main ------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]),
+                                     formatter_class=argparse.RawTextHelpFormatter,
+                                     description="Build the sparse seek index of an activity log"
+                                     )
+
+    parser.add_argument('-e', '--every',
+                        type=int,
+                        help=f'rows between index entries; default: {LogIndex.EVERY}',
+                        default=None)
+
+    parser.add_argument('-r', '--rechunk',
+                        type=str,
+                        help='first write the log as a multi-member gzip file to this path, and index that',
+                        default=None)
+
+    parser.add_argument('activity_log_path',
+                        type=str,
+                        help='Path to activity tsv file; may be gzipped or unzipped')
+
+    args = parser.parse_args()
+
+    log_path = args.activity_log_path
+    if args.rechunk is not None:
+        rechunk_gzip(log_path, args.rechunk)
+        log_path = args.rechunk
+
+    LogIndex.build(log_path, every=args.every).save()
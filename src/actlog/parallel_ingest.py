@@ -0,0 +1,434 @@
+'''
+Created on Oct 18, 2026
+
+Spreads the extraction work of an ActivityLogCleaner over
+several worker processes. The parent process reads the
+activity log, and routes each row to one worker, based on
+a hash of the row's emplid. All activities of one visitor
+therefore go to the same worker, in log order. That is
+required for the search term accumulation, which is
+tracked per visitor.
+
+Each worker runs the cleaner's extractors on its rows,
+and flushes its buffers into the db through its own
+connection, or, when exporting to Parquet, into part
+files of its own.
+
+Workers are forked, so they share the parent's copy of
+the (large) IP location table. When done, they return
+the addresses they added to the IP location cache, which
+the parent merges into its own, and saves.
+
+With the compact schema, the parent assigns all lookup
+table ids as it reads the log. Each chunk of rows sent
+to a worker is preceded by the ids assigned since the
+worker's previous chunk: messages are (new ids, rows).
+
+Checkpoints are taken by the parent, between two batches
+of rows: it sends each worker a SYNC message, upon which
+the worker flushes its buffers, waits for its writes to
+finish, and returns its pending searches. Once all workers
+answered, every row up to the last one sent is in the db,
+except for the searches, which go into the checkpoint.
+'''
+
+import multiprocessing
+import queue
+import time
+import traceback
+import zlib
+
+from logging_service import LoggingService
+
+from actlog.checkpoint import IngestCheckpoint
+from actlog.ip_cache import IpLocationCache
+
+
+class ParallelIngester:
+    '''
+    Feeds rows to a pool of worker processes,
+    each running the extractors of a (forked) copy
+    of an ActivityLogCleaner.
+    '''
+
+    # Number of rows sent to a worker in one message:
+    CHUNK_SIZE = 500
+    # Number of chunks that may wait in a worker's
+    # queue before the reader blocks:
+    QUEUE_DEPTH = 16
+    # Seconds between checks whether a worker died
+    # while the reader waits for queue space, or
+    # for results:
+    LIVENESS_CHECK_SECS = 5
+    # Message that has workers flush for a checkpoint:
+    SYNC = 'sync'
+
+    #------------------------------------
+    # Constructor
+    #-------------------
+
+    def __init__(self, cleaner, num_workers, key_pos, chunk_size=None):
+        '''
+        The cleaner must be fully initialized, except
+        for its db connection, which each worker opens
+        for itself.
+
+        :param cleaner: cleaner whose extractors are to run
+            in the workers
+        :type cleaner: ActivityLogCleaner
+        :param num_workers: number of worker processes
+        :type num_workers: int
+        :param key_pos: index into each row of the value that
+            determines the worker to which the row is sent
+        :type key_pos: int
+        :param chunk_size: number of rows per message to a worker
+        :type chunk_size: {None | int}
+        '''
+        self.log = LoggingService()
+        self.cleaner = cleaner
+        self.num_workers = num_workers
+        self.key_pos = key_pos
+        self.chunk_size = self.CHUNK_SIZE if chunk_size is None else chunk_size
+
+        # Workers must inherit the cleaner, including
+        # the IP table, rather than getting it pickled:
+        self.mp_context = multiprocessing.get_context('fork')
+
+    #------------------------------------
+    # run
+    #-------------------
+
+    def run(self, batches, checkpoint_log=None):
+        '''
+        Distribute the rows of the given batches over the
+        workers, wait for the workers to finish, and return
+        the highest row id seen, and the number of search
+        terms the workers found to be truncated.
+
+        If checkpoint_log is given, a checkpoint is saved
+        every cleaner.SECS_BETWEEN_CHECKPOINTS, and at the end.
+        The batches must then carry offsets (see RowDecoder).
+
+        :param batches: iterable of lists of (row_id, row)
+        :type batches: iterable([(int, [str])])
+        :param checkpoint_log: path of the log being ingested,
+            if checkpoints are to be taken
+        :type checkpoint_log: {None | str}
+        :return: highest row id, and number of truncated search terms
+        :rtype: (int, int)
+        :raise RuntimeError: if any worker failed
+        '''
+
+        row_queues = [self.mp_context.Queue(self.QUEUE_DEPTH)
+                      for _i in range(self.num_workers)]
+        result_queue = self.mp_context.Queue()
+        sync_queue = self.mp_context.Queue()
+
+        self.workers = []
+        for worker_idx, row_queue in enumerate(row_queues):
+            worker = self.mp_context.Process(target=_ingest_worker,
+                                             args=(worker_idx,
+                                                   self.num_workers,
+                                                   self.cleaner,
+                                                   row_queue,
+                                                   result_queue,
+                                                   sync_queue),
+                                             name=f"ingest_worker_{worker_idx}",
+                                             daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        self.chunks = [[] for _i in range(self.num_workers)]
+        # Number of the cleaner's new lookup table ids
+        # that each worker was sent:
+        self.num_ids_sent = [0] * self.num_workers
+        # Continue after the row of a restored checkpoint:
+        max_row_id = 0 if self.cleaner.cur_id is None else self.cleaner.cur_id
+        last_batch = None
+        prev_checkpoint = int(time.time())
+        try:
+            for batch in batches:
+                for row_id, row in batch:
+                    worker_idx = self.worker_for(row[self.key_pos])
+                    chunk = self.chunks[worker_idx]
+                    chunk.append((row_id, row))
+                    if len(chunk) >= self.chunk_size:
+                        self._send_chunk(row_queues, worker_idx)
+                    if row_id > max_row_id:
+                        max_row_id = row_id
+                last_batch = batch
+                cur_time = int(time.time())
+                if checkpoint_log is not None and \
+                    (cur_time - prev_checkpoint) >= self.cleaner.SECS_BETWEEN_CHECKPOINTS:
+                    search_states = self._sync_workers(row_queues, sync_queue)
+                    self._save_checkpoint(checkpoint_log, batch, max_row_id, search_states)
+                    prev_checkpoint = cur_time
+            # Send partial chunks, and the end-of-rows signal:
+            for worker_idx in range(self.num_workers):
+                self._send_chunk(row_queues, worker_idx)
+                self._send(row_queues, worker_idx, None)
+        except Exception:
+            for worker in self.workers:
+                worker.terminate()
+            raise
+
+        truncated = self._collect_results(result_queue)
+        if checkpoint_log is not None and last_batch is not None:
+            # The workers committed all searches:
+            self._save_checkpoint(checkpoint_log, last_batch, max_row_id, {})
+        return (max_row_id, truncated)
+
+    #------------------------------------
+    # worker_for
+    #-------------------
+
+    def worker_for(self, key):
+        '''
+        Return the index of the worker that handles
+        rows with the given key. The hash must be the
+        same in every process and every run, so Python's
+        (randomized) hash() is not used.
+
+        :param key: emplid or other routing key
+        :type key: str
+        :return: worker index
+        :rtype: int
+        '''
+        return worker_for_key(key, self.num_workers)
+
+    #------------------------------------
+    # _new_ids_for
+    #-------------------
+
+    def _new_ids_for(self, worker_idx):
+        '''
+        Return the lookup table ids that the cleaner
+        assigned since the previous chunk for the given
+        worker was sent.
+
+        :rtype: [(str, tuple, int)]
+        '''
+        new_ids = self.cleaner.new_dimension_ids
+        if new_ids is None:
+            return []
+        worker_ids = new_ids[self.num_ids_sent[worker_idx]:]
+        self.num_ids_sent[worker_idx] = len(new_ids)
+        return worker_ids
+
+    #------------------------------------
+    # _send_chunk
+    #-------------------
+
+    def _send_chunk(self, row_queues, worker_idx):
+        '''
+        Send the rows collected for a worker, if
+        any, preceded by the new lookup table ids.
+        '''
+        chunk = self.chunks[worker_idx]
+        if len(chunk) == 0:
+            return
+        self._send(row_queues, worker_idx, (self._new_ids_for(worker_idx), chunk))
+        self.chunks[worker_idx] = []
+
+    #------------------------------------
+    # _sync_workers
+    #-------------------
+
+    def _sync_workers(self, row_queues, sync_queue):
+        '''
+        Send all collected rows, and have each worker
+        flush its buffers. Return once all writes are done.
+
+        :return: the pending searches of all workers
+        :rtype: {str : dict}
+        :raise RuntimeError: if a worker died
+        '''
+        for worker_idx in range(self.num_workers):
+            self._send_chunk(row_queues, worker_idx)
+            self._send(row_queues, worker_idx, self.SYNC)
+        search_states = {}
+        synced = set()
+        while len(synced) < self.num_workers:
+            try:
+                worker_idx, worker_states = sync_queue.get(timeout=self.LIVENESS_CHECK_SECS)
+            except queue.Empty:
+                self._check_alive(synced)
+                continue
+            synced.add(worker_idx)
+            search_states.update(worker_states)
+        return search_states
+
+    #------------------------------------
+    # _save_checkpoint
+    #-------------------
+
+    def _save_checkpoint(self, checkpoint_log, batch, max_row_id, search_states):
+        '''
+        Write the lookup table rows the parent holds, and
+        save a checkpoint for the state after the given
+        batch. All workers must have synced.
+        '''
+        for dim_buf in self.cleaner.dimension_bufs.values():
+            self.cleaner.flush_buffer(dim_buf)
+        self.cleaner.sink.sync()
+        IngestCheckpoint(checkpoint_log,
+                         batch.end_offset,
+                         max_row_id if max_row_id > 0 else None,
+                         compressed_offset=batch.compressed_offset,
+                         search_states=search_states).save()
+
+    #------------------------------------
+    # _check_alive
+    #-------------------
+
+    def _check_alive(self, reported):
+        '''
+        Raise RuntimeError if a worker that is not
+        among the reported ones died.
+        '''
+        for worker_idx, worker in enumerate(self.workers):
+            if worker_idx not in reported and not worker.is_alive():
+                raise RuntimeError(f"Ingest worker {worker_idx} died; exit code {worker.exitcode}")
+
+    #------------------------------------
+    # _send
+    #-------------------
+
+    def _send(self, row_queues, worker_idx, chunk):
+        '''
+        Put a chunk into a worker's queue, blocking while
+        the queue is full. Raises RuntimeError if the worker
+        died, instead of blocking forever.
+        '''
+        while True:
+            try:
+                row_queues[worker_idx].put(chunk, timeout=self.LIVENESS_CHECK_SECS)
+                return
+            except queue.Full:
+                if not self.workers[worker_idx].is_alive():
+                    raise RuntimeError(f"Ingest worker {worker_idx} died; exit code {self.workers[worker_idx].exitcode}")
+
+    #------------------------------------
+    # _collect_results
+    #-------------------
+
+    def _collect_results(self, result_queue):
+        '''
+        Wait for a result from each worker, and merge
+        the workers' IP location lookups into the
+        cleaner's cache.
+
+        :return: total number of truncated search terms
+        :rtype: int
+        :raise RuntimeError: if any worker reported an error,
+            or died without reporting
+        '''
+        truncated = 0
+        failures = []
+        reported = set()
+        while len(reported) < self.num_workers:
+            try:
+                worker_idx, num_rows, worker_truncated, ip_entries, err = \
+                    result_queue.get(timeout=self.LIVENESS_CHECK_SECS)
+            except queue.Empty:
+                self._check_alive(reported)
+                continue
+            reported.add(worker_idx)
+            if err is not None:
+                failures.append(f"Worker {worker_idx}: {err}")
+                continue
+            self.log.info(f"Worker {worker_idx} processed {num_rows} rows")
+            truncated += worker_truncated
+            if ip_entries is not None:
+                self.cleaner.ip_dict.merge(ip_entries)
+        for worker in self.workers:
+            worker.join()
+        if len(failures) > 0:
+            raise RuntimeError(f"Ingest workers failed: {failures}")
+        return truncated
+
+# ------------------------- Worker Process ----------------
+
+#------------------------------------
+# worker_for_key
+#-------------------
+
+def worker_for_key(key, num_workers):
+    '''
+    Return the index of the worker that handles rows
+    with the given key. See ParallelIngester.worker_for().
+    '''
+    return zlib.crc32(key.encode('utf8')) % num_workers
+
+#------------------------------------
+# _ingest_worker
+#-------------------
+
+def _ingest_worker(worker_idx, num_workers, cleaner, row_queue, result_queue, sync_queue):
+    '''
+    Body of each worker process. Reads (new lookup table
+    ids, chunk of (row_id, row)) from row_queue until None
+    arrives, and runs the cleaner's dispatch on each row.
+    Answers SYNC messages on sync_queue, after flushing.
+    Reports (worker_idx, num_rows, truncated_search_terms, error)
+    to result_queue when done.
+
+    :param worker_idx: index of this worker
+    :type worker_idx: int
+    :param num_workers: number of workers
+    :type num_workers: int
+    :param cleaner: forked copy of the parent's cleaner
+    :type cleaner: ActivityLogCleaner
+    :param row_queue: source of row chunks
+    :type row_queue: multiprocessing.Queue
+    :param result_queue: destination of the final report
+    :type result_queue: multiprocessing.Queue
+    :param sync_queue: destination of the pending searches
+        at each SYNC
+    :type sync_queue: multiprocessing.Queue
+    '''
+    num_rows = 0
+    try:
+        if cleaner.parquet_dir is None:
+            # The parent's connection must not be used
+            # from the child; get our own:
+            cleaner.db = cleaner.connect_db(uname=cleaner.db_user, pwd=cleaner.db_pwd)
+            cleaner.sink = cleaner.make_db_sink(cleaner.db)
+        else:
+            # Part files of our own:
+            cleaner.sink = cleaner.make_parquet_sink(part_prefix=f"w{worker_idx}-")
+        # Of the searches pending in the parent, as when
+        # resuming from a checkpoint, keep only ours:
+        cleaner.crs_search_states = {emplid : search_state 
+                                     for emplid, search_state in cleaner.crs_search_states.items()
+                                     if worker_for_key(emplid, num_workers) == worker_idx}
+        cleaner.rebuild_search_heap()
+        # Lookup table ids come from the parent:
+        cleaner.assigns_dimension_ids = False
+        last_row = None
+        while True:
+            msg = row_queue.get()
+            if msg is None:
+                break
+            if msg == ParallelIngester.SYNC:
+                cleaner.flush_all_buffers()
+                cleaner.sink.sync()
+                sync_queue.put((worker_idx, cleaner.crs_search_states))
+                continue
+            new_ids, chunk = msg
+            cleaner.add_dimension_ids(new_ids)
+            for row_id, row in chunk:
+                cleaner.cur_id = row_id
+                cleaner.dispatch_row(row, row_id)
+            last_row = chunk[-1][1]
+            num_rows += len(chunk)
+        # The parent saves the IP location cache,
+        # including our lookups:
+        cleaner.finish_ingest(last_row, save_ip_cache=False)
+        cleaner.sink.close()
+        if cleaner.parquet_dir is None:
+            cleaner.db.close()
+        ip_entries = cleaner.ip_dict.new_entries() if isinstance(cleaner.ip_dict, IpLocationCache) else None
+        result_queue.put((worker_idx, num_rows, cleaner.sink.truncated_search_terms, ip_entries, None))
+    except Exception:
+        result_queue.put((worker_idx, num_rows, 0, None, traceback.format_exc()))
@@ -0,0 +1,315 @@
+'''
+Created on Oct 18, 2026
+
+Export of the cleaned tables as Parquet files, for
+analysis without going through the db server.
+
+A ParquetTableSink takes the place of the DbTableSink.
+Each table gets a directory below the export directory,
+holding numbered part files:
+
+    <out_dir>/Pins/part-00000.parquet
+    <out_dir>/Pins/part-00001.parquet
+    <out_dir>/Activities/part-00000.parquet
+        ...
+
+Every batch written to the sink, i.e. every flushed buffer,
+is appended to the table's current part file as one row
+group. Once a part file holds ROWS_PER_FILE rows it is
+closed, and the next batch starts a new one. Workers of a
+parallel ingest write part files of their own, named with
+a per-worker prefix. Each table directory reads as one
+dataset:
+
+    pyarrow.parquet.read_table('<out_dir>/Pins')
+    arrow::open_dataset('<out_dir>/Pins')        # R
+
+Columns are typed by name (see COLUMN_TYPES): row and
+course ids are int64, times are timestamps (Parquet
+stores them in milliseconds), latitudes and longitudes
+float64, all others strings. Values that do not convert,
+like a created_at of 'NULL', become nulls.
+
+Requires pyarrow.
+'''
+
+from array import array
+import glob
+import os
+import time
+
+from logging_service import LoggingService
+
+from actlog.pipeline import TableSink
+
+# pyarrow is optional; only the export needs it:
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+class ParquetTableSink(TableSink):
+    '''
+    Used in place of a DbTableSink:
+
+        ParquetTableSink.remove_parts('/data/carta_export', ['Activities', 'Pins', ...])
+        sink = ParquetTableSink('/data/carta_export')
+        sink.write('Pins', ('row_id', 'crs_id'), [(1, 105670), ...])
+            ...
+        sink.close()
+    '''
+
+    # Rows per part file:
+    ROWS_PER_FILE = 5000000
+
+    # Parquet compression codec:
+    COMPRESSION = 'zstd'
+
+    # Kinds of the typed columns; columns not
+    # listed hold strings:
+    COLUMN_TYPES = {'row_id'      : 'int',
+                    'crs_id'      : 'int',
+                    'quarter_id'  : 'int',
+                    'student_id'  : 'int',
+                    'location_id' : 'int',
+                    'action_id'   : 'int',
+                    'created_at'  : 'timestamp',
+                    'updated_at'  : 'timestamp',
+                    'lat'         : 'float',
+                    'longitude'   : 'float'
+                    }
+
+    # Format of created_at and updated_at in the log:
+    TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    #------------------------------------
+    # Constructor
+    #-------------------
+
+    def __init__(self, out_dir, part_prefix='', rows_per_file=None, compression=None):
+        '''
+        :param out_dir: export directory; created if needed
+        :type out_dir: str
+        :param part_prefix: prepended to the part numbers in
+            the file names, like 'w1-' for worker 1
+        :type part_prefix: str
+        :param rows_per_file: rows after which a new part
+            file is started
+        :type rows_per_file: {None | int}
+        :param compression: Parquet codec, like 'snappy'
+        :type compression: {None | str}
+        :raise ImportError: if pyarrow is not installed
+        '''
+        if pa is None:
+            raise ImportError("Parquet export requires pyarrow; install it with 'pip install pyarrow'")
+        self.log = LoggingService()
+        self.out_dir = out_dir
+        self.part_prefix = part_prefix
+        self.rows_per_file = self.ROWS_PER_FILE if rows_per_file is None else rows_per_file
+        self.compression = self.COMPRESSION if compression is None else compression
+        # Table name --> arrow schema:
+        self.schemas = {}
+        # Table name --> open ParquetWriter, and the
+        # number of rows in its file:
+        self.writers = {}
+        self.file_rows = {}
+        # Table name --> number of part files started,
+        # and of rows written:
+        self.num_parts = {}
+        self.num_rows = {}
+
+    #------------------------------------
+    # write
+    #-------------------
+
+    def write(self, table, columns, rows):
+        '''
+        Append the rows to the table's current part
+        file as one row group.
+        '''
+        if len(rows) == 0:
+            return
+        start = time.time()
+        arrow_tbl = self.arrow_table(table, columns, rows)
+        try:
+            writer = self.writers[table]
+        except KeyError:
+            writer = self._open_part(table, arrow_tbl.schema)
+        writer.write_table(arrow_tbl, row_group_size=len(rows))
+        self.file_rows[table] += len(rows)
+        self.num_rows[table] = self.num_rows.get(table, 0) + len(rows)
+        if self.file_rows[table] >= self.rows_per_file:
+            self.writers.pop(table).close()
+        if self.latency_observer is not None:
+            self.latency_observer(table, len(rows), time.time() - start)
+
+    #------------------------------------
+    # arrow_table
+    #-------------------
+
+    def arrow_table(self, table, columns, rows):
+        '''
+        Convert rows into an arrow table with the
+        types of the table's schema.
+
+        :param table: table name
+        :type table: str
+        :param columns: column names
+        :type columns: (str)
+        :param rows: the rows
+        :type rows: {[tuple] | ColumnBatch}
+        :rtype: pyarrow.Table
+        '''
+        try:
+            schema = self.schemas[table]
+        except KeyError:
+            schema = self.schema_for(columns)
+            self.schemas[table] = schema
+        try:
+            col_values = rows.columns
+        except AttributeError:
+            # List of tuples:
+            col_values = list(zip(*rows))
+        return pa.Table.from_arrays([self.arrow_array(values, self.COLUMN_TYPES.get(col_nm, 'str'))
+                                     for col_nm, values in zip(columns, col_values)],
+                                    schema=schema)
+
+    #------------------------------------
+    # schema_for
+    #-------------------
+
+    @classmethod
+    def schema_for(cls, columns):
+        '''
+        Return the arrow schema of a table with the
+        given columns.
+
+        :rtype: pyarrow.Schema
+        '''
+        arrow_types = {'int'       : pa.int64(),
+                       'float'     : pa.float64(),
+                       'timestamp' : pa.timestamp('s'),
+                       'str'       : pa.string()
+                       }
+        return pa.schema([(col_nm, arrow_types[cls.COLUMN_TYPES.get(col_nm, 'str')])
+                          for col_nm in columns])
+
+    #------------------------------------
+    # arrow_array
+    #-------------------
+
+    @classmethod
+    def arrow_array(cls, values, kind):
+        '''
+        Convert one column. Integer columns of a ColumnBatch
+        are taken over without copying. Values that are not
+        of the column's kind are parsed, like the str row ids
+        of Activities; those that do not parse become nulls.
+
+        :param values: the column's values
+        :type values: {array | list | tuple}
+        :param kind: 'int', 'float', 'timestamp', or 'str'
+        :type kind: str
+        :rtype: pyarrow.Array
+        '''
+        if kind == 'int':
+            if isinstance(values, array) and values.typecode == 'q':
+                return pa.Array.from_buffers(pa.int64(), len(values), [None, pa.py_buffer(values)])
+            return cls._converted(values, pa.int64(), int)
+        if kind == 'float':
+            return cls._converted(values, pa.float64(), float)
+        if kind == 'timestamp':
+            # Epoch seconds in the compact schema, else
+            # times as in the log:
+            if isinstance(values, array):
+                return cls.arrow_array(values, 'int').cast(pa.timestamp('s'))
+            try:
+                return pa.array(values, pa.int64()).cast(pa.timestamp('s'))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                return pc.strptime(pa.array(values, pa.string()),
+                                   format=cls.TIME_FORMAT,
+                                   unit='s',
+                                   error_is_null=True)
+        return cls._converted(values, pa.string(), str)
+
+    #------------------------------------
+    # close
+    #-------------------
+
+    def close(self):
+        '''
+        Finish the open part files, and log
+        what was written.
+        '''
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        for table, num_rows in sorted(self.num_rows.items()):
+            self.log.info(f"Exported {num_rows} rows of {table} in {self.num_parts[table]} "
+                          f"part file(s) to {os.path.join(self.out_dir, table)}")
+
+    #------------------------------------
+    # remove_parts
+    #-------------------
+
+    @staticmethod
+    def remove_parts(out_dir, tables):
+        '''
+        Delete the part files an earlier export left
+        for the given tables, so that a new export
+        starts with empty tables.
+
+        :param out_dir: export directory
+        :type out_dir: str
+        :param tables: table names
+        :type tables: [str]
+        '''
+        for table in tables:
+            for part_path in glob.glob(os.path.join(out_dir, table, 'part-*.parquet')):
+                os.remove(part_path)
+
+    #------------------------------------
+    # _open_part
+    #-------------------
+
+    def _open_part(self, table, schema):
+        '''
+        Start the next part file of the given table.
+
+        :rtype: pyarrow.parquet.ParquetWriter
+        '''
+        part_num = self.num_parts.get(table, 0)
+        tbl_dir = os.path.join(self.out_dir, table)
+        os.makedirs(tbl_dir, exist_ok=True)
+        part_path = os.path.join(tbl_dir, f"part-{self.part_prefix}{part_num:05d}.parquet")
+        writer = pq.ParquetWriter(part_path, schema, compression=self.compression)
+        self.writers[table] = writer
+        self.file_rows[table] = 0
+        self.num_parts[table] = part_num + 1
+        return writer
+
+    #------------------------------------
+    # _converted
+    #-------------------
+
+    @staticmethod
+    def _converted(values, arrow_type, convert):
+        '''
+        Return the values as an array of the given type,
+        converting those that arrow does not take as they
+        are with the given function, like int().
+        '''
+        try:
+            return pa.array(values, arrow_type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+        converted = []
+        for val in values:
+            try:
+                converted.append(None if val is None else convert(val))
+            except (ValueError, TypeError):
+                converted.append(None)
+        return pa.array(converted, arrow_type)
@@ -0,0 +1,1000 @@
+'''
+Created on Oct 18, 2026
+
+Streaming pipeline for cleaning the activity log. The
+work is split into stages, each of which consumes an
+iterator of batches, and yields batches:
+
+    TsvSource      : lists of raw text lines from a plain or gzipped tsv
+    RowDecoder     : lists of (row_id, row) from the lines
+    ExtractorStage : lists of RecordBatch, the typed output of
+                     the ActivityLogCleaner's extractors, and
+                     of IngestCheckpoints, if enabled
+    SinkStage      : hands each RecordBatch to a TableSink
+
+A Pipeline chains the stages, either as generators in
+the calling thread, or with each stage in its own thread,
+connected by bounded queues. Each stage keeps statistics,
+so per-stage throughput can be reported.
+
+Running the extractors without a db:
+
+    cleaner = ActivityLogCleaner(None, unittesting=True)
+    cleaner.ip_dict = IpFullLocation()
+    sink = CountingSink()
+    cleaner.build_pipeline(log_path, sink).run()
+    print(sink.counts)
+'''
+
+from collections import namedtuple
+import csv
+import gzip
+import io
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from logging_service import LoggingService
+
+from actlog.checkpoint import IngestCheckpoint
+from actlog.columnar import ColumnBatch
+
+
+# Typed record classes, one per table; created
+# on demand by record_type():
+_record_types = {}
+
+#------------------------------------
+# record_type
+#-------------------
+
+def record_type(table, columns):
+    '''
+    Return a namedtuple class whose fields are the
+    given table's columns.
+
+    :param table: table name, like 'Pins'
+    :type table: str
+    :param columns: column names of the table
+    :type columns: (str)
+    :return: namedtuple class for records of the table
+    :rtype: type
+    '''
+    try:
+        return _record_types[table]
+    except KeyError:
+        rec_type = namedtuple(table, columns)
+        _record_types[table] = rec_type
+        return rec_type
+
+# ------------------------- RecordBatch ----------------
+
+class RecordBatch(namedtuple('RecordBatch', ['table', 'columns', 'rows'])):
+    '''
+    The rows destined for one table, as plain
+    tuples in column order. Use records() to get
+    them as namedtuples.
+    '''
+    __slots__ = ()
+
+    def records(self):
+        rec_type = record_type(self.table, self.columns)
+        return (rec_type._make(row) for row in self.rows)
+
+# ------------------------- StageStats ----------------
+
+class StageStats:
+    '''
+    Counts items flowing through a stage, and the
+    time the stage spent on its own work, excluding
+    time blocked on its neighbors.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.items_in = 0
+        self.items_out = 0
+        self.start_time = None
+        self.end_time = None
+        # Time spent waiting for input, or for
+        # room in the output queue:
+        self.wait_secs = 0.0
+
+    @property
+    def elapsed_secs(self):
+        if self.start_time is None:
+            return 0.0
+        end_time = time.time() if self.end_time is None else self.end_time
+        return end_time - self.start_time
+
+    @property
+    def busy_secs(self):
+        return max(self.elapsed_secs - self.wait_secs, 0.0)
+
+    def throughput(self):
+        '''
+        Items consumed per second of busy time.
+        '''
+        busy = self.busy_secs
+        return self.items_in / busy if busy > 0 else 0.0
+
+    def __str__(self):
+        return (f"{self.name}: {self.items_in} in, {self.items_out} out, "
+                f"{self.busy_secs:.1f}s busy, {self.wait_secs:.1f}s waiting, "
+                f"{self.throughput():.0f} items/s")
+
+# ------------------------- Stage ----------------
+
+class Stage:
+    '''
+    Base class for pipeline stages. Subclasses implement
+    process(), a generator that consumes an iterator of
+    input batches, and yields output batches. They
+    count items via self.stats.
+    '''
+
+    def __init__(self, name=None):
+        self.name = self.__class__.__name__ if name is None else name
+        self.stats = StageStats(self.name)
+
+    def process(self, batches):
+        raise NotImplementedError(f"Stage {self.name} must implement process()")
+
+# ------------------------- LineChunk, RowBatch ----------------
+
+class LineChunk(list):
+    '''
+    Lines yielded by TsvSource. If the source tracks
+    offsets, end_offsets holds, for each line, the
+    uncompressed byte offset just past it, and
+    compressed_offset the approximate position in
+    a gzipped file after the chunk was read.
+    '''
+    __slots__ = ('end_offsets', 'compressed_offset')
+
+    def __init__(self):
+        super().__init__()
+        self.end_offsets = None
+        self.compressed_offset = None
+
+class RowBatch(list):
+    '''
+    (row_id, row) pairs yielded by RowDecoder. If
+    offsets are tracked, end_offset is the uncompressed
+    byte offset just past the batch's last row, i.e. where
+    reading has to resume once the batch is processed.
+    '''
+    __slots__ = ('end_offset', 'compressed_offset')
+
+    def __init__(self):
+        super().__init__()
+        self.end_offset = None
+        self.compressed_offset = None
+
+# ------------------------- TsvSource ----------------
+
+class TsvSource(Stage):
+    '''
+    Yields LineChunks of text lines from a plain or
+    gzipped tsv file. The header line is skipped.
+    Ignores its input; must be the first stage.
+    
+    Reading may start at a byte offset, typically taken
+    from a checkpoint or a LogIndex. For gzipped files the 
+    offset is in the uncompressed stream; getting there 
+    requires decompressing everything before it, but not 
+    parsing it. If a LogIndex with gzip access points is
+    given, decompression starts at the closest access point
+    instead.
+    '''
+
+    CHUNK_LINES = 1000
+
+    def __init__(self, 
+                 path, 
+                 chunk_lines=None, 
+                 start_offset=0, 
+                 track_offsets=False, 
+                 log_index=None, 
+                 name=None):
+        '''
+        :param path: the tsv file
+        :type path: str
+        :param chunk_lines: number of lines per chunk
+        :type chunk_lines: {None | int}
+        :param start_offset: uncompressed byte offset of the
+            first line to read; 0 reads from the start, and
+            skips the header
+        :type start_offset: int
+        :param track_offsets: whether to record the end offset
+            of each line in the chunks
+        :type track_offsets: bool
+        :param log_index: index of the file, used for seeking
+        :type log_index: {None | LogIndex}
+        '''
+        super().__init__(name)
+        self.path = path
+        self.chunk_lines = self.CHUNK_LINES if chunk_lines is None else chunk_lines
+        self.start_offset = start_offset
+        self.track_offsets = track_offsets
+        self.log_index = log_index
+        # The binary file beneath the text file:
+        self.raw_fd = None
+        # Offset of the first line read, once known:
+        self.data_offset = None
+
+    def open(self):
+        '''
+        Return a text file object for the source,
+        positioned at self.start_offset.
+        '''
+        if self.log_index is not None:
+            self.raw_fd = self.log_index.open_at(self.start_offset)
+            return io.TextIOWrapper(self.raw_fd, newline='')
+        with open(self.path, 'rb') as fd:
+            magic = fd.read(2)
+        if magic == b'\x1f\x8b':
+            self.raw_fd = gzip.open(self.path, 'rb')
+        else:
+            self.raw_fd = open(self.path, 'rb')
+        if self.start_offset > 0:
+            self.raw_fd.seek(self.start_offset)
+        return io.TextIOWrapper(self.raw_fd, newline='')
+
+    def compressed_offset(self):
+        '''
+        Position in the compressed file, if gzipped.
+        The decompressor reads ahead, so this is approximate.
+        '''
+        try:
+            return self.raw_fd.fileobj.tell()
+        except AttributeError:
+            return None
+
+    def process(self, _batches=None):
+        with self.open() as fd:
+            offset = self.start_offset
+            if offset == 0:
+                header = fd.readline()
+                offset = len(header.encode(fd.encoding))
+            self.data_offset = offset
+            if self.track_offsets:
+                yield from self._offset_chunks(fd, offset)
+            else:
+                yield from self._chunks(fd)
+        self.stats.items_in = self.stats.items_out
+
+    def _chunks(self, fd):
+        chunk = LineChunk()
+        for line in fd:
+            chunk.append(line)
+            if len(chunk) >= self.chunk_lines:
+                self.stats.items_out += len(chunk)
+                yield chunk
+                chunk = LineChunk()
+        if len(chunk) > 0:
+            self.stats.items_out += len(chunk)
+            yield chunk
+
+    def _offset_chunks(self, fd, offset):
+        encoding = fd.encoding
+        chunk = LineChunk()
+        chunk.end_offsets = end_offsets = []
+        for line in fd:
+            chunk.append(line)
+            # Lines keep their line endings (newline=''), so
+            # their encoded length is their length in the file:
+            offset += len(line.encode(encoding))
+            end_offsets.append(offset)
+            if len(chunk) >= self.chunk_lines:
+                chunk.compressed_offset = self.compressed_offset()
+                self.stats.items_out += len(chunk)
+                yield chunk
+                chunk = LineChunk()
+                chunk.end_offsets = end_offsets = []
+        if len(chunk) > 0:
+            chunk.compressed_offset = self.compressed_offset()
+            self.stats.items_out += len(chunk)
+            yield chunk
+
+# ------------------------- RowDecoder ----------------
+
+class RowDecoder(Stage):
+    '''
+    Turns lists of tsv lines into RowBatches of (row_id, row),
+    using the cleaner's filtering of unusable rows. A
+    single csv reader spans all chunks, so records that
+    contain newlines are decoded correctly.
+    
+    If the lines come with end offsets, each RowBatch
+    is stamped with the offset just past its last row. The
+    csv reader does not read ahead, so that is the end of
+    the last line the reader consumed.
+    '''
+
+    def __init__(self, cleaner, min_row_id=None, max_row_id=None, name=None):
+        '''
+        :param cleaner: provides log_rows() for filtering
+        :type cleaner: ActivityLogCleaner
+        :param min_row_id: if provided, rows with lower
+            ids are skipped
+        :type min_row_id: {None | int}
+        :param max_row_id: if provided, decoding stops at
+            the first row with a higher id; the log is
+            ordered by id
+        :type max_row_id: {None | int}
+        '''
+        super().__init__(name)
+        self.cleaner = cleaner
+        self.min_row_id = min_row_id
+        self.max_row_id = max_row_id
+        # End of the last consumed line, if known:
+        self.offset = None
+        self.compressed_offset = None
+
+    def _lines(self, batches):
+        for lines in batches:
+            self.stats.items_in += len(lines)
+            end_offsets = getattr(lines, 'end_offsets', None)
+            if end_offsets is None:
+                yield from lines
+                continue
+            self.compressed_offset = lines.compressed_offset
+            for line_idx, line in enumerate(lines):
+                self.offset = end_offsets[line_idx]
+                yield line
+
+    def process(self, batches):
+        reader = csv.reader(self._lines(batches), delimiter='\t')
+        batch = RowBatch()
+        for row_id, row in self.cleaner.log_rows(reader):
+            if self.min_row_id is not None and row_id < self.min_row_id:
+                continue
+            if self.max_row_id is not None and row_id > self.max_row_id:
+                break
+            batch.append((row_id, row))
+            if len(batch) >= TsvSource.CHUNK_LINES:
+                yield self._stamped(batch)
+                batch = RowBatch()
+        if len(batch) > 0:
+            yield self._stamped(batch)
+
+    def _stamped(self, batch):
+        batch.end_offset = self.offset
+        batch.compressed_offset = self.compressed_offset
+        self.stats.items_out += len(batch)
+        return batch
+
+# ------------------------- ExtractorStage ----------------
+
+class ExtractorStage(Stage):
+    '''
+    Runs the cleaner's extractors on batches of
+    (row_id, row). Whenever one of the cleaner's buffers
+    fills, its content is yielded as a RecordBatch, rather
+    than written to a db. At the end of input, pending
+    searches are closed out, and all buffers are emptied
+    into the output.
+    
+    If checkpoint_log is given, then every
+    cleaner.SECS_BETWEEN_CHECKPOINTS, and at the end, all
+    buffers are emptied into the output, followed by an
+    IngestCheckpoint. The SinkStage saves the checkpoint
+    once everything before it is written.
+    '''
+
+    def __init__(self, cleaner, checkpoint_log=None, name=None):
+        '''
+        :param cleaner: the cleaner whose extractors run
+        :type cleaner: ActivityLogCleaner
+        :param checkpoint_log: path of the log being ingested,
+            if checkpoints are to be taken. The input batches
+            must then carry offsets.
+        :type checkpoint_log: {None | str}
+        '''
+        super().__init__(name)
+        self.cleaner = cleaner
+        self.checkpoint_log = checkpoint_log
+
+    def process(self, batches):
+        collector = CollectingSink()
+        # Divert the cleaner's flushes into our output
+        # while we run:
+        prev_sink = self.cleaner.sink
+        self.cleaner.sink = collector
+        try:
+            prev_sign_of_life = int(time.time())
+            prev_checkpoint = prev_sign_of_life
+            last_batch = None
+            # Lookup table ids in log order, as a parallel
+            # ingest assigns them:
+            assign_ids = self.cleaner.compact_schema
+            for batch in batches:
+                self.stats.items_in += len(batch)
+                for row_id, row in batch:
+                    self.cleaner.cur_id = row_id
+                    if assign_ids:
+                        self.cleaner.assign_dimension_ids(row)
+                    self.cleaner.dispatch_row(row, row_id)
+                last_batch = batch
+                # Time for printing progress, or for a checkpoint?
+                cur_time = int(time.time())
+                if self.checkpoint_log is not None and \
+                    (cur_time - prev_checkpoint) >= self.cleaner.SECS_BETWEEN_CHECKPOINTS:
+                    self._checkpoint(collector, batch)
+                    prev_checkpoint = cur_time
+                if len(collector.batches) > 0:
+                    yield from self._drain(collector)
+                if (cur_time - prev_sign_of_life) > self.cleaner.SECS_BETWEEN_HEARTBEATS:
+                    print(f"At record {self.cleaner.cur_id}", end='\r')
+                    prev_sign_of_life = cur_time
+            if last_batch is not None:
+                self.cleaner.finish_ingest(last_batch[-1][1])
+                if self.checkpoint_log is not None:
+                    self._checkpoint(collector, last_batch)
+            else:
+                # Nothing (left) to read; searches restored
+                # from a checkpoint may still be pending:
+                self.cleaner.finish_ingest()
+            if len(collector.batches) > 0:
+                yield from self._drain(collector)
+        finally:
+            self.cleaner.sink = prev_sink
+
+    def _checkpoint(self, collector, batch):
+        '''
+        Empty all of the cleaner's buffers into the collector,
+        and add a checkpoint for the state after the batch.
+        '''
+        self.cleaner.flush_all_buffers()
+        collector.batches.append(IngestCheckpoint.of_cleaner(self.cleaner,
+                                                             self.checkpoint_log,
+                                                             batch.end_offset,
+                                                             compressed_offset=batch.compressed_offset))
+
+    def _drain(self, collector):
+        out = collector.batches
+        collector.batches = []
+        self.stats.items_out += sum(len(rec_batch.rows) for rec_batch in out
+                                    if isinstance(rec_batch, RecordBatch))
+        yield out
+
+# ------------------------- SinkStage ----------------
+
+class SinkStage(Stage):
+    '''
+    Final stage: writes each RecordBatch to a
+    TableSink, and closes the sink at the end.
+    Yields the number of rows written per input batch.
+    
+    An IngestCheckpoint in the input is saved as soon
+    as the sink has finished all writes before it. The
+    checkpoint is given the row id of the last row written
+    to each table.
+    '''
+
+    def __init__(self, sink, name=None):
+        super().__init__(name)
+        self.sink = sink
+        # Table name --> row id of the last row written:
+        self.table_row_ids = {}
+
+    def process(self, batches):
+        for rec_batches in batches:
+            num_rows = 0
+            for rec_batch in rec_batches:
+                if isinstance(rec_batch, IngestCheckpoint):
+                    self.sink.sync()
+                    rec_batch.table_row_ids = dict(self.table_row_ids)
+                    rec_batch.save()
+                    continue
+                num_rows += len(rec_batch.rows)
+                self.sink.write(rec_batch.table, rec_batch.columns, rec_batch.rows)
+                if len(rec_batch.rows) > 0:
+                    self.table_row_ids[rec_batch.table] = rec_batch.rows[-1][0]
+            self.stats.items_in += num_rows
+            yield num_rows
+        self.sink.close()
+
+# ------------------------- Pipeline ----------------
+
+class Pipeline:
+    '''
+    Chains stages. The first stage is a source, whose
+    process() method is called with None. Each other
+    stage consumes the output of its predecessor.
+    '''
+
+    # Maximum number of batches waiting between
+    # two stages in threaded mode:
+    QUEUE_SIZE = 8
+
+    # Marks the end of a stage's output in a queue:
+    _END = object()
+
+    def __init__(self, stages, queue_size=None):
+        self.log = LoggingService()
+        self.stages = stages
+        self.queue_size = self.QUEUE_SIZE if queue_size is None else queue_size
+
+    #------------------------------------
+    # run
+    #-------------------
+
+    def run(self, threaded=False):
+        '''
+        Run the pipeline to completion. If threaded is
+        True, each stage runs in its own thread, and
+        stages are connected by bounded queues. Else the
+        stages are chained as generators in the calling
+        thread. Per-stage statistics are logged at the end.
+
+        :param threaded: whether to run each stage in its own thread
+        :type threaded: bool
+        '''
+        if threaded:
+            self._run_threaded()
+        else:
+            self._run_inline()
+        self.report()
+
+    def _run_inline(self):
+        now = time.time()
+        # Seconds spent inside each stage's generator,
+        # including the time of all upstream stages:
+        inside_secs = [0.0] * len(self.stages)
+        batches = None
+        for stage_idx, stage in enumerate(self.stages):
+            stage.stats.start_time = now
+            batches = self._timed(stage.process(batches), inside_secs, stage_idx)
+        for _batch in batches:
+            pass
+        now = time.time()
+        # Charge each stage only for its own share:
+        upstream_secs = 0.0
+        for stage_idx, stage in enumerate(self.stages):
+            stage.stats.end_time = now
+            own_secs = inside_secs[stage_idx] - upstream_secs
+            upstream_secs = inside_secs[stage_idx]
+            stage.stats.wait_secs = max(stage.stats.elapsed_secs - own_secs, 0.0)
+
+    def _timed(self, batches, inside_secs, stage_idx):
+        batch_iter = iter(batches)
+        while True:
+            start = time.time()
+            try:
+                batch = next(batch_iter)
+            except StopIteration:
+                inside_secs[stage_idx] += time.time() - start
+                return
+            inside_secs[stage_idx] += time.time() - start
+            yield batch
+
+    def _run_threaded(self):
+        queues = [queue.Queue(self.queue_size) for _i in range(len(self.stages) - 1)]
+        # Set when the consumer of a queue stops reading it
+        # before the end, as when decoding stops at max_row_id:
+        abandoned = [threading.Event() for _queue in queues]
+        errors = []
+        threads = []
+        for stage_idx, stage in enumerate(self.stages):
+            if stage_idx == 0:
+                in_queue = in_abandoned = None
+            else:
+                in_queue = queues[stage_idx - 1]
+                in_abandoned = abandoned[stage_idx - 1]
+            if stage_idx < len(queues):
+                out_queue = queues[stage_idx]
+                out_abandoned = abandoned[stage_idx]
+            else:
+                out_queue = out_abandoned = None
+            thread = threading.Thread(target=self._stage_thread,
+                                      args=(stage, 
+                                            (in_queue, in_abandoned), 
+                                            (out_queue, out_abandoned), 
+                                            errors),
+                                      name=f"pipeline_{stage.name}",
+                                      daemon=True)
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+    def _stage_thread(self, stage, in_queue_info, out_queue_info, errors):
+        in_queue, in_abandoned = in_queue_info
+        out_queue, out_abandoned = out_queue_info
+        stats = stage.stats
+        stats.start_time = time.time()
+        # Whether the end of the input was seen:
+        input_done = [False]
+        try:
+            inputs = None if in_queue is None else self._queue_iter(in_queue, stats, input_done)
+            for batch in stage.process(inputs):
+                if out_queue is not None:
+                    if out_abandoned.is_set():
+                        break
+                    start_wait = time.time()
+                    out_queue.put(batch)
+                    stats.wait_secs += time.time() - start_wait
+        except Exception as e:
+            errors.append(e)
+        finally:
+            stats.end_time = time.time()
+            if out_queue is not None:
+                out_queue.put(self._END)
+            # Let upstream stages finish rather than block
+            # on a full queue:
+            if in_queue is not None and not input_done[0]:
+                in_abandoned.set()
+                for _batch in self._queue_iter(in_queue, stats, input_done):
+                    pass
+
+    def _queue_iter(self, in_queue, stats, input_done):
+        while True:
+            start_wait = time.time()
+            batch = in_queue.get()
+            stats.wait_secs += time.time() - start_wait
+            if batch is self._END:
+                input_done[0] = True
+                return
+            yield batch
+
+    #------------------------------------
+    # report
+    #-------------------
+
+    def report(self):
+        for stage in self.stages:
+            self.log.info(str(stage.stats))
+
+# ------------------------- Sinks ----------------
+
+class TableSink:
+    '''
+    Destination for the rows of the cleaned tables.
+    Subclasses implement write(), and optionally close().
+    '''
+
+    # Number of search terms that did not fit
+    # into their column:
+    truncated_search_terms = 0
+
+    # Optional callable(table, num_rows, secs) that
+    # is told how long each insert took:
+    latency_observer = None
+
+    def write(self, table, columns, rows):
+        '''
+        Store the given rows in the given table.
+
+        :param table: destination table name
+        :type table: str
+        :param columns: column names, in the order of the
+            values in each row
+        :type columns: (str)
+        :param rows: the rows
+        :type rows: {[tuple] | ColumnBatch}
+        '''
+        raise NotImplementedError(f"Sink {self.__class__.__name__} must implement write()")
+
+    def sync(self):
+        '''
+        Return once all rows passed to write() so far
+        are stored. Sinks that write before returning
+        from write() need not override this.
+        '''
+        pass
+
+    def close(self):
+        pass
+
+class DbTableSink(TableSink):
+    '''
+    Writes rows into the db via the backend's
+    bulk_insert().
+    '''
+
+    def __init__(self, db):
+        self.log = LoggingService()
+        self.db = db
+
+    def write(self, table, columns, rows):
+        start = time.time()
+        (errs, warns) = self.insert(table, columns, rows)
+        if self.latency_observer is not None:
+            self.latency_observer(table, len(rows), time.time() - start)
+        self.report_insert_problems(table, errs, warns)
+
+    def insert(self, table, columns, rows):
+        '''
+        Insert the rows, and return the (errors, warnings)
+        reported by the db, without acting on them. 
+        '''
+        if isinstance(rows, ColumnBatch):
+            rows = rows.tuples()
+        return self.db.bulk_insert(table, columns, rows)
+
+    def report_insert_problems(self, table, errs, warns):
+        '''
+        Log errors and warnings from an insert, counting
+        the truncated search terms separately.
+        '''
+        if errs is not None:
+            self.log.err(f"Errors insert into tbl {table}: {errs}")
+        if warns is not None:
+            # Filter out the overlong search terms:
+            for warn in warns:
+                if warn[2].find("Data truncated for column 'search_term'") > -1:
+                    self.truncated_search_terms += 1
+                    print(f"Search terms truncated: {self.truncated_search_terms}")
+                else:
+                    self.log.warn(f"Warnings insert into tbl {table}: {warns}")
+
+            self.log.warn(f"Warnings insert into tbl {table}: {warns}")
+
+class LoadDataTableSink(DbTableSink):
+    '''
+    Writes rows into MySQL by streaming them into a
+    temporary tsv file, and loading that file with
+    LOAD DATA LOCAL INFILE. For large batches into
+    MyISAM tables this is much faster than multi-row
+    INSERT statements.
+    
+    Values are escaped the way LOAD DATA expects with
+    its default FIELDS ESCAPED BY '\\': backslash, tab,
+    newline, carriage return and NUL are backslash-escaped,
+    and None becomes \\N (NULL).
+    '''
+
+    # Escapes for characters that would otherwise
+    # end a field or line:
+    ESCAPE_TABLE = str.maketrans({'\\' : '\\\\',
+                                  '\t' : '\\t',
+                                  '\n' : '\\n',
+                                  '\r' : '\\r',
+                                  '\0' : '\\0'
+                                  })
+
+    def __init__(self, db, tmp_dir=None):
+        '''
+        :param db: open connection
+        :type db: MySqlBackend
+        :param tmp_dir: directory for the temporary files;
+            a RAM-backed directory such as /dev/shm avoids
+            disk writes. Default: system temp directory
+        :type tmp_dir: {None | str}
+        '''
+        super().__init__(db)
+        self.tmp_dir = tmp_dir
+
+    def insert(self, table, columns, rows):
+        with tempfile.NamedTemporaryFile('w', 
+                                         encoding='utf8',
+                                         newline='\n',
+                                         prefix=f"{table}_",
+                                         suffix='.tsv',
+                                         dir=self.tmp_dir,
+                                         delete=False) as fd:
+            tmp_path = fd.name
+            fd.writelines(self.tsv_lines(rows))
+        try:
+            return self.db.execute(f'''LOAD DATA LOCAL INFILE '{tmp_path}'
+                      INTO TABLE {table}
+                      CHARACTER SET utf8mb4
+                      FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'
+                      LINES TERMINATED BY '\\n'
+                      ({', '.join(columns)});
+                      '''
+            )
+        finally:
+            os.remove(tmp_path)
+
+    def tsv_lines(self, rows):
+        '''
+        Generator of LOAD DATA compatible lines, one
+        per row.
+        '''
+        escape = self.escape
+        for row in rows:
+            yield '\t'.join([escape(val) for val in row]) + '\n'
+
+    @classmethod
+    def escape(cls, val):
+        if type(val) == str:
+            return val.translate(cls.ESCAPE_TABLE)
+        if val is None:
+            return '\\N'
+        return str(val)
+
+class CollectingSink(TableSink):
+    '''
+    Keeps the written rows in memory as RecordBatch
+    instances in self.batches.
+    '''
+
+    def __init__(self):
+        self.batches = []
+
+    def write(self, table, columns, rows):
+        self.batches.append(RecordBatch(table, columns, rows))
+
+class CountingSink(TableSink):
+    '''
+    Discards rows, but counts them per table in
+    self.counts. Useful for running, and timing the
+    extraction without a db.
+    '''
+
+    def __init__(self):
+        self.counts = {}
+
+    def write(self, table, columns, rows):
+        self.counts[table] = self.counts.get(table, 0) + len(rows)
+
+class AsyncTableSink(TableSink):
+    '''
+    Wraps another sink, and performs its writes in a
+    background thread, so that parsing continues while
+    an insert is in flight. Writes are handed to the
+    thread through a bounded queue. When the queue is
+    full, write() blocks until the writer catches up.
+    
+    If the wrapped sink has an insert() method, like
+    DbTableSink, errors and warnings it returns are passed
+    back, and handed to the wrapped sink's report_insert_problems()
+    in the calling thread during the next write() or close().
+    Exceptions raised in the writer thread are re-raised
+    in the calling thread the same way.
+    
+    Flush latencies, and the time write() was blocked
+    waiting for queue space are logged by close().
+    '''
+
+    # Number of batches that may wait for the writer:
+    MAX_PENDING = 4
+
+    # Marks the end of writes in the queue:
+    _END = object()
+
+    def __init__(self, sink, max_pending=None):
+        '''
+        :param sink: the sink that does the actual writing
+        :type sink: TableSink
+        :param max_pending: max number of batches waiting
+            for the writer thread
+        :type max_pending: {None | int}
+        '''
+        self.log = LoggingService()
+        self.sink = sink
+        max_pending = self.MAX_PENDING if max_pending is None else max_pending
+        self.write_queue = queue.Queue(max_pending)
+        # Insert problems and exceptions from the writer, for
+        # the calling thread; queue.Queue is thread safe:
+        self.problems = queue.Queue()
+        
+        # Metrics: table name --> [number of flushes, total secs, max secs]:
+        self.flush_latencies = {}
+        # Seconds write() was blocked by a full queue:
+        self.stall_secs = 0.0
+
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_loop,
+                                       name='async_table_writer',
+                                       daemon=True)
+        self.writer.start()
+
+    @property
+    def truncated_search_terms(self):
+        return self.sink.truncated_search_terms
+
+    @truncated_search_terms.setter
+    def truncated_search_terms(self, num):
+        self.sink.truncated_search_terms = num
+
+    #------------------------------------
+    # write
+    #-------------------
+
+    def write(self, table, columns, rows):
+        '''
+        Queue the rows for writing. The caller must not
+        modify rows afterwards.
+        '''
+        self._handle_problems()
+        start_wait = time.time()
+        self.write_queue.put((table, columns, rows))
+        self.stall_secs += time.time() - start_wait
+
+    #------------------------------------
+    # sync
+    #-------------------
+
+    def sync(self):
+        '''
+        Wait for all queued writes to finish, and
+        report any problems they had.
+        '''
+        self.write_queue.join()
+        self._handle_problems()
+
+    #------------------------------------
+    # close
+    #-------------------
+
+    def close(self):
+        '''
+        Wait for all queued writes to finish, report
+        any remaining problems, close the wrapped sink,
+        and log the flush metrics.
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        self.write_queue.put(self._END)
+        self.writer.join()
+        self._handle_problems()
+        self.sink.close()
+        self.report()
+
+    #------------------------------------
+    # report
+    #-------------------
+
+    def report(self):
+        for table, (num_flushes, total_secs, max_secs) in sorted(self.flush_latencies.items()):
+            self.log.info(f"Flushes to {table}: {num_flushes}, "
+                          f"mean {total_secs / num_flushes:.3f}s, max {max_secs:.3f}s")
+        self.log.info(f"Parser stalled {self.stall_secs:.1f}s waiting for the db writer")
+
+    #------------------------------------
+    # _handle_problems
+    #-------------------
+
+    def _handle_problems(self):
+        while True:
+            try:
+                table, errs, warns, exc = self.problems.get_nowait()
+            except queue.Empty:
+                return
+            if exc is not None:
+                raise exc
+            self.sink.report_insert_problems(table, errs, warns)
+
+    #------------------------------------
+    # _write_loop
+    #-------------------
+
+    def _write_loop(self):
+        has_insert = hasattr(self.sink, 'insert')
+        while True:
+            item = self.write_queue.get()
+            if item is self._END:
+                self.write_queue.task_done()
+                return
+            table, columns, rows = item
+            start = time.time()
+            try:
+                if has_insert:
+                    (errs, warns) = self.sink.insert(table, columns, rows)
+                    if errs is not None or warns is not None:
+                        self.problems.put((table, errs, warns, None))
+                else:
+                    self.sink.write(table, columns, rows)
+            except Exception as e:
+                self.problems.put((table, None, None, e))
+            latency = time.time() - start
+            if self.latency_observer is not None:
+                self.latency_observer(table, len(rows), latency)
+            try:
+                stats = self.flush_latencies[table]
+                stats[0] += 1
+                stats[1] += latency
+                stats[2] = max(stats[2], latency)
+            except KeyError:
+                self.flush_latencies[table] = [1, latency, latency]
+            # Only now may sync() return:
+            self.write_queue.task_done()
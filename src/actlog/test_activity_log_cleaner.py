@@ -3,16 +3,177 @@ Created on Nov 22, 2021
 
 @author: paepcke
 '''
+import copy
+import io
 import os
+import tempfile
 import unittest
+from unittest import mock
 
 from actlog.activity_log_cleaning import ActivityLogCleaner, BufferClass
+from actlog.bulk_load import BulkLoadSession
+from actlog.checkpoint import IngestCheckpoint
+from actlog.columnar import ColumnarBuffer, ColumnBatch
+from actlog.db_backends import MySqlBackend, SqliteBackend
+from actlog.env_scanner import EnvironmentScanner
+from actlog.flush_coordinator import FlushCoordinator
+from actlog.index_builder import IndexBuilder
+from actlog.int_lists import IntListParser
+from actlog.ip_cache import IpLocationCache
 from actlog.ipToFullLocation import IpFullLocation
+from actlog.ip_table_file import IpRangeColumns, IpTableFile
+from actlog.log_index import LogIndex, gzip_members, rechunk_gzip
+from actlog.parallel_ingest import ParallelIngester
+from actlog.parquet_sink import ParquetTableSink
+from actlog.pipeline import AsyncTableSink, CollectingSink, CountingSink, DbTableSink, \
+    LoadDataTableSink, TableSink, TsvSource
+
+# pyarrow is optional; without it the Parquet
+# export is not tested:
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
 
 #*****TEST_ALL = True
 TEST_ALL = False
 
 
+# Column names of the activity log:
+LOG_HEADER = ['id', 'emplid', 'ip_address', 'caller', 'action', 'key_parameter',
+              'environment', 'output', 'browser', 'created_at', 'updated_at']
+
+def write_log(rows, log_path=None):
+    '''
+    Write an activity log with the given rows of str
+    values after the header, to log_path, or to a new
+    temporary file, which the caller removes. Returns
+    the path of the log.
+    '''
+    if log_path is None:
+        with tempfile.NamedTemporaryFile('w', suffix='.tsv', delete=False) as fd:
+            log_path = fd.name
+    with open(log_path, 'w') as fd:
+        for row in [LOG_HEADER] + rows:
+            fd.write('\t'.join(row) + '\n')
+    return log_path
+
+def sample_log_rows(num_rows):
+    '''
+    Return num_rows rows of an activity log, with pins,
+    course views, searches, and environments of 13
+    visitors at 5 IP addresses.
+    '''
+    rows = []
+    for row_id in range(1, num_rows + 1):
+        crs_id = 105670 + row_id % 17
+        course = f"{{selected_course:{crs_id}, name:CS{row_id % 17}}}"
+        env, output = 'NULL', 'NULL'
+        kind = row_id % 4
+        if kind == 0:
+            caller, action, key_param = 'pin', 'pin', course
+        elif kind == 1:
+            caller, action, key_param = 'get_course_info', 'view', course
+        elif kind == 2:
+            caller, action, key_param = 'find_search', 'search', f"{{search_term:cs {row_id % 30}}}"
+            output = f"{{results:[{crs_id}, 105687]}}"
+        else:
+            caller, action, key_param = 'initial_recommendation', 'x', '{}'
+            env = f"stuff {{pinned:{{1156:{crs_id}}}, course_history_ids:[102794, {crs_id}]}}"
+        created_at = f"2016-01-01 {row_id // 3600:02}:{row_id // 60 % 60:02}:{row_id % 60:02}"
+        rows.append([str(row_id), f"emplid{row_id % 13}", f"171.66.16.{row_id % 5}", caller, action,
+                     key_param, env, output, 'Mozilla', created_at, created_at])
+    return rows
+
+def table_contents(actlog_cleaner):
+    '''
+    Return a dict of the sorted rows of each table the
+    given cleaner writes, read through its db connection.
+    '''
+    return {tbl_nm : sorted(actlog_cleaner.db.query(f"SELECT * FROM {tbl_nm}"), key=repr)
+            for tbl_nm, _cols in actlog_cleaner.buffer_tables.values()}
+
+
+class SmallBatchCleaner(ActivityLogCleaner):
+    '''
+    Flushes its buffers after a few rows, so that
+    short logs lead to many writes.
+    '''
+    DB_BATCH_SIZE_BIG = 40
+    DB_BATCH_SIZE_SMALL = 10
+
+
+class CrashingSink(TableSink):
+    '''
+    Passes writes on to another sink, but fails
+    the fail_at'th write, like a crashing ingest.
+    '''
+    def __init__(self, sink, fail_at):
+        self.sink = sink
+        self.fail_at = fail_at
+        self.num_writes = 0
+
+    def write(self, table, columns, rows):
+        self.num_writes += 1
+        if self.num_writes == self.fail_at:
+            raise RuntimeError('Crash')
+        self.sink.write(table, columns, rows)
+
+
+class UnknownIpLocations:
+    '''
+    Stands in for IpFullLocation in tests that
+    do not need the IP table; knows only the given
+    locations.
+    '''
+    def __init__(self, locations=None):
+        self.locations = {} if locations is None else locations
+
+    def get(self, ip_str, default=None):
+        return self.locations.get(ip_str, default)
+
+    def lookupIP(self, ip_str):
+        return self.locations[ip_str]
+
+
+class WarningDb:
+    '''
+    Stands in for MySQLDB; every bulkInsert reports
+    one truncated search term.
+    '''
+    def __init__(self):
+        self.inserted = []
+
+    def bulkInsert(self, tbl_nm, col_names, rows):
+        self.inserted.extend(rows)
+        return (None, [('Warning', 1265, "Data truncated for column 'search_term' at row 1")])
+
+
+class RecordingDb:
+    '''
+    Stands in for MySQLDB; records executed statements,
+    and answers queries from a dict of canned results.
+    The results for the first key that occurs in a
+    query are returned.
+    '''
+    def __init__(self, query_results):
+        self.query_results = query_results
+        self.statements = []
+
+    def query(self, query_str):
+        for key, results in self.query_results.items():
+            if key in query_str:
+                return iter(results)
+        raise ValueError(f"No canned result for {query_str}")
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        return (None, None)
+
+    def close(self):
+        pass
+
+
 class Test(unittest.TestCase):
 
     @classmethod
@@ -255,6 +416,1073 @@ class Test(unittest.TestCase):
                              [actlog_cleaner.DEFAULT_IPLOC_TUPLE]
                              )
 
+    #------------------------------------
+    # test_parallel_routing
+    #-------------------
+    
+    def test_parallel_routing(self):
+        
+        actlog_cleaner = ActivityLogCleaner(None, unittesting=True)
+        ingester = ParallelIngester(actlog_cleaner, 4, key_pos=1)
+        
+        # Same emplid always goes to the same worker:
+        emplid = '$2b$15$Kk3zHbZyk9q2K4skrd/47OvPtG/KBoE41TftO6xwO0Tz7cIgJlj46'
+        worker_idx = ingester.worker_for(emplid)
+        self.assertEqual(ingester.worker_for(emplid), worker_idx)
+        self.assertIn(worker_idx, range(4))
+        
+        # Many emplids spread over all workers:
+        used = {ingester.worker_for(f"emplid{i}") for i in range(100)}
+        self.assertSetEqual(used, {0, 1, 2, 3})
+        
+        # A worker that dies without reporting fails
+        # the ingest, rather than hanging it:
+        ingester = ParallelIngester(actlog_cleaner, 1, key_pos=1)
+        ingester.LIVENESS_CHECK_SECS = 0.1
+        worker = ingester.mp_context.Process(target=os._exit, args=(3,))
+        worker.start()
+        worker.join()
+        ingester.workers = [worker]
+        with self.assertRaisesRegex(RuntimeError, 'exit code 3'):
+            ingester._collect_results(ingester.mp_context.Queue())
+
+    #------------------------------------
+    # test_parallel_matches_serial
+    #-------------------
+    
+    def test_parallel_matches_serial(self):
+        
+        locations = {f"171.66.16.{host}" : ('US', 'United States', 'California', f"City{host % 3}",
+                                             37.4 + host % 3, -122.1, '94305', '-07:00', '1', '650')
+                     for host in range(5)}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = write_log(sample_log_rows(400), os.path.join(tmp_dir, 'log.tsv'))
+            for compact_schema in (False, True):
+                contents = {}
+                for num_workers in (1, 2, 3):
+                    db_path = os.path.join(tmp_dir, f"actlog_{compact_schema}_{num_workers}.sqlite")
+                    actlog_cleaner = SmallBatchCleaner(log_path,
+                                                       sqlite_path=db_path,
+                                                       num_workers=num_workers,
+                                                       compact_schema=compact_schema,
+                                                       unittesting=True)
+                    actlog_cleaner.ip_dict = UnknownIpLocations(locations)
+                    actlog_cleaner.open_db()
+                    if num_workers > 1:
+                        actlog_cleaner.ingest_parallel(log_path)
+                    else:
+                        actlog_cleaner.ingest(log_path)
+                    contents[num_workers] = table_contents(actlog_cleaner)
+                    actlog_cleaner.db.close()
+                # Every table, including the lookup tables of
+                # the compact schema, is the same:
+                self.assertDictEqual(contents[2], contents[1])
+                self.assertDictEqual(contents[3], contents[1])
+                self.assertGreater(min(len(contents[1][tbl_nm]) for tbl_nm in ('Pins', 'CrseSearches', 'CrseSelects')), 0)
+                if compact_schema:
+                    self.assertEqual(len(contents[1]['Locations']), 3)
+
+    #------------------------------------
+    # test_parallel_ip_cache
+    #-------------------
+
+    def test_parallel_ip_cache(self):
+
+        ip_table = UnknownIpLocations({f"171.66.16.{host}" : ('US', 'United States', 'California', 'Stanford',
+                                                               37.4, -122.1, '94305', '-07:00', '1', '650')
+                                       for host in range(3)})
+        ip_table.version = 'v1'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = write_log(sample_log_rows(400), os.path.join(tmp_dir, 'log.tsv'))
+            cache_path = os.path.join(tmp_dir, 'ip_locations.cache')
+            actlog_cleaner = SmallBatchCleaner(log_path,
+                                               sqlite_path=os.path.join(tmp_dir, 'actlog.sqlite'),
+                                               num_workers=3,
+                                               unittesting=True)
+            actlog_cleaner.ip_dict = IpLocationCache(ip_table, cache_path=cache_path)
+            actlog_cleaner.open_db()
+            actlog_cleaner.ingest_parallel(log_path)
+            actlog_cleaner.db.close()
+            # Lookups of all workers, including the
+            # addresses without location, were saved:
+            saved_cache = IpLocationCache(ip_table, cache_path=cache_path)
+            self.assertSetEqual(set(saved_cache.entries.keys()),
+                                {f"171.66.16.{host}" for host in range(5)})
+            self.assertIsNone(saved_cache.entries['171.66.16.4'])
+            self.assertEqual(saved_cache.get('171.66.16.0')[3], 'Stanford')
+            self.assertEqual(saved_cache.num_misses, 0)
+
+        ip_cache = IpLocationCache(ip_table, max_entries=2)
+        ip_cache.get('171.66.16.0')
+        other_cache = IpLocationCache(ip_table)
+        other_cache.get('171.66.16.1')
+        other_cache.get('171.66.16.2')
+        ip_cache.merge(other_cache.new_entries())
+        self.assertEqual(len(ip_cache), 2)
+        self.assertNotIn('171.66.16.0', ip_cache.entries)
+
+    #------------------------------------
+    # test_pipeline_without_db
+    #-------------------
+    
+    def test_pipeline_without_db(self):
+        
+        rows = [
+            ['1', 'emplid1', '171.66.16.37', 'pin', 'pin', '{selected_course:105670, name:CS140}',
+             'NULL', 'NULL', 'Mozilla', '2016-01-01 10:00:00', '2016-01-01 10:00:00'],
+            ['2', 'emplid1', '171.66.16.37', 'find_search', 'search', '{search_term:cs 1}',
+             'NULL', '{results:[105670, 105687]}', 'Mozilla', '2016-01-01 10:00:01', '2016-01-01 10:00:01'],
+            ['3', 'emplid1', '171.66.16.37', 'find_search', 'search', '{search_term:cs 10}',
+             'NULL', 'NULL', 'Mozilla', '2016-01-01 10:00:02', '2016-01-01 10:00:02'],
+            ]
+        log_path = write_log(rows)
+        
+        actlog_cleaner = ActivityLogCleaner(None, unittesting=True)
+        actlog_cleaner.ip_dict = UnknownIpLocations()
+        sink = CollectingSink()
+        try:
+            actlog_cleaner.build_pipeline(log_path, sink).run()
+        finally:
+            os.remove(log_path)
+        
+        tables = {rec_batch.table : rec_batch for rec_batch in sink.batches}
+        self.assertListEqual(tables['Pins'].rows, [(1, 105670)])
+        self.assertListEqual(tables['CrseSearches'].rows, 
+                             [(2, 'cs 10', '[105670, 105687]', None)])
+        # Only one activity for the pin, and one for the search:
+        self.assertEqual(len(tables['Activities'].rows), 2)
+        # Typed records:
+        pin = next(tables['Pins'].records())
+        self.assertEqual(pin.crs_id, 105670)
+
+    #------------------------------------
+    # test_checkpoint_resume
+    #-------------------
+    
+    def test_checkpoint_resume(self):
+        
+        rows = [
+            ['1', 'emplid1', '171.66.16.37', 'pin', 'pin', '{selected_course:105670, name:CS140}',
+             'NULL', 'NULL', 'Mozilla', '2016-01-01 10:00:00', '2016-01-01 10:00:00'],
+            ['2', 'emplid1', '171.66.16.37', 'find_search', 'search', '{search_term:cs 1}',
+             'NULL', '{results:[105670, 105687]}', 'Mozilla', '2016-01-01 10:00:01', '2016-01-01 10:00:01'],
+            ]
+        appended_row = ['3', 'emplid2', '171.66.16.38', 'find_search', 'search', '{search_term:me 1}',
+                        'NULL', 'NULL', 'Mozilla', '2016-01-01 10:00:02', '2016-01-01 10:00:02']
+        log_path = write_log(rows)
+        checkpoint_path = IngestCheckpoint.path_for(log_path)
+        try:
+            actlog_cleaner = ActivityLogCleaner(None, unittesting=True)
+            actlog_cleaner.ip_dict = UnknownIpLocations()
+            actlog_cleaner.build_pipeline(log_path, CollectingSink(), checkpoints=True).run()
+            
+            # A checkpoint is saved at the end of the input:
+            checkpoint = IngestCheckpoint.load(checkpoint_path)
+            self.assertEqual(checkpoint.offset, os.path.getsize(log_path))
+            self.assertEqual(checkpoint.last_row_id, 2)
+            self.assertEqual(checkpoint.table_row_ids['Pins'], 1)
+            self.assertEqual(checkpoint.table_row_ids['CrseSearches'], 2)
+            self.assertDictEqual(checkpoint.search_states, {})
+            
+            # Rows appended to the log are all that a
+            # resumed run reads:
+            with open(log_path, 'a') as append_fd:
+                append_fd.write('\t'.join(appended_row) + '\n')
+            self.assertTrue(checkpoint.matches(log_path))
+            actlog_cleaner = ActivityLogCleaner(None, unittesting=True)
+            actlog_cleaner.ip_dict = UnknownIpLocations()
+            actlog_cleaner.start_fresh = checkpoint
+            start_offset, min_row_id = actlog_cleaner.resume_point()
+            sink = CollectingSink()
+            actlog_cleaner.build_pipeline(log_path, sink, 
+                                          min_row_id=min_row_id, 
+                                          start_offset=start_offset).run()
+            tables = {rec_batch.table : rec_batch for rec_batch in sink.batches}
+            self.assertListEqual([row[0] for row in tables['Activities'].rows], ['3'])
+            self.assertListEqual(tables['CrseSearches'].rows, [(3, 'me 1', None, None)])
+        finally:
+            os.remove(log_path)
+            IngestCheckpoint.remove(checkpoint_path)
+        
+        # Restoring a checkpoint with a pending search
+        # deletes rows written after it:
+        checkpoint.last_row_id = 3
+        checkpoint.search_states = {'emplid2' : {'row_id' : 3, 'created_at' : '2016-01-01 10:00:02'}}
+        actlog_cleaner.db = RecordingDb({})
+        actlog_cleaner.restore_checkpoint(checkpoint)
+        self.assertIn('DELETE FROM Activities WHERE row_id > 3', actlog_cleaner.db.statements)
+        self.assertIn('DELETE FROM CrseSearches WHERE row_id IN (3)', actlog_cleaner.db.statements)
+        self.assertListEqual(list(actlog_cleaner.crs_search_states.keys()), ['emplid2'])
+
+    #------------------------------------
+    # test_resume_before_first_checkpoint
+    #-------------------
+    
+    def test_resume_before_first_checkpoint(self):
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = write_log(sample_log_rows(400), os.path.join(tmp_dir, 'log.tsv'))
+            
+            def new_cleaner(db_nm):
+                actlog_cleaner = SmallBatchCleaner(log_path,
+                                                   sqlite_path=os.path.join(tmp_dir, db_nm),
+                                                   unittesting=True)
+                actlog_cleaner.ip_dict = UnknownIpLocations()
+                return actlog_cleaner
+            
+            actlog_cleaner = new_cleaner('complete.sqlite')
+            actlog_cleaner.open_db()
+            actlog_cleaner.ingest(log_path)
+            expected = table_contents(actlog_cleaner)
+            actlog_cleaner.db.close()
+            
+            # Crash early, long before the first regular checkpoint:
+            actlog_cleaner = new_cleaner('resumed.sqlite')
+            actlog_cleaner.open_db()
+            actlog_cleaner.sink = CrashingSink(actlog_cleaner.sink, fail_at=5)
+            with self.assertRaises(RuntimeError):
+                actlog_cleaner.ingest(log_path)
+            actlog_cleaner.db.close()
+            
+            # Resuming without wiping the tables gives
+            # the same tables as the run without crash:
+            actlog_cleaner = new_cleaner('resumed.sqlite')
+            with mock.patch('builtins.input', return_value='n'):
+                actlog_cleaner.open_db()
+            actlog_cleaner.ingest(log_path)
+            self.assertDictEqual(table_contents(actlog_cleaner), expected)
+            self.assertGreater(len(expected['CrseSearches']), 0)
+            actlog_cleaner.db.close()
+            
+            # Without a checkpoint, resuming is refused:
+            IngestCheckpoint.remove(IngestCheckpoint.path_for(log_path))
+            actlog_cleaner = new_cleaner('resumed.sqlite')
+            with mock.patch('builtins.input', return_value='n'):
+                with self.assertRaisesRegex(RuntimeError, 'No checkpoint'):
+                    actlog_cleaner.open_db()
+            actlog_cleaner.db.close()
+
+    #------------------------------------
+    # test_parallel_checkpoints
+    #-------------------
+    
+    def test_parallel_checkpoints(self):
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = write_log(sample_log_rows(400), os.path.join(tmp_dir, 'log.tsv'))
+            
+            def new_cleaner(db_nm, num_workers):
+                actlog_cleaner = SmallBatchCleaner(log_path,
+                                                   sqlite_path=os.path.join(tmp_dir, db_nm),
+                                                   num_workers=num_workers,
+                                                   unittesting=True)
+                actlog_cleaner.ip_dict = UnknownIpLocations()
+                return actlog_cleaner
+            
+            actlog_cleaner = new_cleaner('serial.sqlite', 1)
+            actlog_cleaner.open_db()
+            actlog_cleaner.ingest(log_path)
+            expected = table_contents(actlog_cleaner)
+            actlog_cleaner.db.close()
+            
+            # A checkpoint after every batch of 50 rows:
+            saved = []
+            def record(checkpoint, path=None):
+                saved.append(checkpoint.to_dict())
+            actlog_cleaner = new_cleaner('parallel.sqlite', 2)
+            actlog_cleaner.open_db()
+            with mock.patch.object(TsvSource, 'CHUNK_LINES', 50), \
+                 mock.patch.object(SmallBatchCleaner, 'SECS_BETWEEN_CHECKPOINTS', 0), \
+                 mock.patch.object(IngestCheckpoint, 'save', autospec=True, side_effect=record):
+                actlog_cleaner.ingest_parallel(log_path)
+            self.assertDictEqual(table_contents(actlog_cleaner), expected)
+            # Like a crash after the middle checkpoint, with
+            # some of the later rows written:
+            actlog_cleaner.db.execute('DELETE FROM EnrollmentHist WHERE row_id > 250')
+            actlog_cleaner.db.execute('DELETE FROM CrseSearches WHERE row_id > 300')
+            actlog_cleaner.db.close()
+            # Start, 8 batches, end:
+            self.assertEqual(len(saved), 10)
+            self.assertEqual(saved[-1]['last_row_id'], 400)
+            self.assertEqual(saved[-1]['offset'], os.path.getsize(log_path))
+            
+            # Resuming from a checkpoint taken while searches
+            # were pending gives the same tables:
+            checkpoint = IngestCheckpoint(**saved[4])
+            self.assertEqual(checkpoint.last_row_id, 200)
+            self.assertGreater(len(checkpoint.search_states), 0)
+            checkpoint.save()
+            actlog_cleaner = new_cleaner('parallel.sqlite', 2)
+            with mock.patch('builtins.input', return_value='n'):
+                actlog_cleaner.open_db()
+            actlog_cleaner.ingest_parallel(log_path)
+            self.assertDictEqual(table_contents(actlog_cleaner), expected)
+            actlog_cleaner.db.close()
+
+    #------------------------------------
+    # test_log_index
+    #-------------------
+    
+    def test_log_index(self):
+        
+        header = 'id\templid\tcreated_at\tupdated_at\n'
+        lines = [f"{row_id}\templid{row_id}\t2016-01-{row_id:02} 10:00:00\t2016-01-{row_id:02} 10:00:00\n"
+                 for row_id in range(1, 21)]
+        with tempfile.NamedTemporaryFile('w', suffix='.tsv', delete=False) as fd:
+            fd.writelines([header] + lines)
+        gz_path = fd.name + '.gz'
+        try:
+            rechunk_gzip(fd.name, gz_path, member_bytes=100)
+            # Members of at most 100 uncompressed bytes:
+            self.assertEqual(len(gzip_members(gz_path)), 
+                             (len(header) + sum(len(line) for line in lines) + 99) // 100)
+            for log_path in (fd.name, gz_path):
+                log_index = LogIndex.build(log_path, every=3)
+                self.assertListEqual(log_index.row_ids, [1, 4, 7, 10, 13, 16, 19])
+                # Each entry's offset is the start of its row:
+                for row_id, offset in zip(log_index.row_ids, log_index.offsets):
+                    with log_index.open_at(offset) as row_fd:
+                        self.assertEqual(row_fd.readline().decode(), lines[row_id - 1])
+                with log_index.open_at(log_index.offset_for_row_id(12)) as row_fd:
+                    self.assertTrue(row_fd.readline().startswith(b'10\t'))
+                self.assertEqual(log_index.offset_for_row_id(0), 0)
+                # January 5th to 8th, inclusive:
+                self.assertTupleEqual(log_index.row_range_for_dates('2016-01-05', '2016-01-09'), (5, 8))
+                self.assertTupleEqual(log_index.row_range_for_dates('2016-01-15', None), (15, None))
+            
+            log_index.save()
+            self.assertEqual(LogIndex.load(gz_path).offsets, log_index.offsets)
+        finally:
+            for path in (fd.name, gz_path, LogIndex.path_for(gz_path)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    #------------------------------------
+    # test_env_scanner
+    #-------------------
+
+    def test_env_scanner(self):
+
+        scanner = EnvironmentScanner()
+
+        env = '{pinned:{1156:208582, 1162:120904}, course_history_ids:[102794, 105644], pinned:{1172:100001}}'
+        # Like the greedy regex: last pins in the line:
+        self.assertListEqual(scanner.pins(env), [(1172, 100001)])
+        self.assertEqual(scanner.enrollment_history(env), '[102794, 105644]')
+
+        # Pins in a later line are not found past the first:
+        env = '{pinned:{1156:208582}\npinned:{1162:120904}}'
+        self.assertListEqual(scanner.pins(env), [(1156, 208582)])
+
+        env = ('{"pinned_courses"=>[#<Enrollment STRM: 1214, CLASS_NBR: 25600, CRSE_ID: 204608, SUBJECT: "CS">], '
+               '"registered_courses"=>[#<Enrollment STRM: nil, CLASS_NBR: nil, CRSE_ID: 105687>, '
+               '#<Enrollment STRM: nil, CLASS_NBR: nil, CRSE_ID: 105690>]}')
+        self.assertTupleEqual(scanner.scan(env), ([(1214, 204608)], [105687, 105690]))
+
+        self.assertTupleEqual(scanner.scan('{"recommendations"=>[]}'), ([], None))
+
+    #------------------------------------
+    # test_int_list_parser
+    #-------------------
+
+    def test_int_list_parser(self):
+
+        parser = IntListParser()
+        self.assertListEqual(list(parser.parse(b'[102794, 105644,105645]')), [102794, 105644, 105645])
+        self.assertListEqual(list(parser.parse(' [1, 2,] ')), [1, 2])
+        self.assertListEqual(list(parser.parse('[]')), [])
+        self.assertEqual(parser.num_malformed, 0)
+
+        self.assertIsNone(parser.parse('[1, Foo]'))
+        self.assertIsNone(parser.parse('102794, 105644'))
+        self.assertListEqual(parser.parse_pairs('1156:208582, 1162, 1172:100001'),
+                             [(1156, 208582), (1172, 100001)])
+        self.assertEqual(parser.num_malformed, 3)
+
+        # Same text as str() of the int list:
+        for digit_strs in (['213685', '213686'], ['012345', '213686'], []):
+            self.assertEqual(parser.format(digit_strs), str([int(digits) for digits in digit_strs]))
+        self.assertEqual(parser.format_zeros(3), str([0] * 3))
+
+        # Malformed lists are not buffered:
+        actlog_cleaner = ActivityLogCleaner(None, unittesting=True)
+        res_buf = BufferClass('test_buf', 100)
+        actlog_cleaner.buffer_int_arr(res_buf, 1, b'[123, 456')
+        actlog_cleaner.buffer_int_arr(res_buf, 2, b'[789]')
+        self.assertListEqual(res_buf.arr, [(2, 789)])
+        self.assertEqual(actlog_cleaner.int_parser.num_malformed, 1)
+
+    #------------------------------------
+    # test_columnar_buffer
+    #-------------------
+
+    def test_columnar_buffer(self):
+
+        actlog_cleaner = ActivityLogCleaner(None, columnar_buffers=True, unittesting=True)
+        buf = actlog_cleaner.enrl_hist_buf
+        self.assertIsInstance(buf, ColumnarBuffer)
+
+        actlog_cleaner.buffer_int_arr(buf, 1, b'[123, 456]')
+        actlog_cleaner.buffer_int_arr(buf, 2, [789])
+        buf.append((3, None))
+        self.assertListEqual(buf.arr, [(1, 123), (1, 456), (2, 789), (3, None)])
+
+        # Sinks receive the columns; the buffer starts
+        # over with new ones:
+        sink = CollectingSink()
+        actlog_cleaner.sink = sink
+        actlog_cleaner.flush_buffer(buf)
+        batch = sink.batches[0].rows
+        self.assertIsInstance(batch, ColumnBatch)
+        self.assertEqual(len(batch), 4)
+        self.assertTupleEqual(batch[-1], (3, None))
+        self.assertListEqual(buf.arr, [])
+        self.assertEqual(len(batch), 4)
+        self.assertListEqual(list(LoadDataTableSink(None).tsv_lines(batch)),
+                             ['1\t123\n', '1\t456\n', '2\t789\n', '3\t\\N\n'])
+
+    #------------------------------------
+    # test_flush_coordinator
+    #-------------------
+
+    def test_flush_coordinator(self):
+
+        coordinator = FlushCoordinator(memory_budget=10000, max_packet_bytes=100000)
+        pins_buf = BufferClass('pins_buf', 150)
+        search_buf = BufferClass('crs_search_buf', 1000)
+        coordinator.register(pins_buf, 'Pins', ('q', 'q'))
+        coordinator.register(search_buf, 'CrseSearches', ('q', None, None, None))
+
+        # Pins rows have a fixed size, and are flushed
+        # at the batch size:
+        for row_id in range(149):
+            self.assertTupleEqual(coordinator.added(pins_buf, (row_id, 123456)), ())
+        self.assertTupleEqual(coordinator.added(pins_buf, (149, 123456)), (pins_buf,))
+        coordinator.flushed(pins_buf)
+        self.assertEqual(coordinator.total_bytes, 0)
+
+        # Long searches are flushed before reaching half
+        # the packet size:
+        coordinator.max_packet_bytes = 3000
+        search_row = (1, 'cs', '[' + ', '.join(['123456'] * 100) + ']', None)
+        self.assertTupleEqual(coordinator.added(search_buf, search_row), ())
+        self.assertTupleEqual(coordinator.added(search_buf, search_row), (search_buf,))
+        coordinator.flushed(search_buf)
+
+        # Strings count in UTF-8 bytes:
+        self.assertEqual(coordinator.row_bytes(('größe',)) - coordinator.row_bytes(('grosse',)), 1)
+
+        # Over budget, the largest buffer goes first:
+        coordinator.max_packet_bytes = 100000
+        coordinator.added_pairs(pins_buf, 100)
+        for _ in range(9):
+            self.assertTupleEqual(coordinator.added(search_buf, search_row), ())
+        self.assertListEqual(coordinator.added(search_buf, search_row), [search_buf])
+        self.assertEqual(coordinator.num_budget_flushes, 1)
+
+        # Fast inserts grow the batch size, up to the max;
+        # slow ones shrink it:
+        coordinator.record_flush('Pins', 150, 0.01)
+        self.assertEqual(coordinator.table_states['Pins'].batch_rows, 600)
+        coordinator.record_flush('Pins', 600, 6.0)
+        self.assertEqual(coordinator.table_states['Pins'].batch_rows, 350)
+
+        # The cleaner flushes through the coordinator:
+        actlog_cleaner = ActivityLogCleaner(None, memory_budget=10000, unittesting=True)
+        sink = CountingSink()
+        actlog_cleaner.sink = sink
+        actlog_cleaner.flush_coordinator.max_packet_bytes = 1000
+        for row_id in range(100):
+            actlog_cleaner.buffer(actlog_cleaner.pins_buf, (row_id, 123456))
+        # 100 rows of 24 bytes, in batches of up to 500 bytes:
+        self.assertEqual(sink.counts['Pins'], 100 - 100 % 21)
+
+    #------------------------------------
+    # test_search_timeout
+    #-------------------
+
+    def test_search_timeout(self):
+
+        def search_row(row_id, emplid, term, created_at):
+            return [str(row_id), emplid, '171.66.16.37', 'find_search', 'search', f'{{search_term:{term}}}',
+                    'NULL', 'NULL', 'Mozilla', created_at, created_at]
+
+        actlog_cleaner = ActivityLogCleaner(None, search_timeout=3600, unittesting=True)
+        actlog_cleaner.ip_dict = UnknownIpLocations()
+        actlog_cleaner.dispatch_row(search_row(1, 'emplid1', 'cs 1', '2016-01-01 10:00:00'), 1)
+        actlog_cleaner.dispatch_row(search_row(2, 'emplid2', 'stats', '2016-01-01 10:30:00'), 2)
+        self.assertEqual(actlog_cleaner.search_deadline, '2016-01-01 11:00:00')
+
+        # Another visitor's row an hour later
+        # commits the first search only:
+        actlog_cleaner.dispatch_row(search_row(3, 'emplid3', 'math', '2016-01-01 11:00:00'), 3)
+        self.assertListEqual(actlog_cleaner.crs_search_buf.arr, [(1, 'cs 1', None, None)])
+        self.assertListEqual(sorted(actlog_cleaner.crs_search_states.keys()), ['emplid2', 'emplid3'])
+        self.assertEqual(actlog_cleaner.search_deadline, '2016-01-01 11:30:00')
+
+        # Searching again later starts a new search:
+        actlog_cleaner.dispatch_row(search_row(4, 'emplid2', 'stats 60', '2016-01-01 11:45:00'), 4)
+        self.assertListEqual(actlog_cleaner.crs_search_buf.arr,
+                             [(1, 'cs 1', None, None), (2, 'stats', None, None)])
+        self.assertEqual(actlog_cleaner.crs_search_states['emplid2']['row_id'], 4)
+
+        actlog_cleaner.rebuild_search_heap()
+        self.assertListEqual([row_id for _secs, row_id, _emplid in sorted(actlog_cleaner.search_heap)], [3, 4])
+
+        # The timeout counts from the last keystroke:
+        actlog_cleaner.dispatch_row(search_row(5, 'emplid3', 'math 51', '2016-01-01 11:50:00'), 5)
+        actlog_cleaner.dispatch_row(search_row(6, 'emplid5', 'econ', '2016-01-01 12:10:00'), 6)
+        self.assertIn('emplid3', actlog_cleaner.crs_search_states)
+        self.assertEqual(actlog_cleaner.search_deadline, '2016-01-01 12:45:00')
+        
+        # Rows without a time leave pending searches alone:
+        actlog_cleaner.dispatch_row(search_row(7, 'emplid6', 'law', 'NULL'), 7)
+        self.assertIn('emplid3', actlog_cleaner.crs_search_states)
+        
+        actlog_cleaner.dispatch_row(search_row(8, 'emplid7', 'bio', '2016-01-01 12:50:00'), 8)
+        self.assertNotIn('emplid3', actlog_cleaner.crs_search_states)
+        self.assertEqual(actlog_cleaner.crs_search_buf.arr[-1], (3, 'math 51', None, None))
+        
+        # By default, searches time out after an hour:
+        self.assertEqual(ActivityLogCleaner(None, unittesting=True).search_timeout, 3600)
+
+        # Without timeout, searches continue:
+        actlog_cleaner = ActivityLogCleaner(None, search_timeout=0, unittesting=True)
+        actlog_cleaner.ip_dict = UnknownIpLocations()
+        actlog_cleaner.dispatch_row(search_row(1, 'emplid1', 'cs 1', '2016-01-01 10:00:00'), 1)
+        actlog_cleaner.dispatch_row(search_row(2, 'emplid1', 'cs 10', '2016-01-02 10:00:00'), 2)
+        self.assertEqual(actlog_cleaner.crs_search_states['emplid1']['search_term_accumulator'], 'cs 10')
+        self.assertListEqual(actlog_cleaner.crs_search_buf.arr, [])
+
+    #------------------------------------
+    # test_compact_schema
+    #-------------------
+
+    def test_compact_schema(self):
+
+        def row(row_id, caller, action, created_at, updated_at, emplid='emplid1'):
+            return [str(row_id), emplid, '171.66.16.37', caller, action, '{sunet:foo}',
+                    'NULL', 'NULL', 'Mozilla', created_at, updated_at]
+
+        actlog_cleaner = ActivityLogCleaner(None, compact_schema=True, unittesting=True)
+        actlog_cleaner.ip_dict = UnknownIpLocations()
+        actlog_cleaner.add_activity_record(row(1, 'get_recommendations', 'index',
+                                               '1970-01-02 00:00:01', '1970-01-02 00:00:01'))
+        actlog_cleaner.add_activity_record(row(2, 'post_feedback', 'feedback',
+                                               '1970-01-02 00:00:02', 'NULL'))
+        actlog_cleaner.add_activity_record(row(3, 'get_recommendations', 'index',
+                                               '1970-01-02 00:00:03', '1970-01-02 00:01:03', emplid='emplid2'))
+        self.assertListEqual(actlog_cleaner.activity_buf.arr,
+                             [('1', 1, '171.66.16.37', 1, 1, 86401, 86401),
+                              ('2', 1, '171.66.16.37', 1, 2, 86402, None),
+                              ('3', 2, '171.66.16.37', 1, 1, 86403, 86463)])
+        actions_buf = actlog_cleaner.dimension_bufs[actlog_cleaner.actions]
+        self.assertListEqual(actions_buf.arr,
+                             [(1, 'get_recommendations', 'index'), (2, 'post_feedback', 'feedback')])
+        self.assertEqual(actlog_cleaner.buffer_tables[actions_buf][0], 'Actions')
+        students_buf = actlog_cleaner.dimension_bufs[actlog_cleaner.students]
+        self.assertListEqual(students_buf.arr, [(1, 'emplid1'), (2, 'emplid2')])
+        # One Locations row instead of an IpLocation row per activity:
+        locations_buf = actlog_cleaner.dimension_bufs[actlog_cleaner.locations]
+        self.assertListEqual(locations_buf.arr, [(1,) + ActivityLogCleaner.DEFAULT_IPLOC_TUPLE])
+        self.assertEqual(len(ActivityLogCleaner.DEFAULT_IPLOC_TUPLE), 10)
+        self.assertNotIn(actlog_cleaner.ip_location_buf, actlog_cleaner.buffer_tables)
+        # Location values are keyed as str, like those read from the db:
+        actlog_cleaner.ip_dict = UnknownIpLocations({'171.64.75.72' : ('US', 'United States', 'California', 'Stanford',
+                                                                        37.421262, -122.163949, '94305', '-07:00', 
+                                                                        '1', '650')})
+        self.assertEqual(actlog_cleaner.location_id('171.64.75.72'), 2)
+        self.assertEqual(locations_buf.arr[-1][5:7], ('37.421262', '-122.163949'))
+        self.assertEqual(actlog_cleaner.buffer_tables[actlog_cleaner.activity_buf][0], 'ActivitiesCompact')
+        specs = actlog_cleaner.index_specs()
+        self.assertIn(('action_id_idx', 'ActivitiesCompact', 'action_id'), specs)
+        self.assertNotIn('Activities', [tbl_nm for _idx_nm, tbl_nm, _col_nm in specs])
+
+        # A resumed ingest keeps the ids:
+        actlog_cleaner = ActivityLogCleaner(None, compact_schema=True, unittesting=True)
+        actlog_cleaner.ip_dict = UnknownIpLocations()
+        actlog_cleaner.db = RecordingDb({'FROM Actions' : [(1, 'get_recommendations', 'index'),
+                                                           (4, 'pin', 'pin'),
+                                                           (5, 'get_recommendations', 'index')],
+                                         'FROM Students' : [(1, 'emplid1')],
+                                         'FROM Locations' : []})
+        actlog_cleaner.load_dimensions()
+        self.assertEqual(actlog_cleaner.dimension_id(actlog_cleaner.actions, ('get_recommendations', 'index')), 1)
+        self.assertEqual(actlog_cleaner.dimension_id(actlog_cleaner.actions, ('pin', 'unpin')), 6)
+        self.assertEqual(actlog_cleaner.dimension_id(actlog_cleaner.students, ('emplid1',)), 1)
+        
+        # The parent of a parallel ingest assigns the ids
+        # of each row as it is read, and the workers take
+        # them over:
+        worker = copy.deepcopy(actlog_cleaner)
+        worker.assigns_dimension_ids = False
+        actlog_cleaner.new_dimension_ids = []
+        actlog_cleaner.assign_dimension_ids(row(4, 'pin', 'pin', '1970-01-02 00:00:04', 
+                                                '1970-01-02 00:00:04', emplid='emplid2'))
+        self.assertListEqual(actlog_cleaner.new_dimension_ids,
+                             [('Students', ('emplid2',), 2),
+                              ('Locations', tuple(str(val) for val in ActivityLogCleaner.DEFAULT_IPLOC_TUPLE), 1)])
+        with self.assertRaises(RuntimeError):
+            worker.dimension_id(worker.students, ('emplid2',))
+        worker.add_dimension_ids(actlog_cleaner.new_dimension_ids)
+        worker.add_activity_record(row(4, 'pin', 'pin', '1970-01-02 00:00:04', 
+                                       '1970-01-02 00:00:04', emplid='emplid2'))
+        self.assertListEqual(worker.activity_buf.arr, [('4', 2, '171.66.16.37', 1, 4, 86404, 86404)])
+        self.assertListEqual(worker.dimension_bufs[worker.students].arr, [])
+
+        # Lookup tables are not rolled back to a checkpoint,
+        # and the views are (re)created:
+        checkpoint = IngestCheckpoint(__file__, 0, 3, head_digest='', head_len=0)
+        db = RecordingDb({'information_schema.tables' : ['VIEW']})
+        actlog_cleaner.db = MySqlBackend(db, ActivityLogCleaner.DB_NAME)
+        actlog_cleaner.restore_checkpoint(checkpoint)
+        actlog_cleaner.create_views()
+        self.assertIn('DELETE FROM ActivitiesCompact WHERE row_id > 3', db.statements)
+        self.assertFalse(any('FROM Actions' in statement or 'FROM Students' in statement 
+                             for statement in db.statements))
+        self.assertTrue(db.statements[-2].startswith('CREATE OR REPLACE VIEW Activities AS'))
+        self.assertIn("TIMESTAMP '1970-01-01 00:00:00' + INTERVAL act.created_at SECOND AS created_at",
+                      db.statements[-2])
+        self.assertTrue(db.statements[-1].startswith('CREATE OR REPLACE VIEW IpLocation AS'))
+
+    #------------------------------------
+    # test_ip_location_cache
+    #-------------------
+
+    def test_ip_location_cache(self):
+
+        class CountingIpTable:
+            version = 'v1'
+            def __init__(self):
+                self.num_lookups = 0
+            def lookupIP(self, ip_str):
+                self.num_lookups += 1
+                if ip_str == '171.64.75.72':
+                    return ('US', 'United States', 'California', 'Stanford',
+                            37.421262, -122.163949, '94305', '-07:00', '1', '650')
+                if ip_str.count('.') != 3:
+                    raise ValueError(f"IP string is not a valid IP address: '{ip_str}'")
+                raise KeyError(ip_str)
+
+        ip_table = CountingIpTable()
+        ip_cache = IpLocationCache(ip_table, max_entries=2)
+        for _i in range(3):
+            self.assertEqual(ip_cache.get('171.64.75.72')[3], 'Stanford')
+            # Misses and malformed addresses are cached too:
+            self.assertEqual(ip_cache.get('0.0.0.1', default='unknown'), 'unknown')
+        self.assertIsNone(ip_cache.get('NULL'))
+        self.assertIsNone(ip_cache.get('NULL'))
+        self.assertEqual(ip_table.num_lookups, 3)
+        self.assertEqual((ip_cache.num_hits, ip_cache.num_misses, ip_cache.num_not_found), (5, 3, 2))
+        with self.assertRaises(KeyError):
+            ip_cache.lookupIP('NULL')
+        # The least recently used address was evicted:
+        self.assertListEqual(list(ip_cache.entries.keys()), ['0.0.0.1', 'NULL'])
+
+        # Saved caches are reused by the same table version only:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = os.path.join(tmp_dir, 'ip_locations.cache')
+            ip_cache.cache_path = cache_path
+            ip_cache.save()
+            self.assertEqual(len(IpLocationCache(ip_table, cache_path=cache_path)), 2)
+            ip_table.version = 'v2'
+            self.assertEqual(len(IpLocationCache(ip_table, cache_path=cache_path)), 0)
+
+    #------------------------------------
+    # test_ip_range_index
+    #-------------------
+
+    def test_ip_range_index(self):
+
+        def ip_range(start, end, city):
+            return (start, end, 'US', 'United States', 'California', city,
+                    37.421262, -122.163949, '94305', '-07:00', '1', '650')
+
+        # 171.64.0.0 - 171.64.255.255 is Stanford, then
+        # a hole up to 171.66.0.0:
+        ip_table = IpFullLocation.fromRanges([ip_range(16777216, 2873098239, 'Elsewhere'),
+                                              ip_range(2873098240, 2873163775, 'Stanford'),
+                                              ip_range(2873229312, 4294967295, 'Beyond')])
+        self.assertEqual(ip_table.lookupIP('171.64.75.72'),
+                         ('US', 'United States', 'California', 'Stanford',
+                          37.421262, -122.163949, '94305', '-07:00', '1', '650'))
+        self.assertEqual(ip_table.lookupIP('171.64.0.0')[3], 'Stanford')
+        self.assertEqual(ip_table.lookupIP('171.63.255.255')[3], 'Elsewhere')
+        self.assertEqual(ip_table.lookupIP('255.255.255.255')[3], 'Beyond')
+        # Before the first range, and in the hole:
+        self.assertIsNone(ip_table.get('0.0.0.1'))
+        self.assertEqual(ip_table.get('171.65.0.1', default='unknown'), 'unknown')
+        with self.assertRaises(ValueError):
+            ip_table.lookupIP('NULL')
+        self.assertEqual(ip_table.getBy3LetterCode('US')[1], 'United States')
+
+    #------------------------------------
+    # test_ip_batch_lookup
+    #-------------------
+    
+    def test_ip_batch_lookup(self):
+        
+        def ip_range(start, end, city):
+            return (start, end, 'US', 'United States', 'California', city,
+                    37.421262, -122.163949, '94305', '-07:00', '1', '650')
+
+        ip_table = IpFullLocation.fromRanges([ip_range(16777216, 2873098239, 'Elsewhere'),
+                                              ip_range(2873098240, 2873163775, 'Stanford'),
+                                              ip_range(2873229312, 4294967295, 'Beyond')])
+        ips = ['171.64.75.72', '0.0.0.1', '171.65.0.1', '255.255.255.255', '171.63.255.255']
+        range_idxs = ip_table.lookup_many(ips)
+        self.assertListEqual(list(range_idxs), [1, -1, -1, 2, 0])
+        self.assertListEqual(ip_table.locations(range_idxs, default='unknown'),
+                             [ip_table.get(ip, default='unknown') for ip in ips])
+        
+        # Malformed addresses are not found, and do not
+        # disturb the others:
+        ips.extend(['NULL', None, '1.2.3', '171.64.1', '300.1.1.1'])
+        self.assertListEqual(list(ip_table.lookup_many(ips)), [1, -1, -1, 2, 0, -1, -1, -1, -1, -1])
+        self.assertListEqual(list(ip_table.lookup_ints([2873098240, 2873098239, 16777215])), 
+                             [1, 0, -1])
+        self.assertListEqual(list(ip_table.lookup_many([])), [])
+
+    #------------------------------------
+    # test_ip_table_file
+    #-------------------
+    
+    def test_ip_table_file(self):
+        
+        ranges = [(16777216, 16777471, 'AU', 'Australia', 'Queensland', 'Brisbane',
+                   -27.46794, 153.02809, '4000', '+10:00', '61', '07'),
+                  (16777472, 16778239, 'CN', 'China', 'Fujian', 'Fuzhou',
+                   26.06139, 119.30611, '350004', '+08:00', '86', '591'),
+                  (2873098240, 2873163775, 'US', 'United States', 'California', 'Stanford',
+                   37.421262, -122.163949, '94305', '-07:00', '1', '650'),
+                  (2873229312, 2873229567, 'US', 'United States', 'Hawaii', 'Kailua',
+                   21.402220, -157.739440, '96734', '-10:00', '1', '808')]
+        ip_table = IpFullLocation.fromRanges(ranges)
+        # Each distinct string is held once:
+        self.assertEqual(len(ip_table.rangeColumns.strs), 29)
+        self.assertEqual(ip_table.rangeColumns.range_tuple(3), ranges[3])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            table_file_path = os.path.join(tmp_dir, IpFullLocation.TABLE_FILE)
+            IpTableFile.write(ip_table.rangeColumns, table_file_path)
+            file_table = IpFullLocation(table_file_path)
+            self.assertEqual(len(file_table.rangeColumns), 4)
+            
+            ips = ['1.0.0.1', '1.0.3.255', '171.64.75.72', '171.66.0.255', 
+                   '0.0.0.1', '1.0.4.0', '171.65.0.1', '255.255.255.255']
+            for ip in ips:
+                self.assertEqual(file_table.get(ip), ip_table.get(ip))
+            self.assertEqual(file_table.lookupIP('171.64.75.72'),
+                             ('US', 'United States', 'California', 'Stanford',
+                              37.421262, -122.163949, '94305', '-07:00', '1', '650'))
+            self.assertListEqual(file_table.locations(file_table.lookup_many(ips)),
+                                 ip_table.locations(ip_table.lookup_many(ips)))
+            self.assertDictEqual(file_table.twoLetterKeyedDict, ip_table.twoLetterKeyedDict)
+            self.assertIsNone(file_table.ipDict)
+            
+            # Other files are refused:
+            with open(table_file_path, 'r+b') as fd:
+                fd.write(b'NOTATABL')
+            with self.assertRaises(ValueError):
+                IpTableFile(table_file_path)
+            del file_table
+
+    #------------------------------------
+    # test_ip_table_build
+    #-------------------
+    
+    def test_ip_table_build(self):
+        
+        csv_lines = ['"0","16777215","-","-","-","-","0.000000","0.000000","-","-","-","-"',
+                     '"16777216","16777471","AU","Australia","Queensland","Brisbane",'
+                     '"-27.467940","153.028090","4000","+10:00","61","07"',
+                     '"16777472","16778239","KR","Korea, Republic of","Seoul","Seoul",'
+                     '"37.566000","126.978000","100-011","+09:00","82","02"',
+                     '"2873098240","2873163775","US","United States","California","Stanford",'
+                     '"37.421262","-122.163949","94305","-07:00","1","650"'
+                     ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = os.path.join(tmp_dir, 'ip.csv')
+            table_file_path = os.path.join(tmp_dir, IpFullLocation.TABLE_FILE)
+            with open(csv_path, 'w', newline='') as fd:
+                fd.write('\r\n'.join(csv_lines) + '\r\n')
+            
+            ip_table = IpFullLocation(csv_path, tableFilePath=table_file_path, numWorkers=1)
+            self.assertEqual(len(ip_table.rangeColumns), 3)
+            self.assertEqual(ip_table.lookupIP('1.0.2.0')[1], 'Korea, Republic of')
+            self.assertEqual(ip_table.lookupIP('171.64.75.72'),
+                             ('US', 'United States', 'California', 'Stanford',
+                              37.421262, -122.163949, '94305', '-07:00', '1', '650'))
+            self.assertEqual(ip_table.getBy3LetterCode('AU'), ('AU', 'Australia', 'Queensland', 'Brisbane'))
+            
+            # The next instance maps the table file:
+            ip_table = IpFullLocation(csv_path, tableFilePath=table_file_path)
+            self.assertIsInstance(ip_table.rangeColumns, IpTableFile)
+            self.assertEqual(ip_table.lookupIP('1.0.0.1')[3], 'Brisbane')
+            self.assertTrue(ip_table.rangeColumns.is_built_from(csv_path))
+            
+            # Once the csv file changes, the table is rebuilt.
+            # An odd line is parsed line by line:
+            csv_lines[1] = csv_lines[1].replace('Brisbane', 'Gold Coast')
+            csv_lines.append('# Comment')
+            with open(csv_path, 'w', newline='') as fd:
+                fd.write('\n'.join(csv_lines) + '\n')
+            ip_table = IpFullLocation(csv_path, tableFilePath=table_file_path)
+            self.assertNotIsInstance(ip_table.rangeColumns, IpTableFile)
+            self.assertEqual(ip_table.lookupIP('1.0.0.1')[3], 'Gold Coast')
+            self.assertEqual(ip_table.lookupIP('1.0.2.0')[1], 'Korea, Republic of')
+            self.assertEqual(IpTableFile(table_file_path).location(0)[3], 'Gold Coast')
+            
+            # Parsing in parallel chunks gives the same table:
+            columns = IpRangeColumns.from_csv(csv_path, num_workers=2, chunk_bytes=100)
+            self.assertListEqual([columns.range_tuple(range_idx) for range_idx in range(3)],
+                                 [ip_table.rangeColumns.range_tuple(range_idx) for range_idx in range(3)])
+            del ip_table
+
+    #------------------------------------
+    # test_geolocate_stream
+    #-------------------
+    
+    def test_geolocate_stream(self):
+        
+        ip_table = IpFullLocation.fromRanges([(2873098240, 2873163775, 'US', 'United States', 'California', 'Stanford',
+                                               37.421262, -122.163949, '94305', '-07:00', '1', '650')])
+        # One address per line:
+        out_fd = io.StringIO()
+        num_lines = ip_table.geolocate_stream(io.StringIO('171.64.75.72\n10.0.0.1\nNULL\n'), out_fd, batch_size=2)
+        self.assertEqual(num_lines, 3)
+        self.assertListEqual(out_fd.getvalue().splitlines(),
+                             ['ip\t' + '\t'.join(IpFullLocation.LOCATION_COLS),
+                              '171.64.75.72\tUS\tUnited States\tCalifornia\tStanford\t37.421262\t-122.163949\t'
+                              '94305\t-07:00\t1\t650',
+                              '10.0.0.1' + '\t' * 10,
+                              'NULL' + '\t' * 10])
+        
+        # A named column of a csv file:
+        out_fd = io.StringIO()
+        ip_table.geolocate_stream(io.StringIO('user,client_ip\n"Doe, J.",171.64.75.72\nRoe,\n'), out_fd,
+                                  ip_col='client_ip', delimiter=',')
+        lines = out_fd.getvalue().splitlines()
+        self.assertEqual(lines[0], 'user,client_ip,' + ','.join(IpFullLocation.LOCATION_COLS))
+        self.assertTrue(lines[1].startswith('"Doe, J.",171.64.75.72,US,United States,California,Stanford,'))
+        self.assertEqual(lines[2], 'Roe,' + ',' * 10)
+        with self.assertRaises(ValueError):
+            ip_table.geolocate_stream(io.StringIO('user,ip\n'), io.StringIO(), ip_col='client_ip', delimiter=',')
+
+    #------------------------------------
+    # test_parquet_export
+    #-------------------
+    
+    @unittest.skipIf(pq is None, 'pyarrow not installed')
+    def test_parquet_export(self):
+        
+        rows = [
+            ['1', 'emplid1', '171.66.16.37', 'pin', 'pin', '{selected_course:105670, name:CS140}',
+             'NULL', 'NULL', 'Mozilla', '2016-01-01 10:00:00', 'NULL'],
+            ['2', 'emplid1', '171.66.16.37', 'pin', 'pin', '{selected_course:105687, name:CS145}',
+             'NULL', 'NULL', 'Mozilla', '2016-01-01 10:00:01', '2016-01-01 10:00:01'],
+            ]
+        with tempfile.TemporaryDirectory() as out_dir:
+            log_path = os.path.join(out_dir, 'log.tsv')
+            write_log(rows, log_path)
+            actlog_cleaner = ActivityLogCleaner(None, columnar_buffers=True, unittesting=True)
+            actlog_cleaner.ip_dict = UnknownIpLocations()
+            sink = ParquetTableSink(os.path.join(out_dir, 'export'))
+            actlog_cleaner.build_pipeline(log_path, sink).run()
+            
+            pins = pq.read_table(os.path.join(out_dir, 'export', 'Pins'))
+            self.assertListEqual(pins.to_pylist(), [{'row_id' : 1, 'crs_id' : 105670},
+                                                    {'row_id' : 2, 'crs_id' : 105687}])
+            # Typed columns; unparsable times are nulls:
+            activities = pq.read_table(os.path.join(out_dir, 'export', 'Activities'))
+            self.assertEqual(str(activities.schema.field('row_id').type), 'int64')
+            self.assertTrue(str(activities.schema.field('created_at').type).startswith('timestamp'))
+            self.assertListEqual(activities.column('row_id').to_pylist(), [1, 2])
+            self.assertListEqual([str(time) for time in activities.column('updated_at').to_pylist()],
+                                 ['None', '2016-01-01 10:00:01'])
+            locations = pq.read_table(os.path.join(out_dir, 'export', 'IpLocation'))
+            self.assertListEqual(locations.column('lat').to_pylist(), [0.0, 0.0])
+            self.assertEqual(locations.column('country')[0].as_py(), 'Country-Unknown')
+            
+            # Epoch second times of the compact schema, from
+            # tuples; a new part file after each batch:
+            sink = ParquetTableSink(os.path.join(out_dir, 'export'), rows_per_file=2)
+            sink.write('ActivitiesCompact', ('row_id', 'student_id', 'created_at'), [('1', 1, 86401), ('2', 1, None)])
+            sink.write('ActivitiesCompact', ('row_id', 'student_id', 'created_at'), [('3', 2, 86403)])
+            sink.close()
+            compact_dir = os.path.join(out_dir, 'export', 'ActivitiesCompact')
+            self.assertListEqual(sorted(os.listdir(compact_dir)), ['part-00000.parquet', 'part-00001.parquet'])
+            compact = pq.read_table(compact_dir)
+            self.assertListEqual([str(time) for time in compact.column('created_at').to_pylist()],
+                                 ['1970-01-02 00:00:01', 'None', '1970-01-02 00:00:03'])
+            
+            # A new export replaces the part files:
+            ParquetTableSink.remove_parts(os.path.join(out_dir, 'export'), ['ActivitiesCompact'])
+            self.assertListEqual(os.listdir(compact_dir), [])
+
+    #------------------------------------
+    # test_sqlite_backend
+    #-------------------
+    
+    def test_sqlite_backend(self):
+        
+        rows = [
+            ['1', 'emplid1', '171.66.16.37', 'pin', 'pin', '{selected_course:105670, name:CS140}',
+             'NULL', 'NULL', 'Mozilla', '2016-01-01 10:00:00', '2016-01-01 10:00:00'],
+            ['2', 'emplid1', '171.66.16.37', 'find_search', 'search', '{search_term:cs 1}',
+             'NULL', '{results:[105670, 105687]}', 'Mozilla', '2016-01-01 10:00:01', '2016-01-01 10:00:01'],
+            ['3', 'emplid2', '171.66.16.37', 'pin', 'pin', '{selected_course:105687, name:CS145}',
+             'NULL', 'NULL', 'Mozilla', '2016-01-01 10:00:02', '2016-01-01 10:00:02'],
+            ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'log.tsv')
+            write_log(rows, log_path)
+            # Same content of Activities, whether a
+            # table, or a view of the compact schema:
+            activities = {}
+            for compact_schema in (False, True):
+                actlog_cleaner = ActivityLogCleaner(log_path,
+                                                    sqlite_path=os.path.join(tmp_dir, f"actlog_{compact_schema}.sqlite"),
+                                                    compact_schema=compact_schema,
+                                                    checkpoints=False,
+                                                    unittesting=True)
+                actlog_cleaner.ip_dict = UnknownIpLocations()
+                db = actlog_cleaner.open_db()
+                self.assertIsInstance(db, SqliteBackend)
+                actlog_cleaner.ingest(log_path)
+                actlog_cleaner.add_primary_keys()
+                actlog_cleaner.create_indexes()
+                
+                self.assertListEqual(list(db.query("SELECT row_id, crs_id FROM Pins ORDER BY row_id")),
+                                     [(1, 105670), (3, 105687)])
+                self.assertListEqual(list(db.query("SELECT row_id, search_term FROM CrseSearches")), [(2, 'cs 1')])
+                activities[compact_schema] = list(db.query('''SELECT row_id, student, category, created_at 
+                                                                FROM Activities ORDER BY row_id'''))
+                self.assertEqual(db.table_type('Activities'), 'VIEW' if compact_schema else 'BASE TABLE')
+                # Deferred primary key, and the indexes:
+                self.assertTrue(db.index_exists('Pins', 'crs_id'))
+                if compact_schema:
+                    self.assertTrue(db.index_exists('ActivitiesCompact', 'row_id'))
+                    self.assertTrue(db.index_exists('ActivitiesCompact', 'created_at'))
+                else:
+                    self.assertTrue(db.index_exists('Activities', 'row_id'))
+                    self.assertTrue(db.index_exists('Activities', 'created_at'))
+                    self.assertListEqual(list(db.query("SELECT row_id, country FROM IpLocation WHERE row_id = 1")),
+                                         [(1, 'Country-Unknown')])
+                db.close()
+            self.assertListEqual(activities[False],
+                                 [(1, 'emplid1', 'pin', '2016-01-01 10:00:00'),
+                                  (2, 'emplid1', 'find_search', '2016-01-01 10:00:01'),
+                                  (3, 'emplid2', 'pin', '2016-01-01 10:00:02')])
+            self.assertListEqual(activities[True], activities[False])
+
+    #------------------------------------
+    # test_async_db_sink
+    #-------------------
+    
+    def test_async_db_sink(self):
+        
+        db = WarningDb()
+        sink = AsyncTableSink(DbTableSink(MySqlBackend(db, ActivityLogCleaner.DB_NAME)), max_pending=1)
+        for row_id in range(5):
+            sink.write('CrseSearches', ('row_id', 'search_term'), [(row_id, 'cs 1')])
+        sink.close()
+        
+        # All rows written, in order:
+        self.assertListEqual([row[0] for row in db.inserted], list(range(5)))
+        # Warnings came back to this thread:
+        self.assertEqual(sink.truncated_search_terms, 5)
+        self.assertEqual(sink.flush_latencies['CrseSearches'][0], 5)
+
+    #------------------------------------
+    # test_load_data_escaping
+    #-------------------
+    
+    def test_load_data_escaping(self):
+        
+        sink = LoadDataTableSink(None)
+        rows = [(10, 'cs\t106\\a', None, 37.421262),
+                (11, 'two\nlines', '[123456, 234567]', 0.0)]
+        lines = list(sink.tsv_lines(rows))
+        expected = ['10\tcs\\t106\\\\a\t\\N\t37.421262\n',
+                    '11\ttwo\\nlines\t[123456, 234567]\t0.0\n']
+        self.assertListEqual(lines, expected)
+
+    #------------------------------------
+    # test_bulk_load_session
+    #-------------------
+    
+    def test_bulk_load_session(self):
+        
+        db = RecordingDb({
+            'SELECT @@SESSION.bulk_insert_buffer_size' : [(8388608, 8388608)],
+            'SHOW KEYS FROM Activities' : [('Activities', 0, 'PRIMARY', 1, 'row_id')],
+            'SELECT COUNT(*) FROM Activities' : [0]
+            })
+        session = BulkLoadSession(db, ['Activities', 'Pins'], 
+                                  bulk_insert_buffer_size=1000, 
+                                  myisam_sort_buffer_size=2000)
+        session.apply_session_settings()
+        session.disable_keys()
+        session.enable_keys()
+        session.restore_session_settings()
+        
+        expected = ['SET SESSION bulk_insert_buffer_size = 1000',
+                    'SET SESSION myisam_sort_buffer_size = 2000',
+                    'ALTER TABLE Activities DROP PRIMARY KEY',
+                    'ALTER TABLE Activities DISABLE KEYS',
+                    'ALTER TABLE Pins DISABLE KEYS',
+                    'ALTER TABLE Activities ENABLE KEYS',
+                    'ALTER TABLE Activities ADD PRIMARY KEY(row_id)',
+                    'ALTER TABLE Pins ENABLE KEYS',
+                    'SET SESSION bulk_insert_buffer_size = 8388608',
+                    'SET SESSION myisam_sort_buffer_size = 8388608'
+                    ]
+        self.assertListEqual(db.statements, expected)
+
+        # Cleanup after the load finds nothing left to do:
+        session.enable_keys()
+        session.restore_session_settings()
+        self.assertListEqual(db.statements, expected)
+        
+        # A resumed load into a filled table, whose primary
+        # key an earlier run dropped:
+        db = RecordingDb({
+            'SHOW KEYS FROM Activities' : [],
+            'SELECT COUNT(*) FROM Activities' : [1000]
+            })
+        session = BulkLoadSession(db, ['Activities'])
+        session.disable_keys()
+        session.enable_keys()
+        expected = ['ALTER TABLE Activities DISABLE KEYS',
+                    'ALTER TABLE Activities ENABLE KEYS',
+                    'ALTER TABLE Activities ADD PRIMARY KEY(row_id)'
+                    ]
+        self.assertListEqual(db.statements, expected)
+
+    #------------------------------------
+    # test_index_builder
+    #-------------------
+    
+    def test_index_builder(self):
+        
+        db = RecordingDb({
+            'information_schema.statistics' : [('Pins', 'PRIMARY', 'row_id')],
+            'information_schema.tables' : [('Pins', 1000), ('Activities', 50000)]
+            })
+        specs = [('row_id_idx', 'Pins', 'row_id'),
+                 ('crs_id_idx', 'Pins', 'crs_id'),
+                 ('created_at_idx', 'Activities', 'created_at'),
+                 ('row_id_idx', 'NoSuchTable', 'row_id')
+                 ]
+        builder = IndexBuilder(lambda : MySqlBackend(db, ActivityLogCleaner.DB_NAME), specs, pool_size=1)
+        durations = builder.build()
+        
+        # Existing and impossible indexes skipped; largest table first:
+        self.assertListEqual(db.statements,
+                             ['CREATE INDEX created_at_idx ON Activities(created_at);',
+                              'CREATE INDEX crs_id_idx ON Pins(crs_id);'])
+        self.assertListEqual([(tbl_nm, idx_nm) for tbl_nm, idx_nm, _secs in durations],
+                             [('Activities', 'created_at_idx'), ('Pins', 'crs_id_idx')])
 
 # --------------------- Main ----------------
 if __name__ == "__main__":